@@ -3,6 +3,8 @@ from . import *
 
 import matplotlib.ticker as mtick
 
+from ..core.cache import SimulationMemo
+
 def plot_compute_increase(
     scenario_group, title = "Compute increase over time", get_label = lambda scenario: scenario.name,
     show_legend = True, crop_at_year = None):
@@ -11,7 +13,7 @@ def plot_compute_increase(
 
   for i, scenario in enumerate(scenario_group):
     plt.subplot(len(scenario_group), 1, i + 1)
-    scenario.model.plot_compute_decomposition(new_figure=False, crop_at_year=crop_at_year)
+    scenario.result.plot_compute_decomposition(new_figure=False, crop_at_year=crop_at_year)
     plt.ylabel(get_label(scenario))
 
     if i == 0:
@@ -89,17 +91,18 @@ def explore(exploration_target='compare', report_file_path=None, report_dir_path
   # Run simulations
   log.info('Running simulations...')
 
+  memo = SimulationMemo()
+
   log.info('  Conservative simulation')
-  low_model = SimulateTakeOff(**low_params)
-  low_model.run_simulation()
+  low_result = memo.simulate(**low_params)
 
   log.info('  Best guess simulation')
-  med_model = SimulateTakeOff(**med_params)
-  med_model.run_simulation()
+  med_result = memo.simulate(**med_params)
 
   log.info('  Aggressive simulation')
-  high_model = SimulateTakeOff(**high_params)
-  high_model.run_simulation()
+  high_result = memo.simulate(**high_params)
+
+  memo.log_summary()
 
   log.info('Writing report...')
   new_report = report is None
@@ -109,14 +112,14 @@ def explore(exploration_target='compare', report_file_path=None, report_dir_path
   report.add_paragraph(f"<span style='font-weight:bold'>Exploration target:</span> {exploration_target}")
 
   # Print table of metrics
-  low_results = {**{'type' : 'Conservative', 'value' : low_value},  **low_model.timeline_metrics, **low_model.takeoff_metrics}
-  med_results = {**{'type' : 'Best guess', 'value' : med_value},  **low_model.timeline_metrics, **med_model.takeoff_metrics}
-  high_results = {**{'type' : 'Aggressive', 'value' : high_value},  **low_model.timeline_metrics, **high_model.takeoff_metrics}
+  low_results = {**{'type' : 'Conservative', 'value' : low_value},  **low_result.timeline_metrics, **low_result.takeoff_metrics}
+  med_results = {**{'type' : 'Best guess', 'value' : med_value},  **low_result.timeline_metrics, **med_result.takeoff_metrics}
+  high_results = {**{'type' : 'Aggressive', 'value' : high_value},  **low_result.timeline_metrics, **high_result.takeoff_metrics}
 
   for metric in ['doubling_times']:
-    low_results[metric] = getattr(low_model, metric)
-    med_results[metric] = getattr(med_model, metric)
-    high_results[metric] = getattr(high_model, metric)
+    low_results[metric] = getattr(low_result, metric)
+    med_results[metric] = getattr(med_result, metric)
+    high_results[metric] = getattr(high_result, metric)
 
   results = [low_results, med_results, high_results]
   results = pd.DataFrame(results)
@@ -140,18 +143,18 @@ def explore(exploration_target='compare', report_file_path=None, report_dir_path
   plt.figure(figsize=(14, 8), dpi=80)
 
   plt.subplot(3, 1, 1)
-  low_model.plot_compute_decomposition(new_figure=False)
+  low_result.plot_compute_decomposition(new_figure=False)
   plt.ylabel(sub_ylabels['Conservative'], fontweight='bold')
   plt.title(f"Compute increase over time")
   plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left', borderaxespad=0)
   plt.gcf().tight_layout(rect=[0, 0.03, 1, 0.95])
 
   plt.subplot(3, 1, 2)
-  med_model.plot_compute_decomposition(new_figure=False)
+  med_result.plot_compute_decomposition(new_figure=False)
   plt.ylabel(sub_ylabels['Best guess'], fontweight='bold')
 
   plt.subplot(3, 1, 3)
-  high_model.plot_compute_decomposition(new_figure=False)
+  high_result.plot_compute_decomposition(new_figure=False)
   plt.ylabel(sub_ylabels['Aggressive'], fontweight='bold')
 
   plt.gcf().text(-0.012, 0.5, ylabel, va='center', ha='center', rotation='vertical', fontsize=14, fontweight='bold')
@@ -162,9 +165,9 @@ def explore(exploration_target='compare', report_file_path=None, report_dir_path
   if exploration_target in ['both_requirements_steepness', 'training_requirements_steepness', 'runtime_requirements_steepness']:
     training = (exploration_target == 'training_requirements_steepness')
 
-    requirements_low = low_model.automation_training_flops_goods if training else low_model.automation_runtime_flops_goods
-    requirements_med = med_model.automation_training_flops_goods if training else med_model.automation_runtime_flops_goods
-    requirements_high = high_model.automation_training_flops_goods if training else high_model.automation_runtime_flops_goods
+    requirements_low = low_result.automation_training_flops_goods if training else low_result.automation_runtime_flops_goods
+    requirements_med = med_result.automation_training_flops_goods if training else med_result.automation_runtime_flops_goods
+    requirements_high = high_result.automation_training_flops_goods if training else high_result.automation_runtime_flops_goods
 
     lims = [
       0.1 * min(
@@ -209,13 +212,13 @@ def explore(exploration_target='compare', report_file_path=None, report_dir_path
   report.add_header("Model summaries", level = 3)
 
   report.add_header("Conservative", level = 4)
-  report.add_data_frame(low_model.get_summary_table())
+  report.add_data_frame(low_result.get_summary_table())
 
   report.add_header("Best guess", level = 4)
-  report.add_data_frame(med_model.get_summary_table())
+  report.add_data_frame(med_result.get_summary_table())
 
   report.add_header("Aggressive", level = 4)
-  report.add_data_frame(high_model.get_summary_table())
+  report.add_data_frame(high_result.get_summary_table())
 
   # Write down the parameters
   if med_params['runtime_training_tradeoff'] <= 0:
@@ -0,0 +1,362 @@
+"""
+Golden trajectories.
+
+Records the outputs of the model for a fixed corpus of parameter sets and
+checks that another version of the model (eg, a faster engine) reproduces
+them within per-variable tolerances.
+
+  python -m ftm.analysis.golden record
+  python -m ftm.analysis.golden compare [--engine module:Class]
+
+The parameters are stored along with the outputs, so the comparison doesn't
+depend on the spreadsheet being unchanged.
+"""
+
+from . import log
+from . import *
+
+import json
+import time
+import importlib
+import traceback
+
+from .diffy import compare_dicts, DIFF_COL
+from ..core.results import SimulationResult
+from ..core.utils import PROJECT_DIR, load_parameters_from_json
+from ..stats.distributions import TakeoffParamsDist
+
+DEFAULT_RTOL = 1e-9
+EPS = 1e-40
+
+# Per-variable relative tolerances (the rest use DEFAULT_RTOL)
+TOLERANCES = {
+  'rampup': 0,
+  'cooldown': 0,
+  'automatable_tasks_goods': 0,
+  'automatable_tasks_rnd': 0,
+  'automatable_tasks_goods_no_tradeoff': 0,
+  'automatable_tasks_rnd_no_tradeoff': 0,
+}
+
+MANIFEST_FILE = 'manifest.json'
+EXTENSION = '.ftmr'
+
+def get_default_golden_dir():
+  return os.path.join(get_option('cache_dir'), 'golden')
+
+#--------------------------------------------------------------------------
+# Corpus
+#--------------------------------------------------------------------------
+
+def get_corpus(mc_seeds = 5, include_spreadsheet = True):
+  """ Returns the parameter sets to record (case name -> parameters) """
+
+  time_settings = {
+    't_start': get_option('t_start', 2022),
+    't_end':   get_option('t_end',   2100),
+    't_step':  get_option('t_step',  0.1),
+  }
+
+  corpus = {}
+
+  for name in ['updated_baseline', 'updated_conservative']:
+    _, params = load_parameters_from_json(os.path.join(PROJECT_DIR, f'{name}.json'))
+    corpus[name] = {**params, **time_settings}
+
+  baseline = corpus['updated_baseline']
+
+  # Edge cases
+  corpus['updated_baseline_t_step_1']         = {**baseline, 't_step': 1}
+  corpus['updated_baseline_no_automation']    = {**baseline, 'disable_automation': True}
+  corpus['updated_baseline_dynamic_t_end']    = {**baseline, 'dynamic_t_end': True, 't_end': None}
+  corpus['overflow']                          = {**baseline, 'software_returns': 50, 'software_ceiling': 1e300}
+
+  if include_spreadsheet:
+    try:
+      parameter_table = get_parameter_table(tradeoff_enabled = 'from_spreadsheet')
+
+      for column in ['Best guess', 'Conservative', 'Aggressive']:
+        params = {
+          parameter: row[column] if not np.isnan(row[column]) else row['Best guess']
+          for parameter, row in parameter_table.iterrows()
+        }
+        corpus[column.lower().replace(' ', '_')] = {**params, **time_settings}
+
+      if mc_seeds > 0:
+        params_dist = TakeoffParamsDist(max_frac_automatable_tasks_goods = 0, max_frac_automatable_tasks_rnd = 0.05)
+        for seed in range(mc_seeds):
+          sample = params_dist.rvs(1, random_state = np.random.default_rng(seed)).iloc[0]
+          corpus[f'mc_{seed}'] = {**sample.to_dict(), **time_settings}
+    except Exception as e:
+      log.info(f'Could not read the parameters from the spreadsheet; skipping those cases ({e})')
+
+  return corpus
+
+#--------------------------------------------------------------------------
+# Engines
+#--------------------------------------------------------------------------
+
+def load_engine(engine = None):
+  """ `engine` is either a class with the interface of SimulateTakeOff, or a 'module:Class' string """
+  if engine is None:
+    return SimulateTakeOff
+
+  if isinstance(engine, str):
+    module_name, class_name = engine.split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+  return engine
+
+def run_engine(engine, params):
+  return engine(**params).run_simulation(return_result = True)
+
+#--------------------------------------------------------------------------
+# Record
+#--------------------------------------------------------------------------
+
+def record(golden_dir = None, corpus = None, engine = None):
+  if golden_dir is None: golden_dir = get_default_golden_dir()
+  if corpus is None: corpus = get_corpus()
+
+  engine = load_engine(engine)
+
+  os.makedirs(golden_dir, exist_ok = True)
+
+  log.info(f'Recording {len(corpus)} golden trajectories in {golden_dir}')
+  log.indent()
+  for case, params in corpus.items():
+    log.info(f'{case}...')
+    result = run_engine(engine, params)
+    with open(os.path.join(golden_dir, case + EXTENSION), 'wb') as f:
+      f.write(result.to_bytes())
+  log.deindent()
+
+  manifest = {
+    'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+    'engine': f'{engine.__module__}:{engine.__qualname__}',
+    'cases': list(corpus.keys()),
+  }
+  with open(os.path.join(golden_dir, MANIFEST_FILE), 'w') as f:
+    json.dump(manifest, f, indent = 2)
+
+  return manifest
+
+def load_golden(golden_dir = None):
+  """ Returns a dict case -> SimulationResult """
+  if golden_dir is None: golden_dir = get_default_golden_dir()
+
+  with open(os.path.join(golden_dir, MANIFEST_FILE), 'r') as f:
+    manifest = json.load(f)
+
+  golden = {}
+  for case in manifest['cases']:
+    with open(os.path.join(golden_dir, case + EXTENSION), 'rb') as f:
+      golden[case] = SimulationResult.from_bytes(f.read())
+  return golden
+
+#--------------------------------------------------------------------------
+# Compare
+#--------------------------------------------------------------------------
+
+class Divergence:
+  """ Outcome of comparing a result against its golden trajectory """
+  def __init__(self, case):
+    self.case = case
+    self.exception = None
+    self.step = None       # first divergent step (None if the trajectories match)
+    self.year = None
+    self.variables = []    # variables that diverge at that step
+    self.step_table = None # compare_dicts table at that step
+    self.metrics_table = None
+    self.length_mismatch = None
+
+  @property
+  def ok(self):
+    return self.exception is None and self.step is None and self.length_mismatch is None \
+        and not self.get_metric_mismatches()
+
+  def get_metric_mismatches(self):
+    if self.metrics_table is None: return []
+    return list(self.metrics_table.index[self.metrics_table['Mismatch']])
+
+def values_match(a, b, rtol):
+  """ Elementwise |a - b| <= rtol * max(|a|, |b|), with NaNs matching NaNs """
+  a = np.asarray(a, dtype = np.float64)
+  b = np.asarray(b, dtype = np.float64)
+  with np.errstate(invalid = 'ignore'):
+    close = np.abs(a - b) <= rtol * np.maximum(np.abs(a), np.abs(b)) + EPS
+  return close | (a == b) | (np.isnan(a) & np.isnan(b))
+
+def compare_result(case, golden, result, tolerances = None, default_rtol = DEFAULT_RTOL):
+  if tolerances is None: tolerances = {}
+  tolerances = {**TOLERANCES, **tolerances}
+  get_rtol = lambda var: tolerances.get(var, default_rtol)
+
+  divergence = Divergence(case)
+
+  # Metrics
+  golden_metrics = {**golden.timeline_metrics, **golden.takeoff_metrics, 'doubling_times': golden.doubling_times}
+  result_metrics = {**result.timeline_metrics, **result.takeoff_metrics, 'doubling_times': result.doubling_times}
+  metrics_table = compare_dicts(golden_metrics, result_metrics, {}, name_a = 'Golden', name_b = 'Engine', add_line_numbers = False)
+  metrics_table['Mismatch'] = [
+    not (var in result_metrics and len(np.atleast_1d(golden_metrics[var])) == len(np.atleast_1d(result_metrics[var]))
+         and np.all(values_match(golden_metrics[var], result_metrics[var], get_rtol(var))))
+    for var in metrics_table.index
+  ]
+  divergence.metrics_table = metrics_table
+
+  # Trajectories
+  if golden.n_timesteps != result.n_timesteps:
+    divergence.length_mismatch = (golden.n_timesteps, result.n_timesteps)
+
+  n_steps = min(golden.n_timesteps, result.n_timesteps)
+  first_step = n_steps
+  first_step_variables = []
+  for var, golden_values in golden.arrays.items():
+    if var not in result.arrays or len(golden_values) != golden.n_timesteps:
+      continue # not a trajectory
+    result_values = result.arrays[var]
+
+    mismatches = ~values_match(golden_values[:n_steps], result_values[:n_steps], get_rtol(var))
+    if np.any(mismatches):
+      step = np.argmax(mismatches)
+      if step < first_step:
+        first_step = step
+        first_step_variables = [var]
+      elif step == first_step:
+        first_step_variables.append(var)
+
+  if first_step < n_steps:
+    divergence.step = int(first_step)
+    divergence.year = golden.index_to_time(first_step)
+    divergence.variables = first_step_variables
+
+    golden_state = {var: values[first_step] for var, values in golden.arrays.items() if len(values) == golden.n_timesteps}
+    result_state = {var: values[first_step] for var, values in result.arrays.items() if len(values) == result.n_timesteps}
+    divergence.step_table = compare_dicts(golden_state, result_state, {}, name_a = 'Golden', name_b = 'Engine', add_line_numbers = False)
+
+  return divergence
+
+def compare(golden_dir = None, engine = None, tolerances = None, default_rtol = DEFAULT_RTOL, cases = None):
+  engine = load_engine(engine)
+  golden = load_golden(golden_dir)
+
+  if cases is not None:
+    golden = {case: golden[case] for case in cases}
+
+  divergences = []
+
+  log.info(f'Comparing {engine.__module__}:{engine.__qualname__} against {len(golden)} golden trajectories')
+  log.indent()
+  for case, golden_result in golden.items():
+    try:
+      result = run_engine(engine, golden_result.input_params)
+      divergence = compare_result(case, golden_result, result, tolerances, default_rtol)
+    except Exception as e:
+      divergence = Divergence(case)
+      divergence.exception = e
+
+    log_divergence(divergence)
+    divergences.append(divergence)
+  log.deindent()
+
+  failed = [d.case for d in divergences if not d.ok]
+  if failed:
+    log.info(f'{len(failed)} of {len(divergences)} cases diverge: {", ".join(failed)}')
+  else:
+    log.info(f'All {len(divergences)} cases match')
+
+  return divergences
+
+def log_divergence(divergence):
+  if divergence.ok:
+    log.info(f'{divergence.case}: OK')
+    return
+
+  log.info(f'{divergence.case}: DIVERGES')
+  log.indent()
+
+  if divergence.exception is not None:
+    log.info('The engine threw an exception:')
+    log.info(''.join(traceback.format_exception(divergence.exception)), end = '')
+    log.deindent()
+    return
+
+  if divergence.length_mismatch is not None:
+    log.info(f'Number of steps: {divergence.length_mismatch[0]} (golden) vs {divergence.length_mismatch[1]} (engine)')
+
+  mismatches = divergence.get_metric_mismatches()
+  if mismatches:
+    log.info('Metrics:')
+    log.info(divergence.metrics_table.loc[mismatches, ['Golden', 'Engine', DIFF_COL]].to_string())
+
+  if divergence.step is not None:
+    log.info(f'First divergent step: {divergence.step} (year {divergence.year:.2f}), variables: {", ".join(divergence.variables)}')
+    table = divergence.step_table
+    log.info(table[table[DIFF_COL].apply(lambda x: isinstance(x, str) or x > 0)].to_string())
+
+  log.deindent()
+
+if __name__ == '__main__':
+  parser = init_cli_arguments()
+
+  parser.add_argument(
+    "action",
+    choices = ['record', 'compare'],
+  )
+
+  parser.add_argument(
+    "-g",
+    "--golden-dir",
+    default=None,
+    help="Directory of the golden trajectories (defaults to <cache_dir>/golden)",
+  )
+
+  parser.add_argument(
+    "-e",
+    "--engine",
+    default=None,
+    help="Model class to run, as 'module:Class' (defaults to ftm.core.model:SimulateTakeOff)",
+  )
+
+  parser.add_argument(
+    "--mc-seeds",
+    type=int,
+    default=5,
+    help="Number of Monte Carlo samples to add to the corpus (when recording)",
+  )
+
+  parser.add_argument(
+    "--no-spreadsheet",
+    action='store_true',
+    help="Don't add the spreadsheet parameter sets (nor the Monte Carlo samples) to the corpus",
+  )
+
+  parser.add_argument(
+    "--rtol",
+    type=float,
+    default=DEFAULT_RTOL,
+    help="Default relative tolerance",
+  )
+
+  parser.add_argument(
+    "--tolerance",
+    action='append',
+    default=[],
+    help="Relative tolerance for a specific variable, as 'variable=rtol' (can be repeated)",
+  )
+
+  args = handle_cli_arguments(parser)
+
+  if args.action == 'record':
+    corpus = get_corpus(mc_seeds = args.mc_seeds, include_spreadsheet = not args.no_spreadsheet)
+    record(args.golden_dir, corpus, engine = args.engine)
+  else:
+    tolerances = {}
+    for tolerance in args.tolerance:
+      var, rtol = tolerance.split('=')
+      tolerances[var] = float(rtol)
+
+    divergences = compare(args.golden_dir, engine = args.engine, tolerances = tolerances, default_rtol = args.rtol)
+    if not all(d.ok for d in divergences):
+      sys.exit(1)
@@ -5,31 +5,194 @@ Monte carlo analysis.
 from . import log
 from . import *
 
+import re
 import json
+import tempfile
 import dill as pickle
+import time
 import traceback
+from multiprocessing import Pool
 import seaborn as sns
 import colorsys
 import matplotlib.colors as mc
 from matplotlib.ticker import StrMethodFormatter
-from scipy.stats import rv_continuous, gaussian_kde
+from scipy.stats import rv_continuous, gaussian_kde, norm
 from scipy.interpolate import interp1d
 from scipy.special import erfinv
 from numpy.random import default_rng
 from matplotlib import cm
 from xml.etree import ElementTree as et
 from ..core.utils import get_param_names, get_metric_names, get_most_important_metrics, pluralize
+from ..core.perf import PerfCounters
 from ..stats.distributions import *
+from ..stats.sketches import TrajectoryQuantileSketch
+from .work_queue import WorkQueue, run_worker
 from statsmodels.distributions.empirical_distribution import ECDF
+from statsmodels.discrete.discrete_model import Logit
 
 rng = default_rng()
 
 class McAnalysisResults:
-  pass
+  """ Results of mc_analysis.
+
+      save() stores them in a directory: the scalars and the small tables go to a JSON manifest,
+      and each array to its own .npy file. load() memory-maps the arrays, so reading the results
+      (eg, to regenerate the report) only touches the columns that are actually used.
+  """
+
+  manifest_file = 'manifest.json'
+  format_version = 1
+
+  # Attributes stored as they are in the manifest
+  manifest_attributes = [
+    'quantiles', 'metrics_quantiles', 'n_trials', 'n_finished_trials', 't_step', 't_start', 't_end',
+    'slow_takeoff_count', 'aggressive', 'seed', 'checkpoint_dir', 'adaptive', 'stopped_early', 'qmc', 'stratify_reqs', 'paired',
+    'antithetic',
+  ]
+
+  array_attributes = ['timesteps', 'last_valid_indices', 'doubling_indices']
+  table_attributes = ['parameter_table', 'rank_correlations', 'ajeya_cdf', 'failures']
+  unindexed_tables = ['ajeya_cdf', 'failures']
+
+  def save(self, path):
+    os.makedirs(os.path.join(path, 'scalar_metrics'), exist_ok = True)
+    os.makedirs(os.path.join(path, 'state_metrics'), exist_ok = True)
+
+    manifest = {'format_version': McAnalysisResults.format_version}
+    for attr in McAnalysisResults.manifest_attributes:
+      manifest[attr] = getattr(self, attr, None)
+
+    for attr in McAnalysisResults.array_attributes:
+      np.save(os.path.join(path, f'{attr}.npy'), np.asarray(getattr(self, attr)))
+
+    manifest['scalar_metrics'] = list(self.scalar_metrics)
+    for metric, values in self.scalar_metrics.items():
+      np.save(os.path.join(path, 'scalar_metrics', f'{metric}.npy'), np.asarray(values, dtype = np.float64))
+
+    # The trajectories are stored up to t_end (padded with NaNs), as a (n_trials, n_timesteps) array
+    manifest['state_metrics'] = {}
+    n_timesteps = len(self.timesteps)
+    for metric, values in self.state_metrics.items():
+      if isinstance(values, TrajectoryQuantileSketch):
+        settings, arrays = values.to_arrays()
+        np.savez(os.path.join(path, 'state_metrics', f'{metric}.npz'), **arrays)
+        manifest['state_metrics'][metric] = {'sketch': settings}
+      else:
+        trajectories = np.full((len(values), n_timesteps), np.nan)
+        for i, trajectory in enumerate(values):
+          trajectory = np.asarray(trajectory)[:n_timesteps]
+          trajectories[i, :len(trajectory)] = trajectory
+        np.save(os.path.join(path, 'state_metrics', f'{metric}.npy'), trajectories)
+        manifest['state_metrics'][metric] = {}
+
+    manifest['param_columns'] = list(self.param_samples.columns)
+    np.save(os.path.join(path, 'param_samples.npy'), self.param_samples.to_numpy(dtype = np.float64))
+
+    manifest['tables'] = []
+    for attr in McAnalysisResults.table_attributes:
+      table = getattr(self, attr, None)
+      if table is not None:
+        table.to_csv(os.path.join(path, f'{attr}.csv'), index = (attr not in McAnalysisResults.unindexed_tables))
+        manifest['tables'].append(attr)
+
+    manifest['metrics_before_full_automation_quantiles'] = [
+      [metric.name, table] for metric, table in self.metrics_before_full_automation_quantiles.items()
+    ]
+
+    precision = getattr(self, 'precision', None)
+    if precision is not None:
+      precision = {**precision, 'quantiles': [[metric, q, width] for (metric, q), width in precision['quantiles'].items()]}
+    manifest['precision'] = precision
+
+    perf = getattr(self, 'perf', None)
+    manifest['perf'] = perf.to_dict() if perf is not None else None
+
+    # Last, so that an interrupted save doesn't leave a store that looks complete
+    with open(os.path.join(path, McAnalysisResults.manifest_file), 'w') as f:
+      json.dump(manifest, f, cls = NumpyJSONEncoder)
+
+  @staticmethod
+  def load(path):
+    with open(os.path.join(path, McAnalysisResults.manifest_file), 'r') as f:
+      manifest = json.load(f)
+
+    if manifest['format_version'] != McAnalysisResults.format_version:
+      raise ValueError(f'Unsupported format version of the MC results in {path}: {manifest["format_version"]}')
+
+    results = McAnalysisResults()
+    for attr in McAnalysisResults.manifest_attributes:
+      setattr(results, attr, manifest.get(attr))
+
+    def load_array(*parts):
+      return np.load(os.path.join(path, *parts), mmap_mode = 'r')
+
+    for attr in McAnalysisResults.array_attributes:
+      setattr(results, attr, load_array(f'{attr}.npy'))
+
+    results.scalar_metrics = {metric: load_array('scalar_metrics', f'{metric}.npy') for metric in manifest['scalar_metrics']}
+
+    results.state_metrics = {}
+    for metric, info in manifest['state_metrics'].items():
+      if 'sketch' in info:
+        with np.load(os.path.join(path, 'state_metrics', f'{metric}.npz')) as arrays:
+          results.state_metrics[metric] = TrajectoryQuantileSketch.from_arrays(info['sketch'], dict(arrays))
+      else:
+        results.state_metrics[metric] = load_array('state_metrics', f'{metric}.npy')
+
+    results.param_samples = pd.DataFrame(load_array('param_samples.npy'), columns = manifest['param_columns'], copy = False)
+
+    for attr in McAnalysisResults.table_attributes:
+      table = None
+      if attr in manifest['tables']:
+        table = pd.read_csv(os.path.join(path, f'{attr}.csv'), index_col = (None if attr in McAnalysisResults.unindexed_tables else 0))
+      setattr(results, attr, table)
+
+    metrics = {metric.name: metric for metric in get_metrics_before_full_automation()}
+    results.metrics_before_full_automation_quantiles = {
+      metrics[name]: table for name, table in manifest['metrics_before_full_automation_quantiles']
+    }
+
+    results.precision = manifest['precision']
+    if results.precision is not None:
+      results.precision['quantiles'] = {(metric, q): width for metric, q, width in results.precision['quantiles']}
+
+    results.perf = PerfCounters.from_dict(manifest['perf']) if manifest['perf'] is not None else None
+
+    return results
+
+def read_mc_analysis_results(path):
+  """ Reads the results stored with McAnalysisResults.save (or pickled, by previous versions) """
+  if os.path.isdir(path):
+    return McAnalysisResults.load(path)
+  with open(path, 'rb') as f:
+    return pickle.load(f)
 
 class TooManyRetries(Exception):
   pass
 
+class PrescreenedSample(Exception):
+  """ The failure classifier predicted that the simulation of the sample would fail (see FailureClassifier) """
+  pass
+
+def interpolate(x, xp, fp, logarithmic = False):
+  """ Linear interpolation of (xp, fp) at the points x, extrapolating linearly beyond the ends
+      (like interp1d(xp, fp, fill_value = 'extrapolate')). If `logarithmic`, the interpolation is done on
+      log10(fp) (and the result is left in log10). xp must be increasing.
+  """
+  x = np.asarray(x, dtype = np.float64)
+  xp = np.asarray(xp)
+
+  # Segment of each point (the first and last ones for the points outside)
+  i = np.clip(np.searchsorted(xp, x), 1, len(xp) - 1)
+
+  x_lo, x_hi = xp[i-1], xp[i]
+  y_lo, y_hi = np.asarray(fp, dtype = np.float64)[i-1], np.asarray(fp, dtype = np.float64)[i]
+  if logarithmic:
+    y_lo, y_hi = np.log10(y_lo), np.log10(y_hi)
+
+  slope = (y_hi - y_lo) / (x_hi - x_lo)
+  return slope * (x - x_lo) + y_lo
+
 class YearsBeforeAgiMetric:
   """ Metrics for the "years before full automation" quantiles table """
 
@@ -42,28 +205,20 @@ class YearsBeforeAgiMetric:
     self.nan_remarks = nan_remarks
 
   def get_value_at_year(self, year, model, no_automation_model):
-    ts, values = self.get_values(model)
-    no_auto_ts, no_auto_vals = self.get_values(no_automation_model)
-
-    interpolator = interp1d(
-      ts,
-      values if (self.interpolation == 'linear') else np.log10(values),
-      fill_value = 'extrapolate'
-    )
+    """ `year` can be an array of years (the values are computed in one go) """
+    year = np.asarray(year, dtype = np.float64)
+    logarithmic = (self.interpolation == 'log')
 
-    no_auto_interpolator = interp1d(
-      no_auto_ts,
-      no_auto_vals if (self.interpolation == 'linear') else np.log10(no_auto_vals),
-      fill_value = 'extrapolate'
-    )
+    ts, values = self.get_values(model)
+    value = interpolate(year, ts, values, logarithmic = logarithmic)
 
-    if year < model.t_start:
-      # Extrapolate
-      value = no_auto_interpolator(year)
-    else:
-      value = interpolator(year)
+    # Extrapolate before t_start using the no-automation counterfactual
+    before_start = (year < model.t_start)
+    if np.any(before_start):
+      no_auto_ts, no_auto_vals = self.get_values(no_automation_model)
+      value = np.where(before_start, interpolate(year, no_auto_ts, no_auto_vals, logarithmic = logarithmic), value)
 
-    if self.interpolation == 'log': value = 10**value
+    if logarithmic: value = 10**value
 
     return value
 
@@ -75,38 +230,33 @@ class DoublingYearsBeforeFullAutomationMetric(YearsBeforeAgiMetric):
     self.nan_remarks = nan_remarks
 
   def get_value_at_year(self, year, normal_model, no_automation_model):
-    model = no_automation_model if (year < normal_model.t_start) else normal_model
-
-    ts = model.timesteps
-    vals = getattr(model, self.attr)
-    interpolator = interp1d(ts, np.log10(vals), fill_value = 'extrapolate')
-
-    denominator = np.log2(10**interpolator(year+1)/10**interpolator(year))
-    doubling_time = 1/denominator if (denominator != 0) else 1e10
+    """ `year` can be an array of years (the values are computed in one go) """
+    year = np.asarray(year, dtype = np.float64)
 
-    return doubling_time
-
-def mc_analysis(n_trials = 100, max_retries = 100, aggressive = False):
-  scalar_metrics = {}
+    def get_log_values(model, x):
+      return interpolate(x, model.timesteps, getattr(model, self.attr), logarithmic = True)
 
-  for metric in SimulateTakeOff.timeline_metrics:
-    scalar_metrics[metric] = []
+    log_now  = get_log_values(normal_model, year)
+    log_next = get_log_values(normal_model, year+1)
 
-  for metric in SimulateTakeOff.takeoff_metrics:
-    scalar_metrics[metric] = []
+    before_start = (year < normal_model.t_start)
+    if np.any(before_start):
+      log_now  = np.where(before_start, get_log_values(no_automation_model, year), log_now)
+      log_next = np.where(before_start, get_log_values(no_automation_model, year+1), log_next)
 
-  state_metrics = {
-      metric : [] for metric in ['biggest_training_run', 'gwp']
-  }
+    with np.errstate(divide = 'ignore'):
+      denominator = np.log2(10**log_next/10**log_now)
+      doubling_time = np.where(denominator != 0, 1/denominator, 1e10)
 
-  # Metrics for the "years before full economic automation" tables
+    return doubling_time
 
-  years_before_full_automation = [0, 1, 2, 5, 10]
-  metrics_before_full_automation = []
+def get_metrics_before_full_automation():
+  """ Metrics of the "years before full economic automation" tables """
+  metrics = []
 
   # Doubling times metrics
   def add_doubling_time_metric(metric, nan_remarks = None):
-    metrics_before_full_automation.append(DoublingYearsBeforeFullAutomationMetric(metric, nan_remarks))
+    metrics.append(DoublingYearsBeforeFullAutomationMetric(metric, nan_remarks))
 
   add_doubling_time_metric('gwp')
   add_doubling_time_metric('hardware_performance')
@@ -114,7 +264,7 @@ def mc_analysis(n_trials = 100, max_retries = 100, aggressive = False):
 
   # Rest of the metrics
   def add_model_var_metric(var, format_quantile):
-    metrics_before_full_automation.append(
+    metrics.append(
       YearsBeforeAgiMetric(
         f'{var}',
         lambda model, _var=var: (model.timesteps, getattr(model, _var)),
@@ -126,69 +276,436 @@ def mc_analysis(n_trials = 100, max_retries = 100, aggressive = False):
   add_model_var_metric('frac_compute_training', format_quantile = lambda x: f'{x:.2%}')
   add_model_var_metric('frac_gwp_compute', format_quantile = lambda x: f'{x:.2%}')
 
-  metrics_before_full_automation_values = {
-      metric: {year: [] for year in years_before_full_automation} for metric in metrics_before_full_automation
-  }
+  return metrics
+
+# Arrays of the trial results needed by the analysis
+TRIAL_ARRAYS = ['timesteps', 'gwp', 'biggest_training_run', 'hardware_performance', 'software', 'frac_compute_training', 'frac_gwp_compute']
+
+# Spawn keys of the seeds of the quasi-Monte Carlo sequence and of the strata (far from the ones of the trials)
+QMC_SPAWN_KEY    = 2**32
+STRATA_SPAWN_KEY = 2**32 + 1
+
+class FailureClassifier:
+  """ Logistic model of the probability that the simulation of a parameter sample fails.
+
+      The features are the (empirical) copula uniforms of the parameters, ie, their ranks
+      among the samples the classifier was fitted on.
+  """
+
+  def __init__(self, reference_values, coefficients, intercept):
+    self.reference_values = reference_values # param -> sorted values
+    self.coefficients = coefficients         # param -> coefficient
+    self.intercept = intercept
+
+  def get_uniforms(self, samples):
+    return np.column_stack([
+      (np.searchsorted(values, np.asarray(samples[param]), side = 'right') - 0.5) / len(values)
+      for param, values in self.reference_values.items()
+    ])
+
+  def get_failure_probability(self, samples):
+    x = self.get_uniforms(samples) @ np.array(list(self.coefficients.values())) + self.intercept
+    return 1/(1 + np.exp(-x))
+
+  @staticmethod
+  def fit(param_samples, failures, alpha = 1.0):
+    """ Fits the classifier to the successful samples and the failed ones (see McAnalysisResults.failures).
+        Returns None if there are no failures to learn from.
+    """
+    failures = failures[failures['exception'] != PrescreenedSample.__name__]
+    failed_samples = failures[[param for param in param_samples.columns if param in failures]].dropna()
+    if len(failed_samples) == 0:
+      return None
+
+    samples = pd.concat([param_samples, failed_samples], ignore_index = True)
+    failed = np.concatenate([np.zeros(len(param_samples)), np.ones(len(failed_samples))])
+
+    # Constant parameters don't tell anything
+    params = [param for param in failed_samples.columns if samples[param].nunique() > 1]
+    reference_values = {param: np.sort(samples[param].to_numpy()) for param in params}
+
+    classifier = FailureClassifier(reference_values, {param: 0 for param in params}, 0)
+    x = np.column_stack([np.ones(len(samples)), classifier.get_uniforms(samples)])
+
+    # (L1 regularized, so that perfectly separable failures don't blow the coefficients up)
+    fit = Logit(failed, x).fit_regularized(method = 'l1', alpha = alpha, disp = 0)
+    classifier.intercept = fit.params[0]
+    classifier.coefficients = dict(zip(params, fit.params[1:]))
+    return classifier
+
+_trial_params_dists = None
+_trial_settings = None
+
+def init_trial_worker(params_dists, settings):
+  """ `params_dists` are the parameter distributions of the analyses run together (see mc_analysis) """
+  global _trial_params_dists, _trial_settings
+  _trial_params_dists = params_dists
+  _trial_settings = settings
+
+def run_trial(args, params_dist = None):
+  """ Samples the parameters and runs the simulations of a single MC trial.
+      Returns the sample, the result of the simulation, the result of the
+      no-automation simulation (or None if there was no full automation)
+      and the list of failed attempts.
+
+      If there is a failure classifier in the settings, the samples whose predicted
+      probability of failure is over the prescreening threshold are discarded without
+      simulating them (and recorded as failures).
+  """
+  trial, seed, point, reqs_quantile = args
+
+  if params_dist is None: params_dist = _trial_params_dists[0]
+  t_start     = _trial_settings['t_start']
+  t_end       = _trial_settings['t_end']
+  t_step      = _trial_settings['t_step']
+  n_trials    = _trial_settings['n_trials']
+  max_retries = _trial_settings['max_retries']
+  failure_classifier  = _trial_settings.get('failure_classifier')
+  prescreen_threshold = _trial_settings.get('prescreen_threshold')
+
+  rng = default_rng(seed)
+
+  def get_stratified_point(point):
+    # Stratified training requirements (the rest of the parameters are drawn conditional on them)
+    point = np.array(point if (point is not None) else rng.random(len(params_dist.marginals)))
+    point[params_dist.joint_dist.dimension_names['full_automation_requirements_training']] = reqs_quantile
+    return point
+
+  # With quasi-Monte Carlo, the first candidate sample of the trial comes from its point of the
+  # low-discrepancy sequence (and the rest, if it is rejected, from the random generator)
+  if reqs_quantile is not None:
+    point = get_stratified_point(point)
+
+  if _trial_settings.get('antithetic'):
+    # Both trials of an antithetic pair read the same uniforms, the second one mirrored (see mc_analysis)
+    random_state = PresetPoints(point if (point is not None) else np.empty((0, len(params_dist.marginals))), rng)
+    if trial % 2 == 1: random_state = MirroredPoints(random_state)
+  else:
+    random_state = PresetPoints(point, rng) if (point is not None) else rng
 
-  slow_takeoff_count = 0
+  failures = []
 
-  parameter_table = get_parameter_table(tradeoff_enabled=True)
-  parameter_table = parameter_table[['Conservative', 'Best guess', 'Aggressive', 'Type']]
+  for i in range(max_retries):
+    sample = None
+    model = None
+    start_time = time.perf_counter()
 
-  params_dist = TakeoffParamsDist(
-      parameter_table=parameter_table,
-      max_frac_automatable_tasks_goods=0,
-      max_frac_automatable_tasks_rnd=0.05,
-      resampling_method='all_but_training_requirements',
-      aggressive=aggressive,
-  )
-  samples = []
+    if reqs_quantile is not None and i > 0:
+      # The retries stay in the stratum of the trial (with new random values for the rest of the parameters)
+      random_state = PresetPoints(get_stratified_point(None), rng)
 
-  last_valid_indices = []
+    # Try to run the simulation
+    try:
+      log.info(f'Running simulation {trial+1}/{n_trials}...')
+      log.indent()
 
-  t_start = get_option('t_start', 2022)
-  t_end   = get_option('t_end',   2100)
-  t_step  = get_option('t_step',  0.1)
-  timesteps = np.arange(t_start, t_end, t_step)
+      sample = params_dist.rvs(1, random_state = random_state)
 
-  log.info(f'Running simulations...')
-  log.indent()
-  for trial in range(n_trials):
-    for i in range(max_retries):
-      # Try to run the simulation
-      try:
-        log.info(f'Running simulation {trial+1}/{n_trials}...')
-        log.indent()
+      if failure_classifier is not None and failure_classifier.get_failure_probability(sample)[0] > prescreen_threshold:
+        raise PrescreenedSample(f'Predicted probability of failure over {prescreen_threshold}')
 
-        sample = params_dist.rvs(1)
+      mc_params = {param: sample[param][0] for param in sample}
 
-        mc_params = {param: sample[param][0] for param in sample}
+      model = SimulateTakeOff(**mc_params, t_start = t_start, t_end_min = t_end, t_step = t_step, compute_shares = False)
 
-        model = SimulateTakeOff(**mc_params, t_start = t_start, t_end_min = t_end, compute_shares = False)
+      model.run_simulation()
+    except Exception as e:
+      # This was a bad sample. We'll just discard it and try again.
+      failures.append({
+        'trial': trial,
+        'exception': type(e).__name__,
+        't_idx': model.t_idx if model is not None else None,
+        'time': time.perf_counter() - start_time,
+        **({param: sample[param][0] for param in sample} if sample is not None else {}),
+      })
 
-        model.run_simulation()
-      except Exception as e:
-        # This was a bad sample. We'll just discard it and try again.
-        log.indent()
+      log.indent()
+      if isinstance(e, PrescreenedSample):
+        log.info(f'Prescreened sample: {e}')
+      else:
         log.info('The model threw an exception:')
         log.indent()
         log.info(e)
         log.info(traceback.format_exc(), end = '')
         log.deindent()
-        log.info('Discarding the sample and rerunning the simulation')
-        log.deindent()
-        continue
-
+      log.info('Discarding the sample and rerunning the simulation')
       log.deindent()
+      log.deindent()
+      continue
 
-      # This was a good sample
-      samples.append(sample)
-      break
-    else:
-      raise TooManyRetries('MC sampling: Maximum number of retries reached')
+    log.deindent()
+
+    # This was a good sample
+    break
+  else:
+    raise TooManyRetries('MC sampling: Maximum number of retries reached')
+
+  no_automation_result = None
+  if not np.isnan(model.timeline_metrics['automation_gns_100%']):
+    # The counterfactual is only used to extrapolate the metrics before t_start (see YearsBeforeAgiMetric),
+    # which reads its values up to a year after t_start
+    no_automation_model = model.get_no_automation_counterfactual(t_end = t_start + 1 + t_step/2)
+    no_automation_model.run_simulation()
+
+    assert(np.all(no_automation_model.frac_tasks_automated_goods < 1) and np.all(no_automation_model.frac_tasks_automated_rnd < 1))
+
+    no_automation_result = no_automation_model.get_result(arrays = TRIAL_ARRAYS)
+
+  return sample, model.get_result(arrays = TRIAL_ARRAYS), no_automation_result, failures
+
+def run_trial_batch(queue_dir, trials):
+  """ Task of the work queue of a distributed analysis (see mc_analysis): runs the `trials` (arguments of run_trial)
+      and stores them in the checkpoint in `queue_dir`
+  """
+  params_dists, trial_settings, paired = WorkQueue.get_context(queue_dir, 'mc_analysis')
+  init_trial_worker(params_dists, trial_settings)
+  trial_function = run_paired_trial if paired else run_trial
+  McCheckpoint(queue_dir).write_chunk(trials[0][0], [trial_function(args) for args in trials])
+
+def run_paired_trial(args):
+  """ Runs the trial once per parameter distribution. All of them start from the same random stream, so the
+      samples share their random numbers (common random numbers): the training requirements are at the same
+      quantile of each admissible marginal, and the rest of the parameters come from the same copula draws.
+  """
+  return tuple(run_trial(args, params_dist) for params_dist in _trial_params_dists)
+
+class McCheckpoint:
+  """ On-disk store of completed MC trials, so that runs can be resumed (or extended).
+
+      Trials are appended in order, in chunks (`trials_<first>_<last>.pkl`), next
+      to a manifest with the seed and the settings of the run. Each trial is
+      stored as the output of `run_trial` (the parameter sample and the results
+      of the simulations, with the arrays in TRIAL_ARRAYS).
+  """
+
+  manifest_file = 'manifest.json'
+
+  def __init__(self, checkpoint_dir, chunk_size = 100):
+    self.checkpoint_dir = checkpoint_dir
+    self.chunk_size = chunk_size
+    self.pending = []
+    self.pending_first_trial = None
+
+  def get_chunks(self):
+    """ Returns the list of (first trial, last trial, path) of the stored chunks, in order """
+    chunks = []
+    if os.path.isdir(self.checkpoint_dir):
+      for file in os.listdir(self.checkpoint_dir):
+        m = re.match(r'trials_([0-9]+)_([0-9]+)\.pkl$', file)
+        if m:
+          chunks.append((int(m.group(1)), int(m.group(2)), os.path.join(self.checkpoint_dir, file)))
+    chunks.sort()
+    return chunks
+
+  def get_completed_trials(self):
+    """ Number of trials stored (they always are the first ones) """
+    completed = 0
+    for first, last, path in self.get_chunks():
+      if first != completed:
+        raise ValueError(f'Missing trials {completed}-{first - 1} in the checkpoint {self.checkpoint_dir}')
+      completed = last + 1
+    return completed
+
+  def read_manifest(self):
+    path = os.path.join(self.checkpoint_dir, McCheckpoint.manifest_file)
+    if not os.path.exists(path):
+      return None
+    with open(path, 'r') as f:
+      return json.load(f)
+
+  def write_manifest(self, manifest):
+    os.makedirs(self.checkpoint_dir, exist_ok = True)
+    self._write_atomically(os.path.join(self.checkpoint_dir, McCheckpoint.manifest_file), json.dumps(manifest, indent = 2).encode('utf-8'))
+
+  def iterate(self, n_trials):
+    """ Yields the first `n_trials` stored trials, reading one chunk at a time """
+    for first, last, path in self.get_chunks():
+      if first >= n_trials:
+        break
+      with open(path, 'rb') as f:
+        trials = pickle.load(f)
+      yield from trials[:n_trials - first]
+
+  def append(self, trial, trial_output):
+    if self.pending_first_trial is None:
+      self.pending_first_trial = trial
+    self.pending.append(trial_output)
+    if len(self.pending) >= self.chunk_size:
+      self.flush()
+
+  def flush(self):
+    if not self.pending:
+      return
+
+    self.write_chunk(self.pending_first_trial, self.pending)
+
+    self.pending = []
+    self.pending_first_trial = None
+
+  def write_chunk(self, first, trial_outputs):
+    """ Stores the outputs of the trials `first`, `first + 1`, ... """
+    last = first + len(trial_outputs) - 1
+    path = os.path.join(self.checkpoint_dir, f'trials_{first:08d}_{last:08d}.pkl')
+    self._write_atomically(path, pickle.dumps(trial_outputs))
+
+  def _write_atomically(self, path, data):
+    fd, tmp_path = tempfile.mkstemp(dir = self.checkpoint_dir, suffix = '.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+      os.replace(tmp_path, path)
+    except BaseException:
+      if os.path.exists(tmp_path): os.remove(tmp_path)
+      raise
+
+# Metrics whose quantiles are tracked to decide when to stop (in adaptive mode)
+ADAPTIVE_TRACKED_METRICS = ['automation_gns_100%', 'full_automation_gns']
+
+def get_trial_units(n_trials, antithetic = False):
+  """ Independent units of the trials: each trial on its own, or the antithetic pairs (see mc_analysis) """
+  return np.arange(n_trials) // 2 if antithetic else np.arange(n_trials)
+
+def get_ratio_variance(numerators, denominators, units):
+  """ Variance of sum(numerators)/sum(denominators) (linearized), where the trials of the same unit (eg, the
+      two trials of an antithetic pair) can be correlated, but the units are independent of each other
+  """
+  numerators = np.asarray(numerators, dtype = np.float64)
+  denominators = np.asarray(denominators, dtype = np.float64)
+  _, units = np.unique(units, return_inverse = True)
+  n_units = np.max(units) + 1 if len(units) > 0 else 0
+
+  total = np.sum(denominators)
+  if n_units < 2 or total == 0:
+    return np.inf
+
+  ratio = np.sum(numerators) / total
+  residuals = np.bincount(units, weights = numerators - ratio * denominators, minlength = n_units)
+  return np.sum(residuals**2) / total**2 * n_units / (n_units - 1)
+
+def get_quantile_ci(values, q, confidence = 0.95, units = None):
+  """ Distribution-free confidence interval for the quantile `q`, based on order statistics.
+      With `units` (see get_trial_units), the width comes from the variance of the share of values
+      under the quantile over the units, instead of from the binomial one.
+  """
+  values = np.asarray(values, dtype = np.float64)
+  if units is not None: units = np.asarray(units)[~np.isnan(values)]
+  values = filter_nans(values)
+  n = len(values)
+
+  z = norm.ppf(0.5 + confidence/2)
+  if units is None:
+    half_width = z * np.sqrt(n * q * (1 - q))
+  else:
+    below = values <= np.quantile(values, q) if n > 0 else values
+    half_width = z * n * np.sqrt(get_ratio_variance(below, np.ones(n), units))
+  values = np.sort(values)
+  low  = int(np.floor(n * q - half_width))
+  high = int(np.ceil(n * q + half_width))
+
+  if low < 0 or high >= n:
+    # Not enough samples
+    return (-np.inf, np.inf)
+
+  return (values[low], values[high])
+
+def get_proportion_ci(successes, n, confidence = 0.95, variance = None):
+  """ Normal approximation to the confidence interval of a binomial proportion
+      (or of a proportion with the given `variance`, see get_ratio_variance)
+  """
+  if n == 0:
+    return (-np.inf, np.inf)
+
+  p = min(1, successes/n)
+  z = norm.ppf(0.5 + confidence/2)
+  half_width = z * np.sqrt(p * (1 - p) / n if variance is None else variance)
+  return (p - half_width, p + half_width)
+
+def get_mc_precision(scalar_metrics, slow_takeoff_count, t_end, quantiles, tracked_metrics = ADAPTIVE_TRACKED_METRICS, confidence = 0.95,
+    slow_takeoffs = None, units = None):
+  """ Widths of the confidence intervals of the quantiles of the tracked metrics
+      and of the probability of slow takeoff. With `units` (see get_trial_units), the
+      correlated trials are treated as a unit (this also needs the per-trial `slow_takeoffs`).
+  """
+  precision = {'quantiles': {}, 'slow_takeoff_probability': None, 'confidence': confidence}
+
+  for metric in tracked_metrics:
+    for q in quantiles:
+      low, high = get_quantile_ci(scalar_metrics[metric], q, confidence, units)
+      precision['quantiles'][(metric, q)] = high - low
+
+  finished = np.asarray(scalar_metrics['automation_gns_100%']) < t_end
+  n_finished_trials = np.sum(finished)
+  variance = None if units is None else get_ratio_variance(slow_takeoffs, finished, units)
+  low, high = get_proportion_ci(slow_takeoff_count, n_finished_trials, confidence, variance)
+  precision['slow_takeoff_probability'] = high - low
+
+  return precision
+
+def precision_is_reached(precision, quantile_ci_width, probability_ci_width):
+  return max(precision['quantiles'].values()) <= quantile_ci_width and precision['slow_takeoff_probability'] <= probability_ci_width
+
+class McResultsCollector:
+  """ Accumulates the trials of one MC analysis and summarizes them (see mc_analysis) """
+
+  years_before_full_automation = [0, 1, 2, 5, 10]
+  quantiles = [0.01, 0.1, 0.2, 0.5, 0.8, 0.9, 0.99]
+
+  def __init__(self, params_dist, aggressive, timesteps, t_step, t_end, stream_trajectories = False, profile = False, antithetic = False):
+    self.params_dist = params_dist
+    self.aggressive = aggressive
+    self.antithetic = antithetic
+    self.timesteps = timesteps
+    self.t_step = t_step
+    self.t_end = t_end
+    self.stream_trajectories = stream_trajectories
+
+    self.scalar_metrics = {}
+
+    for metric in SimulateTakeOff.timeline_metrics:
+      self.scalar_metrics[metric] = []
+
+    for metric in SimulateTakeOff.takeoff_metrics:
+      self.scalar_metrics[metric] = []
+
+    self.state_metrics = {
+        metric : [] for metric in ['biggest_training_run', 'gwp']
+    }
+
+    if stream_trajectories:
+      # Keep per-timestep quantile sketches instead of every trajectory (memory doesn't grow with n_trials)
+      self.state_metrics = {metric: TrajectoryQuantileSketch(len(timesteps)) for metric in self.state_metrics}
+
+    # Metrics for the "years before full economic automation" tables
+    self.metrics_before_full_automation = get_metrics_before_full_automation()
+
+    self.metrics_before_full_automation_values = {
+        metric: {year: [] for year in self.years_before_full_automation} for metric in self.metrics_before_full_automation
+    }
+
+    self.slow_takeoff_count = 0
+    self.slow_takeoffs = []
+    self.samples = []
+    self.last_valid_indices = []
+
+    # Failed attempts (see run_trial)
+    self.failures = []
+
+    # Start of the first n year doubling of GWP of each trial (for the takeoff probability table)
+    self.doubling_indices = []
+
+    # Aggregated profiling counters (if profiling is enabled)
+    self.perf = PerfCounters() if profile else None
+
+  def add(self, sample, model, no_automation_model, failures = ()):
+    self.samples.append(sample)
+    self.failures.extend(failures)
+
+    if self.perf is not None:
+      self.perf.merge(model.perf)
+      if no_automation_model is not None: self.perf.merge(no_automation_model.perf)
 
     # Collect results
-    for scalar_metric in scalar_metrics:
+    for scalar_metric in self.scalar_metrics:
       if scalar_metric in SimulateTakeOff.timeline_metrics:
         metric_value = model.timeline_metrics[scalar_metric]
       elif scalar_metric in SimulateTakeOff.takeoff_metrics:
@@ -201,95 +718,403 @@ def mc_analysis(n_trials = 100, max_retries = 100, aggressive = False):
       if scalar_metric in SimulateTakeOff.timeline_metrics and np.isnan(metric_value):
         metric_value = model.t_end
 
-      scalar_metrics[scalar_metric].append(metric_value)
+      self.scalar_metrics[scalar_metric].append(metric_value)
 
-    for state_metric in state_metrics:
+    for state_metric in self.state_metrics:
       metric_value = getattr(model, state_metric)
       assert metric_value.shape == (model.n_timesteps,)
-      state_metrics[state_metric].append(metric_value)
+      if self.stream_trajectories:
+        self.state_metrics[state_metric].add(metric_value)
+      else:
+        self.state_metrics[state_metric].append(metric_value)
 
-    if not np.isnan(model.timeline_metrics['automation_gns_100%']):
-      no_automation_mc_params = mc_params.copy()
-      no_automation_mc_params['full_automation_requirements_training'] = 1e100
-      no_automation_mc_params['flop_gap_training'] = 2
-      no_automation_model = SimulateTakeOff(**no_automation_mc_params, t_start = t_start, t_end = t_start + (2 + t_step))
-      no_automation_model.run_simulation()
+    self.doubling_indices.append(get_doubling_indices(model.gwp[:model.t_idx], self.t_step))
 
-      assert(np.all(no_automation_model.frac_tasks_automated_goods < 1) and np.all(no_automation_model.frac_tasks_automated_rnd < 1))
+    if no_automation_model is not None:
+      years = model.timeline_metrics['automation_gns_100%'] - np.array(self.years_before_full_automation)
+      for metric in self.metrics_before_full_automation:
+        values = metric.get_value_at_year(years, model, no_automation_model)
+        for year, value in zip(self.years_before_full_automation, values):
+          self.metrics_before_full_automation_values[metric][year].append(value)
 
-      for metric in metrics_before_full_automation:
-        for year, year_values in metrics_before_full_automation_values[metric].items():
-          value = metric.get_value_at_year(model.timeline_metrics['automation_gns_100%'] - year, model, no_automation_model)
-          year_values.append(value)
+    self.last_valid_indices.append(model.t_idx)
 
-    last_valid_indices.append(model.t_idx)
+    self.slow_takeoffs.append(is_slow_takeoff(model, self.doubling_indices[-1]))
+    if self.slow_takeoffs[-1]:
+      self.slow_takeoff_count += 1
 
-    if is_slow_takeoff(model):
-      slow_takeoff_count += 1
+  def get_precision(self):
+    units = get_trial_units(len(self.samples), antithetic = True) if self.antithetic else None
+    return get_mc_precision(self.scalar_metrics, self.slow_takeoff_count, self.t_end, self.quantiles, slow_takeoffs = self.slow_takeoffs, units = units)
 
-  log.deindent()
+  def get_results(self):
+    quantiles = self.quantiles
+    t_end = self.t_end
 
-  for name, value in scalar_metrics.items():
-    scalar_metrics[name] = np.array(value)
+    scalar_metrics = {name: np.array(value) for name, value in self.scalar_metrics.items()}
 
-  ## Summaries
-  quantiles = [0.01, 0.1, 0.2, 0.5, 0.8, 0.9, 0.99]
+    ## Summaries
 
-  # Summary of scalar metrics
-  metrics_quantiles = []
-  for q in quantiles:
-    row = {"Quantile" : q}
+    # Summary of scalar metrics
+    metrics_quantiles = []
+    for q in quantiles:
+      row = {"Quantile" : q}
+      for scalar_metric in scalar_metrics:
+        value = np.quantile(filter_nans(scalar_metrics[scalar_metric]), q)
+        row[scalar_metric] = value if (value < t_end) else f'≥ {t_end}'
+      metrics_quantiles.append(row)
+
+    # Summary of the "years before full automation" quantiles
+    metrics_before_full_automation_quantiles = {}
+    for metric, metric_samples in self.metrics_before_full_automation_values.items():
+      table = []
+      for q in quantiles:
+        row = {"Percentile" : f'{q:.0%}'}
+        for year, values in metric_samples.items():
+          column_name = 'At time of full economic automation' if (year == 0) else f'{year} {pluralize("year", year)} before'
+          row[column_name] = np.quantile(values, q)
+        table.append(row)
+      metrics_before_full_automation_quantiles[metric] = table
+
+    ## Add mean
+    row = {"Quantile" : "mean"}
     for scalar_metric in scalar_metrics:
-      value = np.quantile(filter_nans(scalar_metrics[scalar_metric]), q)
-      row[scalar_metric] = value if (value < t_end) else f'≥ {t_end}'
+      row[scalar_metric] = np.mean(filter_nans(scalar_metrics[scalar_metric]))
     metrics_quantiles.append(row)
 
-  # Summary of the "years before full automation" quantiles
-  metrics_before_full_automation_quantiles = {}
-  import dill as pickle
-  with open('/home/edu/.tmp/trash/metrics.pickle', 'wb') as f:
-    pickle.dump(metrics_before_full_automation_values, f)
-  for metric, metric_samples in metrics_before_full_automation_values.items():
-    table = []
-    for q in quantiles:
-      row = {"Percentile" : f'{q:.0%}'}
-      for year, values in metric_samples.items():
-        column_name = 'At time of full economic automation' if (year == 0) else f'{year} {pluralize("year", year)} before'
-        row[column_name] = np.quantile(values, q)
-      table.append(row)
-    metrics_before_full_automation_quantiles[metric] = table
-
-  ## Add mean
-  row = {"Quantile" : "mean"}
-  for scalar_metric in scalar_metrics:
-    row[scalar_metric] = np.mean(filter_nans(scalar_metrics[scalar_metric]))
-  metrics_quantiles.append(row)
-
-  n_finished_trials = np.sum(scalar_metrics['automation_gns_100%'] < t_end)
-
-  results = McAnalysisResults()
-  results.quantiles                    = quantiles
-  results.metrics_quantiles            = metrics_quantiles
-  results.state_metrics                = state_metrics
-  results.scalar_metrics               = scalar_metrics
-  results.n_trials                     = n_trials
-  results.n_finished_trials            = n_finished_trials
-  results.timesteps                    = timesteps
-  results.t_step                       = t_step
-  results.t_start                      = t_start
-  results.t_end                        = t_end
-  results.param_samples                = pd.concat(samples, ignore_index = True)
-  results.parameter_table              = params_dist.parameter_table
-  results.rank_correlations            = params_dist.rank_correlations
-  results.slow_takeoff_count           = slow_takeoff_count
-  results.last_valid_indices           = last_valid_indices
-  results.aggressive                   = aggressive
-  results.metrics_before_full_automation_quantiles = metrics_before_full_automation_quantiles
-
-  reqs_marginal = params_dist.marginals['full_automation_requirements_training']
-  results.ajeya_cdf = reqs_marginal.cdf_pd
-
-  return results
+    n_finished_trials = np.sum(scalar_metrics['automation_gns_100%'] < t_end)
+
+    results = McAnalysisResults()
+    results.quantiles                    = quantiles
+    results.metrics_quantiles            = metrics_quantiles
+    results.state_metrics                = self.state_metrics
+    results.scalar_metrics               = scalar_metrics
+    results.n_trials                     = len(self.samples)
+    results.n_finished_trials            = n_finished_trials
+    results.timesteps                    = self.timesteps
+    results.t_step                       = self.t_step
+    results.t_end                        = t_end
+    results.param_samples                = pd.concat(self.samples, ignore_index = True)
+    results.parameter_table              = self.params_dist.parameter_table
+    results.rank_correlations            = self.params_dist.rank_correlations
+    results.slow_takeoff_count           = self.slow_takeoff_count
+    results.last_valid_indices           = self.last_valid_indices
+    results.aggressive                   = self.aggressive
+    results.metrics_before_full_automation_quantiles = metrics_before_full_automation_quantiles
+    results.perf                         = self.perf
+    results.doubling_indices             = np.array(self.doubling_indices, dtype = np.int64).reshape(-1, TAKEOFF_TABLE_SIZE)
+    results.precision                    = self.get_precision()
+    results.antithetic                   = self.antithetic
+    results.failures                     = pd.DataFrame(self.failures, columns = ['trial', 'exception', 't_idx', 'time'] + list(results.param_samples.columns))
+
+    reqs_marginal = self.params_dist.marginals['full_automation_requirements_training']
+    results.ajeya_cdf = reqs_marginal.cdf_pd
+
+    return results
+
+def get_mc_params_dist(aggressive = False, **kwargs):
+  """ Parameter distribution of the MC analysis (`kwargs` go to TakeoffParamsDist) """
+  return TakeoffParamsDist(
+    max_frac_automatable_tasks_goods=0,
+    max_frac_automatable_tasks_rnd=0.05,
+    resampling_method='all_but_training_requirements',
+    aggressive=aggressive,
+    **kwargs,
+  )
+
+def get_sampling_params_dist(results):
+  """ Parameter distribution the trials of the MC results were drawn from """
+  return get_mc_params_dist(
+    aggressive = bool(results.aggressive), parameter_table = results.parameter_table,
+    rank_correlations = results.rank_correlations, ajeya_cdf = results.ajeya_cdf,
+  )
+
+def mc_analysis(n_trials = 100, max_retries = 100, aggressive = False, workers = 1, seed = None, stream_trajectories = False,
+    checkpoint_dir = None, resume = False,
+    adaptive = False, batch_size = 200, quantile_ci_width = 1.0, probability_ci_width = 0.05,
+    qmc = None, stratify_reqs = False, paired = False, failure_classifier = None, prescreen_threshold = 0.9,
+    queue_dir = None, queue_batch_size = 100, t_step = None, antithetic = False):
+  """ In adaptive mode, `n_trials` is the maximum number of trials. The trials run in batches of
+      `batch_size`, and we stop once the 95% confidence intervals of the quantiles of the
+      ADAPTIVE_TRACKED_METRICS are narrower than `quantile_ci_width` (years) and the one of the
+      probability of slow takeoff is narrower than `probability_ci_width`.
+
+      `qmc` ('sobol' or 'halton') draws the parameters from a scrambled low-discrepancy sequence
+      instead of pseudo-random numbers.
+
+      `stratify_reqs` draws the training requirements with Latin hypercube sampling over the
+      admissible part of their distribution (one stratum per trial).
+
+      If `paired`, runs the normal and the aggressive analyses together (`aggressive` is ignored)
+      and returns both results. Each trial runs both with the same random numbers (see
+      run_paired_trial), so the differences between them are much less noisy.
+
+      The failed attempts of the trials are recorded in the `failures` of the results. With a
+      `failure_classifier` (see FailureClassifier.fit), the samples whose predicted probability
+      of failure is over `prescreen_threshold` are discarded before simulating them. This saves
+      time, but it can discard samples that wouldn't have failed (the prescreened samples are
+      recorded in the failures too).
+
+      With a `queue_dir` (in a shared filesystem), the trials are run in batches of `queue_batch_size` by the
+      workers of a work queue (see run_worker), on any number of machines. This process works on the queue
+      too, waits for the rest of the workers to finish and builds the results. The queue directory is also
+      the checkpoint of the analysis, so running the same command again resumes it.
+
+      `t_step` is the step of the simulations (by default, the t_step option).
+
+      If `antithetic`, the trials come in antithetic pairs: the second trial of each pair draws its parameters from
+      the mirror image (1 - u) of the uniforms of the first one, through the same marginals, copula and admissibility
+      resampling (see MirroredPoints). The estimators of the precision treat each pair as a unit.
+  """
+  if antithetic and stratify_reqs:
+    raise ValueError('The antithetic pairs and the stratified training requirements cannot be used together')
+
+  if queue_dir:
+    checkpoint_dir = queue_dir
+    resume = True
+
+    # A failed task leaves a gap in the checkpoint, so we raise its failure (with its traceback) before reading it
+    if os.path.exists(os.path.join(queue_dir, WorkQueue.db_file)):
+      queue = WorkQueue(queue_dir)
+      try:
+        queue.check_failures()
+      finally:
+        queue.close()
+
+  parameter_table = get_parameter_table(tradeoff_enabled=True)
+  parameter_table = parameter_table[['Conservative', 'Best guess', 'Aggressive', 'Type']]
+
+  studies = [False, True] if paired else [aggressive]
+
+  params_dists = [get_mc_params_dist(study_aggressive, parameter_table = parameter_table) for study_aggressive in studies]
+
+  t_start = get_option('t_start', 2022)
+  t_end   = get_option('t_end',   2100)
+  if t_step is None: t_step = get_option('t_step', 0.1)
+  timesteps = np.arange(t_start, t_end, t_step)
+
+  collectors = [
+    McResultsCollector(params_dist, study_aggressive, timesteps, t_step, t_end,
+      stream_trajectories = stream_trajectories, profile = get_option('profile', False), antithetic = antithetic)
+    for params_dist, study_aggressive in zip(params_dists, studies)
+  ]
+
+  # Checkpointing
+  checkpoint = None
+  completed_trials = 0
+  if checkpoint_dir:
+    checkpoint = McCheckpoint(checkpoint_dir)
+    run_settings = {
+      'aggressive': None if paired else aggressive, 't_start': t_start, 't_end': t_end, 't_step': t_step, 'qmc': qmc,
+      # The strata depend on the number of trials, so stratified runs can be resumed but not extended
+      'stratified_trials': n_trials if stratify_reqs else None,
+      'paired': paired,
+      'prescreened': failure_classifier is not None,
+      'antithetic': antithetic,
+    }
+
+    # (Default values of the settings missing from the manifests of older checkpoints)
+    default_settings = {'paired': False, 'prescreened': False, 'antithetic': False}
+
+    manifest = checkpoint.read_manifest()
+    if manifest is not None:
+      if not resume:
+        raise ValueError(f'There is already a checkpoint in {checkpoint_dir} (use --resume to continue it)')
+
+      for name, value in run_settings.items():
+        if manifest.get(name, default_settings.get(name)) != value:
+          raise ValueError(f'Cannot resume the checkpoint in {checkpoint_dir}: it was created with {name} = {manifest.get(name, default_settings.get(name))} (vs {value})')
+
+      if seed is not None and seed != manifest['seed']:
+        raise ValueError(f'Cannot resume the checkpoint in {checkpoint_dir}: it was created with a different seed')
+      seed = manifest['seed']
+
+      completed_trials = min(n_trials, checkpoint.get_completed_trials())
+
+  # Each trial gets its own random stream, so the results don't depend on the number of workers
+  seed_sequence = np.random.SeedSequence(seed)
+  if antithetic:
+    # (The two trials of each pair share their random stream)
+    trial_seeds = [trial_seed for trial_seed in seed_sequence.spawn((n_trials + 1)//2) for _ in range(2)][:n_trials]
+  else:
+    trial_seeds = seed_sequence.spawn(n_trials)
+  log.info(f'Seed: {seed_sequence.entropy}')
+
+  if checkpoint is not None and completed_trials == 0:
+    checkpoint.write_manifest({'seed': seed_sequence.entropy, **run_settings})
+
+  trial_settings = {
+    't_start': t_start, 't_end': t_end, 't_step': t_step, 'n_trials': n_trials, 'max_retries': max_retries,
+    'failure_classifier': failure_classifier, 'prescreen_threshold': prescreen_threshold, 'antithetic': antithetic,
+  }
+
+  if workers is None or workers < 1:
+    workers = os.cpu_count()
+
+  log.info(f'Running simulations...')
+  log.indent()
+
+  if completed_trials > 0:
+    log.info(f'Resuming from the checkpoint in {checkpoint_dir}: {completed_trials} trials already done, {n_trials - completed_trials} to go')
+
+  # (The points and the strata are quantiles, so they are shared by the paired analyses)
+  if qmc:
+    # One point of the sequence per trial (seeded independently of the number of trials, so that runs can be extended)
+    qmc_seed = np.random.SeedSequence(seed_sequence.entropy, spawn_key = (QMC_SPAWN_KEY,))
+    if antithetic:
+      # (One point per pair)
+      trial_points = np.repeat(QuasiRandomPoints(len(params_dists[0].marginals), method = qmc, seed = default_rng(qmc_seed)).random((n_trials + 1)//2), 2, axis = 0)[:n_trials]
+    else:
+      trial_points = QuasiRandomPoints(len(params_dists[0].marginals), method = qmc, seed = default_rng(qmc_seed)).random(n_trials)
+  else:
+    trial_points = [None] * n_trials
+
+  if stratify_reqs:
+    strata_seed = np.random.SeedSequence(seed_sequence.entropy, spawn_key = (STRATA_SPAWN_KEY,))
+    trial_reqs_quantiles = params_dists[0].get_stratified_reqs_quantiles(n_trials, random_state = default_rng(strata_seed))
+  else:
+    trial_reqs_quantiles = [None] * n_trials
+
+  pending_trials = list(zip(range(n_trials), trial_seeds, trial_points, trial_reqs_quantiles))[completed_trials:]
+
+  # Find the admissible training requirements once (rather than once per worker)
+  for params_dist in params_dists:
+    params_dist.get_admissible_reqs_marginal()
+
+  if queue_dir:
+    queue = WorkQueue(queue_dir)
+    if not queue.get_task_ids():
+      queue.put_context('mc_analysis', (params_dists, trial_settings, paired))
+      queue.add([
+        (run_trial_batch, (queue_dir, pending_trials[i:i + queue_batch_size]))
+        for i in range(0, len(pending_trials), queue_batch_size)
+      ])
+    queue.close()
+
+    log.info(f'Running the trials in the work queue in {queue_dir} (start more workers with --worker {queue_dir})')
+    run_worker(queue_dir, wait = True)
+
+    # (Only the trials that weren't queued are left, if any)
+    completed_trials = min(n_trials, checkpoint.get_completed_trials())
+    pending_trials = pending_trials[completed_trials - pending_trials[0][0]:] if pending_trials else []
+
+  trial_function = run_paired_trial if paired else run_trial
+
+  pool = None
+  if workers == 1:
+    init_trial_worker(params_dists, trial_settings)
+    new_trial_results = map(trial_function, pending_trials)
+  else:
+    log.info(f'Using {workers} workers')
+    pool = Pool(processes = workers, initializer = init_trial_worker, initargs = (params_dists, trial_settings))
+    new_trial_results = pool.imap(trial_function, pending_trials, chunksize = max(1, min(16, len(pending_trials) // (4 * workers))))
+
+  def get_trial_results():
+    if completed_trials > 0:
+      yield from checkpoint.iterate(completed_trials)
+
+    for trial, trial_output in enumerate(new_trial_results, start = completed_trials):
+      if checkpoint is not None: checkpoint.append(trial, trial_output)
+      yield trial_output
+
+  stopped_early = False
+  trials_done = 0
+
+  # The results come in trial order
+  for trial_output in get_trial_results():
+    for collector, output in zip(collectors, trial_output if paired else [trial_output]):
+      collector.add(*output)
+
+    trials_done += 1
+
+    if adaptive and trials_done % batch_size == 0 and trials_done < n_trials:
+      precisions = [collector.get_precision() for collector in collectors]
+      log.info(f'Precision after {trials_done} trials: quantiles within {max(max(precision["quantiles"].values()) for precision in precisions):.2f} years, '
+               f'slow takeoff probability within {max(precision["slow_takeoff_probability"] for precision in precisions):.3f}')
+      if all(precision_is_reached(precision, quantile_ci_width, probability_ci_width) for precision in precisions):
+        log.info('Target precision reached')
+        stopped_early = True
+        break
+
+  if checkpoint is not None:
+    checkpoint.flush()
+
+  if pool is not None:
+    if stopped_early:
+      pool.terminate()
+    else:
+      pool.close()
+    pool.join()
+
+  log.deindent()
+
+  all_results = []
+  for collector in collectors:
+    if collector.perf is not None:
+      log.info('Simulation profile' + (' (aggressive)' if paired and collector.aggressive else '') + ':')
+      log.indent()
+      log.info(collector.perf)
+      log.deindent()
+
+    results = collector.get_results()
+    results.t_start                      = t_start
+    results.seed                         = seed_sequence.entropy
+    results.checkpoint_dir               = checkpoint_dir
+    results.adaptive                     = adaptive
+    results.stopped_early                = stopped_early
+    results.qmc                          = qmc
+    results.stratify_reqs                = stratify_reqs
+    results.paired                       = paired
+    all_results.append(results)
+
+  return tuple(all_results) if paired else all_results[0]
+
+def get_grouped_quantiles(groups, values, qs, n_groups, weights = None):
+  """ Quantiles `qs` of the `values` of each group, with a single sort. `groups` are integers
+      (eg, from np.digitize); the ones outside of [0, n_groups) and the NaN values are left out.
+      Same as np.quantile (or get_weighted_quantile, with `weights`) for each group.
+
+      Returns (counts, quantiles), where quantiles is a (n_groups, len(qs)) array (NaN for the empty groups).
+  """
+  values = np.asarray(values, dtype = np.float64)
+  groups = np.asarray(groups, dtype = np.int64)
+  weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype = np.float64)
+  qs = np.asarray(qs, dtype = np.float64)
+
+  keep = ~np.isnan(values) & (weights > 0) & (groups >= 0) & (groups < n_groups)
+  values, groups, weights = values[keep], groups[keep], weights[keep]
+
+  order = np.lexsort((values, groups))
+  values, groups, weights = values[order], groups[order], weights[order]
+
+  counts = np.bincount(groups, minlength = n_groups)
+  quantiles = np.full((n_groups, len(qs)), np.nan)
+  nonempty = np.nonzero(counts)[0]
+  if len(nonempty) == 0:
+    return counts, quantiles
+
+  starts = (np.cumsum(counts) - counts)[nonempty]
+  ends = starts + counts[nonempty] - 1
+
+  # Position of each value within its group, as in get_weighted_quantile (0 for the first one, 1 for the last one)
+  cumulative = np.cumsum(weights)
+  cumulative -= np.repeat(cumulative[starts] - weights[starts], counts[nonempty])
+  span = np.repeat(cumulative[ends] - weights[ends], counts[nonempty])
+  with np.errstate(divide = 'ignore', invalid = 'ignore'):
+    positions = np.where(span > 0, (cumulative - weights) / span, 0)
+
+  # Find the value right before each quantile with a single search (the groups are 2 apart, so they don't overlap)
+  keys = 2*groups + positions
+  targets = 2*nonempty[:, np.newaxis] + qs
+  lower = np.clip(np.searchsorted(keys, targets, side = 'right') - 1, starts[:, np.newaxis], ends[:, np.newaxis])
+  upper = np.minimum(lower + 1, ends[:, np.newaxis])
+
+  with np.errstate(divide = 'ignore', invalid = 'ignore'):
+    fraction = np.clip((qs - positions[lower]) / (positions[upper] - positions[lower]), 0, 1)
+  fraction = np.where(upper > lower, fraction, 0)
+  quantiles[nonempty] = values[lower] + fraction * (values[upper] - values[lower])
+
+  return counts, quantiles
 
 def conditional_dist_graph(x, y, x_label=None, y_label=None, xscale="linear"):
   indices_to_keep = np.where(np.logical_not(np.isnan(x) | np.isnan(y)))
@@ -342,16 +1167,10 @@ def conditional_dist_graph(x, y, x_label=None, y_label=None, xscale="linear"):
     bins = np.linspace(np.min(x), np.max(x), bin_count)
   bin_indices = np.digitize(x, bins)
 
-  medians_x = []
-  medians_y = []
-
-  for bin_index in range(bin_count):
-      ys = y[bin_indices == bin_index]
-      if len(ys) > 10:
-          medians_x.append(bins[bin_index])
-          medians_y.append(np.median(ys))
+  counts, medians = get_grouped_quantiles(bin_indices, y, [0.5], bin_count)
+  enough = counts > 10
 
-  plt.plot(medians_x, medians_y, color = 'red', label = 'Median')
+  plt.plot(bins[enough], medians[enough, 0], color = 'red', label = 'Median')
   plt.legend(loc='upper left')
 
   if x_label: plt.xlabel(x_label)
@@ -359,8 +1178,9 @@ def conditional_dist_graph(x, y, x_label=None, y_label=None, xscale="linear"):
 
   plt.xscale(xscale)
 
-def is_slow_takeoff(model):
-  return model.timeline_metrics['automation_gns_100%'] is not None and n_year_doubling_before_m_year_doubling(model.gwp[:model.t_idx], model.t_step, 4, 1)
+def is_slow_takeoff(model, doubling_indices = None):
+  if doubling_indices is None: doubling_indices = get_doubling_indices(model.gwp[:model.t_idx], model.t_step)
+  return model.timeline_metrics['automation_gns_100%'] is not None and doubling_before(doubling_indices[4-1], doubling_indices[1-1], 4, model.t_step)
 
 def n_year_doubling_before_m_year_doubling(array, t_step, n, m):
   delta_n = round(n/t_step)
@@ -378,36 +1198,476 @@ def n_year_doubling_before_m_year_doubling(array, t_step, n, m):
 
   return t_diff >= n
 
+TAKEOFF_TABLE_SIZE = 19
+
+def get_doubling_indices(array, t_step):
+  """ indices[n-1] is the index at which the first full n year doubling of `array` starts
+      (-1 if there is none), for n = 1, ..., TAKEOFF_TABLE_SIZE
+  """
+  indices = np.full(TAKEOFF_TABLE_SIZE, -1, dtype = np.int64)
+  for n in range(1, TAKEOFF_TABLE_SIZE + 1):
+    delta = round(n/t_step)
+    if delta >= len(array): break
+    doubled = array[delta:]/array[:-delta] >= 2
+    if np.any(doubled):
+      indices[n-1] = np.argmax(doubled)
+  return indices
+
+def doubling_before(idx_n, idx_m, n, t_step):
+  """ Same as n_year_doubling_before_m_year_doubling, but from the doubling indices (see get_doubling_indices) """
+  return (idx_m < 0) | ((idx_n >= 0) & ((idx_m - idx_n) * t_step >= n))
+
+def get_doubling_indices_table(results):
+  """ (n_trials, TAKEOFF_TABLE_SIZE) table of doubling indices of the trials """
+  if getattr(results, 'doubling_indices', None) is not None:
+    return results.doubling_indices
+
+  # Results from before we stored them
+  return np.array([
+    get_doubling_indices(results.state_metrics['gwp'][i][:results.last_valid_indices[i]], results.t_step)
+    for i in range(results.n_trials)
+  ], dtype = np.int64).reshape(-1, TAKEOFF_TABLE_SIZE)
+
+def get_finished_trials(results):
+  return np.asarray(results.scalar_metrics['automation_gns_100%']) < results.t_end
+
+def get_takeoff_probability_table(doubling_indices, t_step, weights = None):
+  """ table[n-1, m-1] is the fraction of the trials (rows of `doubling_indices`) with
+      a full n year doubling of GWP before a m year doubling starts (weighted by `weights`, if given)
+  """
+  table = np.full((TAKEOFF_TABLE_SIZE, TAKEOFF_TABLE_SIZE), np.nan) # only defined for n > m
+  if len(doubling_indices) == 0:
+    return table
+
+  for n in range(2, TAKEOFF_TABLE_SIZE + 1):
+    flags = doubling_before(doubling_indices[:, n-1:n], doubling_indices[:, :n-1], n, t_step)
+    table[n-1, :n-1] = np.average(flags, axis = 0, weights = weights)
+  return table
+
 def write_takeoff_probability_table(n_trials=100, max_retries=100, input_results_filename=None):
   if input_results_filename:
-    with open(input_results_filename, 'rb') as f:
-      results = pickle.load(f)
+    results = read_mc_analysis_results(input_results_filename)
   else:
     results = mc_analysis(n_trials, max_retries)
 
-  t_step = results.t_step
-  gwps = [results.state_metrics['gwp'][i][:results.last_valid_indices[i]] for i in range(results.n_trials)]
-
-  ns = list(range(1, 20))
-  ms = list(range(1, 20))
-  table = []
-  for n in ns:
-    row = []
-    for m in ms:
-      p = np.sum([n_year_doubling_before_m_year_doubling(gwp, t_step, n, m) for gwp in gwps])/results.n_trials if (n > m) else np.nan
-      row.append(p)
-    table.append(row)
+  table = get_takeoff_probability_table(get_doubling_indices_table(results), results.t_step)
 
   df = pd.DataFrame(table)
-  df.index = ns
-  df.columns = ms
+  df.index = list(range(1, TAKEOFF_TABLE_SIZE + 1))
+  df.columns = list(range(1, TAKEOFF_TABLE_SIZE + 1))
 
   return df
 
+def add_precision_paragraph(report, results, metric_id_to_human):
+  precision = getattr(results, 'precision', None)
+  if precision is None:
+    return
+
+  metrics = []
+  for (metric, q), width in precision['quantiles'].items():
+    if metric not in metrics: metrics.append(metric)
+  widest = {metric: max(width for (m, q), width in precision['quantiles'].items() if m == metric) for metric in metrics}
+
+  widths = ', '.join(f'{metric_id_to_human.get(metric, metric)}: {width:.1f} years' for metric, width in widest.items())
+  stopping = ' (stopped once the target precision was reached)' if getattr(results, 'stopped_early', False) else ''
+  if getattr(results, 'antithetic', False):
+    stopping = f' in antithetic pairs{stopping}'
+
+  report.add_paragraph(
+    f"<span style='font-weight:bold'>Precision</span>: {results.n_trials} {pluralize('trial', results.n_trials)}{stopping}. "
+    f"Widest {precision['confidence']:.0%} confidence intervals of the quantiles of the metrics: {widths}. "
+    f"{precision['confidence']:.0%} confidence interval of the probability of slow takeoff: {100*precision['slow_takeoff_probability']:.1f} percentage points wide."
+  )
+
+def add_failures_paragraph(report, results, param_id_to_human, min_failures_for_classifier = 10):
+  """ Rejection rate and time spent per failure class. With enough failures, also the parameters
+      most associated with them (see FailureClassifier), which shows where the resampling biases the sample.
+  """
+  failures = getattr(results, 'failures', None)
+  if failures is None or len(failures) == 0:
+    return
+
+  attempts = results.n_trials + len(failures)
+  report.add_paragraph(
+    f"<span style='font-weight:bold'>Failed samples</span>: {len(failures)} of the {attempts} {pluralize('attempt', attempts)} "
+    f"({len(failures)/attempts:.1%}) failed and were resampled, taking {failures['time'].sum():.1f} s."
+  )
+
+  table = []
+  for exception, group in failures.groupby('exception'):
+    failing_years = results.t_start + group['t_idx'].dropna() * results.t_step
+    table.append({
+      'Failure':             exception,
+      'Count':               len(group),
+      'Share of attempts':   f'{len(group)/attempts:.1%}',
+      'Time (s)':            f'{group["time"].sum():.1f}',
+      'Median failing year': f'{np.median(failing_years):.1f}' if len(failing_years) > 0 else '-',
+    })
+  report.add_data_frame(pd.DataFrame(table), show_index = False)
+
+  if len(failures) >= min_failures_for_classifier:
+    classifier = FailureClassifier.fit(results.param_samples, failures)
+    if classifier is not None:
+      coefficients = sorted(classifier.coefficients.items(), key = lambda item: -abs(item[1]))
+      coefficients = [f'{param_id_to_human.get(param, param)} ({coefficient:+.1f})' for param, coefficient in coefficients[:3] if coefficient != 0]
+      if coefficients:
+        report.add_paragraph(
+          f"Parameters most associated with the failures (coefficients of a logistic model on their quantiles): {', '.join(coefficients)}."
+        )
+
+def add_paired_differences_paragraph(report, results, aggressive_results, metric_id_to_human = None, confidence = 0.95):
+  """ Differences between the aggressive and the normal analyses, run together with mc_analysis(paired = True).
+      Since the trials are paired, the confidence intervals use the per-trial differences.
+  """
+  if metric_id_to_human is None: metric_id_to_human = get_metric_names()
+
+  z = norm.ppf(0.5 + confidence/2)
+  units = get_trial_units(results.n_trials, antithetic = True) if getattr(results, 'antithetic', False) else None
+  differences = []
+  for metric in ADAPTIVE_TRACKED_METRICS:
+    d = np.asarray(aggressive_results.scalar_metrics[metric]) - np.asarray(results.scalar_metrics[metric])
+    keep = ~np.isnan(d)
+    d = d[keep]
+    if units is None:
+      half_width = z * np.std(d, ddof = 1) / np.sqrt(len(d)) if len(d) > 1 else np.inf
+    else:
+      # (The antithetic pairs are the independent units)
+      half_width = z * np.sqrt(get_ratio_variance(d, np.ones(len(d)), units[keep]))
+    differences.append(f'{metric_id_to_human.get(metric, metric)}: {np.mean(d):+.1f} ± {half_width:.1f} years')
+
+  report.add_paragraph(
+    f"<span style='font-weight:bold'>Aggressive vs normal</span> (paired trials, with the same random numbers): "
+    f"mean differences ({confidence:.0%} confidence intervals): {', '.join(differences)}."
+  )
+
+def get_weighted_quantile(values, weights, q):
+  """ Same as np.quantile (with linear interpolation) if all the weights are equal. The NaNs are left out. """
+  values = np.asarray(values, dtype = np.float64)
+  weights = np.asarray(weights, dtype = np.float64)
+  keep = ~np.isnan(values) & (weights > 0)
+  values, weights = values[keep], weights[keep]
+  if len(values) == 0:
+    return np.nan
+
+  order = np.argsort(values)
+  values, weights = values[order], weights[order]
+
+  # Position of each value (0 for the first one, 1 for the last one)
+  cumulative = np.cumsum(weights)
+  positions = (cumulative - weights) / (cumulative[-1] - weights[-1]) if len(values) > 1 else np.zeros(1)
+  return np.interp(q, positions, values)
+
+class ImportanceReweighting:
+  """ Estimates the results of an MC analysis under another parameter distribution without running any
+      new simulations, by weighting its trials with the likelihood ratio between the new distribution and
+      the one they were drawn from (self-normalized importance sampling).
+
+      The weights are only useful while the two distributions are similar. The effective sample size
+      says how many equally weighted trials the reweighted estimates are worth; when it's a small fraction
+      of the trials, a new analysis is needed.
+  """
+
+  def __init__(self, results, params_dist, sampling_params_dist = None, seed = 0):
+    """ `sampling_params_dist` is the distribution the trials of `results` were drawn from (see get_sampling_params_dist) """
+    if sampling_params_dist is None: sampling_params_dist = get_sampling_params_dist(results)
+
+    self.results = results
+    self.params_dist = params_dist
+
+    samples = pd.DataFrame(np.asarray(results.param_samples), columns = results.param_samples.columns)
+
+    # The point distributions don't have densities, so they must stay the same
+    for name, marginal in params_dist.marginals.items():
+      sampling_marginal = sampling_params_dist.marginals[name]
+      is_point = isinstance(marginal, PointDistribution)
+      if is_point != isinstance(sampling_marginal, PointDistribution) or (is_point and not np.isclose(marginal.get_value(), sampling_marginal.get_value(), rtol = 1e-12)):
+        raise ValueError(f'The distribution of {name} is (or was) a point distribution: the trials can\'t be reweighted')
+
+    # Same random numbers for both estimates of the probabilities of good samples, so that most of their noise cancels out
+    log_weights = params_dist.logpdf(samples, random_state = seed) - sampling_params_dist.logpdf(samples, random_state = seed)
+    weights = np.exp(log_weights - np.max(log_weights))
+    self.weights = weights / np.sum(weights)
+
+    self.effective_sample_size = 1 / np.sum(self.weights**2)
+
+  def get_quantile(self, values, q):
+    return get_weighted_quantile(values, self.weights, q)
+
+  def get_metrics_quantiles(self, quantiles = None):
+    """ Same as the `metrics_quantiles` of McAnalysisResults """
+    if quantiles is None: quantiles = self.results.quantiles
+    t_end = self.results.t_end
+
+    metrics_quantiles = []
+    for q in quantiles:
+      row = {"Quantile" : q}
+      for metric, values in self.results.scalar_metrics.items():
+        value = self.get_quantile(values, q)
+        row[metric] = value if (value < t_end) else f'≥ {t_end}'
+      metrics_quantiles.append(row)
+
+    row = {"Quantile" : "mean"}
+    for metric, values in self.results.scalar_metrics.items():
+      values = np.asarray(values, dtype = np.float64)
+      keep = ~np.isnan(values)
+      row[metric] = np.average(values[keep], weights = self.weights[keep]) if np.any(keep) else np.nan
+    metrics_quantiles.append(row)
+
+    return metrics_quantiles
+
+  def get_full_automation_probability(self):
+    return np.sum(self.weights[get_finished_trials(self.results)])
+
+  def get_takeoff_probability_table(self):
+    """ Same as get_takeoff_probability_table, conditional on full automation (like the probability of slow takeoff in the report) """
+    finished = get_finished_trials(self.results)
+    if not np.any(self.weights[finished] > 0):
+      return np.full((TAKEOFF_TABLE_SIZE, TAKEOFF_TABLE_SIZE), np.nan)
+    return get_takeoff_probability_table(get_doubling_indices_table(self.results)[finished], self.results.t_step, weights = self.weights[finished])
+
+  def get_slow_takeoff_probability(self):
+    return self.get_takeoff_probability_table()[4-1, 1-1]
+
+def write_reweighting_report(params_dist, input_results_filename = None, results = None, report_file_path = None,
+    report_dir_path = None, report = None, min_relative_ess = 0.1, seed = 0):
+  """ Report with the results of an MC analysis reweighted to `params_dist` (see ImportanceReweighting) """
+
+  if report_file_path is None:
+    report_file_path = 'mc_reweighting.html'
+
+  if not results:
+    results = read_mc_analysis_results(input_results_filename)
+
+  log.info('Reweighting the trials...')
+  reweighting = ImportanceReweighting(results, params_dist, seed = seed)
+
+  log.info('Writing report...')
+  new_report = report is None
+  if new_report:
+    report = Report(report_file_path=report_file_path, report_dir_path=report_dir_path)
+
+  relative_ess = reweighting.effective_sample_size / results.n_trials
+  reliability = '' if relative_ess >= min_relative_ess else ' <span style="font-weight:bold">The new distribution is too far from the original one for these estimates to be reliable: run a new analysis.</span>'
+  report.add_paragraph(
+    f"Results of the {results.n_trials} {pluralize('trial', results.n_trials)} of an MC analysis, reweighted to a new parameter distribution (without running new simulations). "
+    f"<span style='font-weight:bold'>Effective sample size</span>: {reweighting.effective_sample_size:.0f} trials ({relative_ess:.0%}).{reliability}"
+  )
+
+  report.add_paragraph(f"<span style='font-weight:bold'>Probability of full economic automation before {results.t_end}</span><span style='font-weight:bold'>:</span> {reweighting.get_full_automation_probability():.0%}")
+  report.add_paragraph(f"<span style='font-weight:bold'>Probability of slow takeoff</span> (a full 4 year doubling of GWP before a 1 year doubling starts, conditional on full economic automation before {results.t_end})<span style='font-weight:bold'>:</span> {reweighting.get_slow_takeoff_probability():.0%}")
+
+  metrics_quantiles = pd.DataFrame(reweighting.get_metrics_quantiles())
+  metrics_quantiles['Quantile'] = [q if isinstance(q, str) else f'{q:.2f}' for q in metrics_quantiles['Quantile']]
+  metrics_quantiles = metrics_quantiles[['Quantile'] + [metric for metric in metrics_quantiles.columns if metric in get_most_important_metrics()]]
+  report.add_data_frame(metrics_quantiles.style.format(lambda x: x if isinstance(x, str) else f'{x:.1f}').hide(axis = 'index'), show_index = False)
+
+  if new_report:
+    report_path = report.write()
+    log.info(f'Report stored in {report_path}')
+
+  return reweighting
+
+class MultiFidelityEstimator:
+  """ Combines a big MC analysis with a coarse t_step and a smaller one with the fine t_step (see
+      multifidelity_mc_analysis). Both are run with the same seed, so each fine trial has the same
+      parameters as the coarse trial with its index. The coarse values are used as control variates:
+
+        mean:     mean_fine(paired) + beta * (mean_coarse(all) - mean_coarse(paired))
+        quantile: quantile_coarse(all) + (quantile_fine(paired) - quantile_coarse(paired))
+
+      where beta is the regression coefficient of the fine values on the coarse ones in the paired trials.
+      The more correlated the coarse and fine values are, the more fine trials the estimates are worth
+      (see get_equivalent_trials).
+  """
+
+  def __init__(self, coarse_results, fine_results):
+    if fine_results.n_trials > coarse_results.n_trials:
+      raise ValueError('There must be at least as many coarse trials as fine ones')
+
+    self.coarse_results = coarse_results
+    self.fine_results = fine_results
+
+    # The pairs whose samples differ (because one of them failed and was redrawn) are left out
+    n = fine_results.n_trials
+    coarse_samples = coarse_results.param_samples[fine_results.param_samples.columns].to_numpy(dtype = np.float64)[:n]
+    fine_samples = fine_results.param_samples.to_numpy(dtype = np.float64)
+    self.paired = np.all(np.isclose(coarse_samples, fine_samples, rtol = 1e-12, equal_nan = True), axis = 1)
+
+  def get_paired_values(self, coarse_values, fine_values):
+    """ (all the coarse values, the coarse values of the pairs, the fine values of the pairs), without NaNs """
+    coarse_values = np.asarray(coarse_values, dtype = np.float64)
+    fine_values = np.asarray(fine_values, dtype = np.float64)
+
+    paired_coarse = coarse_values[:len(fine_values)]
+    keep = self.paired & ~np.isnan(paired_coarse) & ~np.isnan(fine_values)
+    return filter_nans(coarse_values), paired_coarse[keep], fine_values[keep]
+
+  def get_metric_values(self, metric):
+    return self.get_paired_values(self.coarse_results.scalar_metrics[metric], self.fine_results.scalar_metrics[metric])
+
+  def get_control_variate_mean(self, coarse_values, fine_values):
+    """ Returns the estimate of the fine mean and its standard error """
+    all_coarse, coarse, fine = self.get_paired_values(coarse_values, fine_values)
+    if len(fine) < 2:
+      return np.nan, np.nan
+
+    var_coarse = np.var(coarse, ddof = 1)
+    var_fine = np.var(fine, ddof = 1)
+    cov = np.cov(coarse, fine)[0, 1]
+
+    beta = cov / var_coarse if var_coarse > 0 else 0
+    estimate = np.mean(fine) + beta * (np.mean(all_coarse) - np.mean(coarse))
+
+    rho_squared = cov**2 / (var_coarse * var_fine) if var_coarse > 0 and var_fine > 0 else 0
+    variance = var_fine * (1 - rho_squared) / len(fine) + beta**2 * np.var(all_coarse, ddof = 1) / len(all_coarse)
+    return estimate, np.sqrt(variance)
+
+  def get_mean(self, metric):
+    return self.get_control_variate_mean(self.coarse_results.scalar_metrics[metric], self.fine_results.scalar_metrics[metric])
+
+  def get_quantile(self, metric, q):
+    all_coarse, coarse, fine = self.get_metric_values(metric)
+    if len(fine) == 0:
+      return np.nan
+    return np.quantile(all_coarse, q) + (np.quantile(fine, q) - np.quantile(coarse, q))
+
+  def get_correlation(self, metric):
+    all_coarse, coarse, fine = self.get_metric_values(metric)
+    if len(fine) < 2 or np.std(coarse) == 0 or np.std(fine) == 0:
+      return np.nan
+    return np.corrcoef(coarse, fine)[0, 1]
+
+  def get_equivalent_trials(self, metric):
+    """ Number of fine trials whose plain mean would be as precise as the estimate of the mean """
+    all_coarse, coarse, fine = self.get_metric_values(metric)
+    estimate, standard_error = self.get_mean(metric)
+    if not standard_error > 0:
+      return np.nan
+    return np.var(fine, ddof = 1) / standard_error**2
+
+  def get_metrics_quantiles(self, quantiles = None):
+    """ Same as the `metrics_quantiles` of McAnalysisResults (the `quantiles` must be sorted) """
+    if quantiles is None: quantiles = self.fine_results.quantiles
+    t_end = self.fine_results.t_end
+
+    # The corrections of the quantiles are noisy, so the estimates can come out of order: we sort them (monotone rearrangement)
+    estimates = {metric: np.sort([self.get_quantile(metric, q) for q in quantiles]) for metric in self.fine_results.scalar_metrics}
+
+    metrics_quantiles = []
+    for i, q in enumerate(quantiles):
+      row = {"Quantile" : q}
+      for metric in self.fine_results.scalar_metrics:
+        value = estimates[metric][i]
+        row[metric] = value if (value < t_end) else f'≥ {t_end}'
+      metrics_quantiles.append(row)
+
+    row = {"Quantile" : "mean"}
+    for metric in self.fine_results.scalar_metrics:
+      row[metric] = self.get_mean(metric)[0]
+    metrics_quantiles.append(row)
+
+    return metrics_quantiles
+
+  def get_full_automation_probability(self):
+    return self.get_control_variate_mean(get_finished_trials(self.coarse_results), get_finished_trials(self.fine_results))[0]
+
+  def get_slow_takeoff_probability(self):
+    """ Conditional on full automation (as in the report), ie, P(slow takeoff and full automation) / P(full automation) """
+    def get_flags(results):
+      doubling_indices = get_doubling_indices_table(results)
+      return get_finished_trials(results) & doubling_before(doubling_indices[:, 4-1], doubling_indices[:, 1-1], 4, results.t_step)
+
+    slow_takeoff = self.get_control_variate_mean(get_flags(self.coarse_results), get_flags(self.fine_results))[0]
+    return slow_takeoff / self.get_full_automation_probability()
+
+def multifidelity_mc_analysis(n_trials = 1000, n_fine_trials = 100, coarse_t_step = 1, max_retries = 100, aggressive = False,
+    workers = 1, seed = None, qmc = None):
+  """ Runs `n_trials` trials with a `coarse_t_step` and the first `n_fine_trials` of them again with the
+      default t_step, and combines them (see MultiFidelityEstimator)
+  """
+  # Both analyses need the same seed, so that their trials are paired
+  if seed is None: seed = np.random.SeedSequence().entropy
+
+  fine_t_step = get_option('t_step', 0.1)
+  if coarse_t_step < fine_t_step:
+    raise ValueError(f'The coarse t_step ({coarse_t_step}) is smaller than the fine one ({fine_t_step})')
+
+  run_times = {}
+  all_results = {}
+  for name, t_step, trials in [('coarse', coarse_t_step, n_trials), ('fine', fine_t_step, n_fine_trials)]:
+    log.info(f'Running the {name} trials (t_step = {t_step})...')
+    log.indent()
+    start_time = time.perf_counter()
+    all_results[name] = mc_analysis(trials, max_retries, aggressive, workers = workers, seed = seed, qmc = qmc, t_step = t_step)
+    run_times[name] = time.perf_counter() - start_time
+    log.deindent()
+
+  estimator = MultiFidelityEstimator(all_results['coarse'], all_results['fine'])
+  estimator.run_times = run_times
+  return estimator
+
+def write_multifidelity_report(n_trials = 1000, n_fine_trials = 100, coarse_t_step = 1, max_retries = 100, aggressive = False,
+    workers = 1, seed = None, qmc = None, estimator = None, output_results_filename = None,
+    report_file_path = None, report_dir_path = None, report = None):
+  """ Report with the estimates of multifidelity_mc_analysis. With `output_results_filename`, the results
+      of the coarse and the fine analyses are stored in its coarse/ and fine/ subdirectories.
+  """
+
+  if report_file_path is None:
+    report_file_path = 'mc_multifidelity.html'
+
+  if estimator is None:
+    estimator = multifidelity_mc_analysis(n_trials, n_fine_trials, coarse_t_step, max_retries, aggressive, workers = workers, seed = seed, qmc = qmc)
+
+  coarse_results, fine_results = estimator.coarse_results, estimator.fine_results
+
+  if output_results_filename:
+    coarse_results.save(os.path.join(output_results_filename, 'coarse'))
+    fine_results.save(os.path.join(output_results_filename, 'fine'))
+
+  metric_id_to_human = get_metric_names()
+
+  log.info('Writing report...')
+  new_report = report is None
+  if new_report:
+    report = Report(report_file_path=report_file_path, report_dir_path=report_dir_path)
+
+  run_times = getattr(estimator, 'run_times', None)
+  def describe_run(results, name):
+    run_time = f', {run_times[name]:.0f} s' if run_times else ''
+    return f"{results.n_trials} {pluralize('trial', results.n_trials)} with t_step = {results.t_step:g}{run_time}"
+
+  equivalent_trials = ', '.join(
+    f'{metric_id_to_human.get(metric, metric)}: {estimator.get_equivalent_trials(metric):.0f} (correlation {estimator.get_correlation(metric):.2f})'
+    for metric in ADAPTIVE_TRACKED_METRICS
+  )
+  report.add_paragraph(
+    f"Multi-fidelity MC analysis: {describe_run(coarse_results, 'coarse')}, and {describe_run(fine_results, 'fine')} for the first {estimator.paired.sum()} of them. "
+    f"The coarse trials are used as control variates for the fine ones. "
+    f"<span style='font-weight:bold'>Equivalent number of fine trials</span> of the estimates of the means: {equivalent_trials}."
+  )
+
+  report.add_paragraph(f"<span style='font-weight:bold'>Probability of full economic automation before {fine_results.t_end}</span><span style='font-weight:bold'>:</span> {estimator.get_full_automation_probability():.0%}")
+  report.add_paragraph(f"<span style='font-weight:bold'>Probability of slow takeoff</span> (a full 4 year doubling of GWP before a 1 year doubling starts, conditional on full economic automation before {fine_results.t_end})<span style='font-weight:bold'>:</span> {estimator.get_slow_takeoff_probability():.0%}")
+
+  metrics_quantiles = pd.DataFrame(estimator.get_metrics_quantiles())
+  metrics_quantiles['Quantile'] = [q if isinstance(q, str) else f'{q:.2f}' for q in metrics_quantiles['Quantile']]
+  metrics_quantiles = metrics_quantiles[['Quantile'] + [metric for metric in metrics_quantiles.columns if metric in get_most_important_metrics()]]
+  report.add_data_frame(metrics_quantiles.style.format(lambda x: x if isinstance(x, str) else f'{x:.1f}').hide(axis = 'index'), show_index = False)
+
+  if new_report:
+    report_path = report.write()
+    log.info(f'Report stored in {report_path}')
+
+  return estimator
+
 def write_mc_analysis_report(
     n_trials=100, max_retries=100, aggressive=False, include_sample_table=False, report_file_path=None,
     report_dir_path=None, report=None, output_results_filename=None, input_results_filename=None,
-    results=None
+    results=None, workers=1, seed=None, stream_trajectories=False, checkpoint_dir=None, resume=False,
+    adaptive=False, batch_size=200, quantile_ci_width=1.0, probability_ci_width=0.05, qmc=None,
+    stratify_reqs=False, failure_classifier=None, prescreen_threshold=0.9, queue_dir=None, queue_batch_size=100,
+    antithetic=False
   ):
 
   if report_file_path is None:
@@ -415,14 +1675,18 @@ def write_mc_analysis_report(
 
   if not results:
     if input_results_filename:
-      with open(input_results_filename, 'rb') as f:
-        results = pickle.load(f)
+      results = read_mc_analysis_results(input_results_filename)
     else:
-      results = mc_analysis(n_trials, max_retries, aggressive)
+      results = mc_analysis(
+        n_trials, max_retries, aggressive, workers = workers, seed = seed, stream_trajectories = stream_trajectories,
+        checkpoint_dir = checkpoint_dir, resume = resume,
+        adaptive = adaptive, batch_size = batch_size, quantile_ci_width = quantile_ci_width, probability_ci_width = probability_ci_width,
+        qmc = qmc, stratify_reqs = stratify_reqs, failure_classifier = failure_classifier, prescreen_threshold = prescreen_threshold,
+        queue_dir = queue_dir, queue_batch_size = queue_batch_size, antithetic = antithetic,
+      )
 
   if output_results_filename:
-    with open(output_results_filename, 'wb') as f:
-      pickle.dump(results, f)
+    results.save(output_results_filename)
 
   metric_id_to_human = get_metric_names()
   param_id_to_human = get_param_names()
@@ -446,19 +1710,9 @@ def write_mc_analysis_report(
   # Add a mini-widget in a tooltip to let the user select the definition of "slow takeoff"
   #
 
-  # Create the table
-  gwps = [results.state_metrics['gwp'][i][:results.last_valid_indices[i]] for i in range(results.n_trials)]
-  takeoff_probability_table = []
-  for n in range(1, 20):
-    row = []
-    for m in range(1, 20):
-      # Only consider runs in which we have full automation before 2100
-      p = np.sum([
-        (n_year_doubling_before_m_year_doubling(gwps[i], results.t_step, n, m) and results.scalar_metrics['automation_gns_100%'][i] < results.t_end) \
-          for i in range(len(gwps))
-      ])/results.n_finished_trials if (n > m) else np.nan
-      row.append(p)
-    takeoff_probability_table.append(row)
+  # The widget computes the probabilities from the doubling indices of the trials
+  # Only consider runs in which we have full automation before 2100
+  finished_doubling_indices = get_doubling_indices_table(results)[get_finished_trials(results)].tolist()
 
   # Probability of 
   report.add_paragraph(f"<span style='font-weight:bold'>Probability of full economic automation before {results.t_end}</span><span style='font-weight:bold'>:</span> {results.n_finished_trials/results.n_trials:.0%}")
@@ -467,6 +1721,9 @@ def write_mc_analysis_report(
   description = f'''Probability of a full <input class='doubling-years-inputs' id='doubling-years-input-m-{report.id}' value='4' style='display:inline-block'> year doubling of GWP before a <input class='doubling-years-inputs' id='doubling-years-input-n-{report.id}' value='1'> year doubling of GWP starts, conditional on full economic automation before {results.t_end}.'''
   report.add_paragraph(f"<span style='font-weight:bold'>Probability of slow takeoff</span>{report.generate_tooltip_html(description, on_mount = 'initialize_takeoff_probability_mini_widget_' + report.id + '()', triggers = 'mouseenter click', classes = 'slow-takeoff-probability-tooltip-info')}<span style='font-weight:bold'>:</span> <span id='slow-takeoff-probability-{report.id}'>{results.slow_takeoff_count/results.n_finished_trials:.0%}</span>")
 
+  add_precision_paragraph(report, results, metric_id_to_human)
+  add_failures_paragraph(report, results, param_id_to_human)
+
   # Style
   report.head.append(et.fromstring('''
     <style>
@@ -492,8 +1749,26 @@ def write_mc_analysis_report(
           return;
         }
 
-        // p(full <row + 1> year doubling before the start of a <col + 1> year doubling)
-        let p_table = ''' + json.dumps(takeoff_probability_table) + ''';
+        // Index at which the first full <col + 1> year doubling of GWP starts (-1 if none), for each trial
+        let doubling_indices = ''' + json.dumps(finished_doubling_indices) + ''';
+        let t_step = ''' + json.dumps(results.t_step) + ''';
+
+        // p(full n year doubling before the start of a m year doubling); same as doubling_before()
+        function get_takeoff_probability(n, m) {
+          if (!(1 <= m && m < n && n <= ''' + str(TAKEOFF_TABLE_SIZE) + ''') || doubling_indices.length == 0) {
+            return NaN;
+          }
+
+          let count = 0;
+          for (let indices of doubling_indices) {
+            let idx_n = indices[n-1];
+            let idx_m = indices[m-1];
+            if (idx_m < 0 || (idx_n >= 0 && (idx_m - idx_n) * t_step >= n)) {
+              count++;
+            }
+          }
+          return count / doubling_indices.length;
+        }
 
         let n_input = document.getElementById('doubling-years-input-n-''' + report.id + '''');
         let m_input = document.getElementById('doubling-years-input-m-''' + report.id + '''');
@@ -502,11 +1777,7 @@ def write_mc_analysis_report(
         function update_slow_takeoff_probability() {
           let m = parseInt(m_input.value);
           let n = parseInt(n_input.value);
-          let p = NaN;
-
-          if ((1 <= m && m <= p_table.length) && (1 <= n && n <= p_table[0].length)) {
-            p = p_table[m-1][n-1] * 100;
-          }
+          let p = get_takeoff_probability(m, n) * 100;
 
           probability.innerHTML = Number.isNaN(p) ? '--' : `${p.toFixed()}%`;
         }
@@ -680,7 +1951,8 @@ def write_mc_analysis_report(
   # Plot trajectories
   metrics = {'biggest_training_run': 'Biggest training run'}
   for metric in metrics:
-    results.state_metrics[metric] = np.stack([s[:len(results.timesteps)] for s in results.state_metrics[metric]])
+    if not isinstance(results.state_metrics[metric], (TrajectoryQuantileSketch, np.ndarray)):
+      results.state_metrics[metric] = np.stack([s[:len(results.timesteps)] for s in results.state_metrics[metric]])
     plot_quantiles(results.timesteps, results.state_metrics[metric], "Year", metrics[metric])
     report.add_figure()
 
@@ -688,11 +1960,14 @@ def write_mc_analysis_report(
   for metric in metrics:
     plt.figure(figsize=(10,6))
 
-    median = np.zeros(len(results.timesteps))
-    for t in range(len(results.timesteps)):
-      median[t]=np.percentile(results.state_metrics[metric][:,t], 50)
+    if isinstance(results.state_metrics[metric], TrajectoryQuantileSketch):
+      median = results.state_metrics[metric].get_percentiles([50])[:, 0]
+      sample_paths = results.state_metrics[metric].sample_paths
+    else:
+      median = get_trajectory_percentiles(results.state_metrics[metric], [50])[:, 0]
+      sample_paths = results.state_metrics[metric][:20]
 
-    for path in results.state_metrics[metric][:20]:
+    for path in sample_paths:
       plt.plot(results.timesteps, path, color='#ccc')
     plt.plot(results.timesteps, median, color='red', label = 'median')
     plt.legend()
@@ -879,20 +2154,52 @@ def write_mc_analysis_report(
   log.info('Done')
 
 # https://stackoverflow.com/questions/18313322/plotting-quantiles-median-and-spread-using-scipy-and-matplotlib
-def plot_quantiles(ts, data, xlabel, ylabel, n_quantiles = 7, colormap = cm.Blues):
-  # Fix overflows
-  UPPER_BOUND = np.quantile(data, 0.95)
-  data[data == 0.] = UPPER_BOUND
-  data[data > UPPER_BOUND] = UPPER_BOUND
+def get_global_quantile(data, q, max_chunk_size = 2**24):
+  """ Quantile `q` of all the values of the (n_trials, n_timesteps) array `data`. It's exact if `data` has at most
+      `max_chunk_size` values; otherwise the trials are read in chunks of at most that size into a TrajectoryQuantileSketch,
+      and the quantile is approximated from it (as in get_trajectory_percentiles, we never copy the whole of `data`).
+  """
+  n_trials, n_timesteps = data.shape
+  if n_trials * n_timesteps <= max_chunk_size:
+    return np.quantile(data, q)
+
+  sketch = TrajectoryQuantileSketch(n_timesteps, n_sample_paths = 0)
+  chunk_trials = max(1, max_chunk_size // max(1, n_timesteps))
+  for start in range(0, n_trials, chunk_trials):
+    sketch.add_paths(data[start:start + chunk_trials])
+  return sketch.get_global_quantile(q)
+
+def get_trajectory_percentiles(data, percentiles, transform = None, max_chunk_size = 2**24):
+  """ Percentiles of each timestep of the (n_trials, n_timesteps) array `data`, as a (n_timesteps, len(percentiles)) array.
+      The timesteps are processed in chunks of at most `max_chunk_size` values (`transform` is applied to each
+      chunk), so we never copy the whole of `data`, which may be a memory-mapped array bigger than the memory.
+  """
+  n_trials, n_timesteps = data.shape
+  chunk_timesteps = max(1, max_chunk_size // max(1, n_trials))
+
+  result = np.empty((n_timesteps, len(percentiles)))
+  for start in range(0, n_timesteps, chunk_timesteps):
+    chunk = np.asarray(data[:, start:start + chunk_timesteps])
+    if transform is not None: chunk = transform(chunk)
+    result[start:start + chunk_timesteps] = np.percentile(chunk, percentiles, axis = 0).T
+  return result
 
-  # Compute quantiles
+def plot_quantiles(ts, data, xlabel, ylabel, n_quantiles = 7, colormap = cm.Blues):
+  """ `data` is either a (n_trials, n_timesteps) array or a TrajectoryQuantileSketch """
   n = len(ts)
   percentiles = np.linspace(0,100,n_quantiles)
 
-  marks=np.zeros((n,n_quantiles))
-  for i in range(n_quantiles):
-    for t in range(n):
-      marks[t,i]=np.percentile(data[:,t],percentiles[i])
+  if isinstance(data, TrajectoryQuantileSketch):
+    # Same overflow fix as below (zeros and values over the upper bound become the upper bound)
+    UPPER_BOUND = data.get_global_quantile(0.95)
+    marks = np.minimum(data.get_percentiles(percentiles, zeros_on_top = True), UPPER_BOUND)
+  else:
+    # Fix overflows
+    UPPER_BOUND = get_global_quantile(data, 0.95)
+    fix_overflows = lambda chunk: np.where((chunk == 0.) | (chunk > UPPER_BOUND), UPPER_BOUND, chunk)
+
+    # Compute quantiles
+    marks = get_trajectory_percentiles(data, percentiles, transform = fix_overflows)
 
   # Plot
   half = int((n_quantiles-1)/2)
@@ -933,6 +2240,84 @@ if __name__ == '__main__':
     default=100,
   )
 
+  parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of processes running the trials (0 to use all the CPUs)",
+  )
+
+  parser.add_argument(
+    "--seed",
+    type=int,
+    default=None,
+    help="Seed of the random number generator (the results don't depend on the number of workers)",
+  )
+
+  parser.add_argument(
+    "--qmc",
+    choices=['sobol', 'halton'],
+    default=None,
+    help="Sample the parameters from a scrambled low-discrepancy sequence (quasi-Monte Carlo)",
+  )
+
+  parser.add_argument(
+    "--stratify-reqs",
+    action='store_true',
+    help="Latin hypercube sampling of the training requirements (one stratum per trial)",
+  )
+
+  parser.add_argument(
+    "--antithetic",
+    action='store_true',
+    help="Run the trials in antithetic pairs (the second trial of each pair uses the mirrored random numbers of the first one)",
+  )
+
+  parser.add_argument(
+    "--adaptive",
+    action='store_true',
+    help="Run the trials in batches and stop once the target precision is reached (--n-trials becomes the maximum)",
+  )
+
+  parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=200,
+    help="Number of trials between precision checks (with --adaptive)",
+  )
+
+  parser.add_argument(
+    "--quantile-ci-width",
+    type=float,
+    default=1.0,
+    help="Target width (in years) of the 95%% confidence intervals of the quantiles of the main metrics (with --adaptive)",
+  )
+
+  parser.add_argument(
+    "--probability-ci-width",
+    type=float,
+    default=0.05,
+    help="Target width of the 95%% confidence interval of the probability of slow takeoff (with --adaptive)",
+  )
+
+  parser.add_argument(
+    "--checkpoint-dir",
+    default=None,
+    help="Store the completed trials in this directory as they finish",
+  )
+
+  parser.add_argument(
+    "--resume",
+    action='store_true',
+    help="Continue (or extend to --n-trials) the run stored in --checkpoint-dir",
+  )
+
+  parser.add_argument(
+    "--stream-trajectories",
+    action='store_true',
+    help="Keep approximate per-timestep quantiles of the trajectories instead of every trajectory (saves memory with many trials)",
+  )
+
   parser.add_argument(
     "--include-sample-table",
     action='store_true',
@@ -957,21 +2342,126 @@ if __name__ == '__main__':
 
   parser.add_argument(
     "--input-results-file",
-    help = 'Read the MC results from this file (pickle) instead of regenerating them',
+    help = 'Read the MC results from this directory (see --output-results-file) instead of regenerating them. Pickle files written by previous versions are accepted too.',
   )
 
   parser.add_argument(
     "--output-results-file",
-    help = 'Store the results of the analysis in this file (pickle)',
+    help = 'Store the results of the analysis in this directory (a JSON manifest plus one .npy file per array)',
+  )
+
+  parser.add_argument(
+    "--fine-trials",
+    type=int,
+    default=None,
+    help="Multi-fidelity analysis: run --n-trials trials with --coarse-t-step, and only this many of them with the default t_step (the coarse trials are used as control variates)",
+  )
+
+  parser.add_argument(
+    "--coarse-t-step",
+    type=float,
+    default=1,
+    help="Step of the coarse simulations (with --fine-trials)",
+  )
+
+  parser.add_argument(
+    "--reweight",
+    action='store_true',
+    help="Instead of running an analysis, reweight the trials of --input-results-file to the parameter distribution given by the rest of the options (eg, --use-aggressive-ajeya, --ajeya-dist-url or --param-table-url), without running new simulations",
+  )
+
+  parser.add_argument(
+    "--prescreen-failures",
+    help = "Skip the samples that are likely to fail, according to a classifier fitted to the failures of the MC results in this directory",
+  )
+
+  parser.add_argument(
+    "--prescreen-threshold",
+    type=float,
+    default=0.9,
+    help="Predicted probability of failure over which the samples are skipped (with --prescreen-failures)",
+  )
+
+  parser.add_argument(
+    "--queue-dir",
+    default=None,
+    help="Run the trials through a work queue in this directory (in a filesystem shared with the workers, see --worker). Running the same command again resumes the analysis.",
+  )
+
+  parser.add_argument(
+    "--queue-batch-size",
+    type=int,
+    default=100,
+    help="Number of trials per task of the work queue (with --queue-dir)",
+  )
+
+  parser.add_argument(
+    "--worker",
+    metavar="QUEUE_DIR",
+    default=None,
+    help="Work on the tasks of the work queue in this directory until there are none left, instead of running an analysis",
+  )
+
+  parser.add_argument(
+    "--lease-time",
+    type=float,
+    default=600,
+    help="Seconds after which the tasks of a worker that stopped responding go back to the queue (with --worker)",
   )
 
   args = handle_cli_arguments(parser)
 
+  if args.worker:
+    tasks_done = run_worker(args.worker, lease_time = args.lease_time)
+    log.info(f'No tasks left in {args.worker} ({tasks_done} done by this worker)')
+    sys.exit()
+
+  if args.resume and not args.checkpoint_dir:
+    parser.error('--resume requires --checkpoint-dir')
+
+  if args.reweight and not args.input_results_file:
+    parser.error('--reweight requires --input-results-file')
+
+  failure_classifier = None
+  if args.prescreen_failures:
+    previous_results = read_mc_analysis_results(args.prescreen_failures)
+    previous_failures = getattr(previous_results, 'failures', None)
+    if previous_failures is not None:
+      failure_classifier = FailureClassifier.fit(previous_results.param_samples, previous_failures)
+    if failure_classifier is None:
+      log.info(f'There are no failures in {args.prescreen_failures}: not prescreening the samples')
+
   if args.use_website_rank_correlations:
     set_option('rank_correlations_sheet_url', get_option('website_rank_correlations_url'))
   else:
     set_option('rank_correlations_sheet_url', args.rank_correlations_url)
 
+  if args.fine_trials:
+    write_multifidelity_report(
+      n_trials=args.n_trials,
+      n_fine_trials=args.fine_trials,
+      coarse_t_step=args.coarse_t_step,
+      max_retries=args.max_retries,
+      aggressive=args.use_aggressive_ajeya,
+      workers=args.workers,
+      seed=args.seed,
+      qmc=args.qmc,
+      output_results_filename=args.output_results_file,
+      report_file_path=args.output_file,
+      report_dir_path=args.output_dir,
+    )
+    sys.exit()
+
+  if args.reweight:
+    write_reweighting_report(
+      get_mc_params_dist(args.use_aggressive_ajeya),
+      input_results_filename=args.input_results_file,
+      report_file_path=args.output_file,
+      report_dir_path=args.output_dir,
+      seed=args.seed if args.seed is not None else 0,
+    )
+    sys.exit()
+
   write_mc_analysis_report(
     n_trials=args.n_trials,
     max_retries=args.max_retries,
@@ -981,4 +2471,20 @@ if __name__ == '__main__':
     output_results_filename=args.output_results_file,
     input_results_filename=args.input_results_file,
     aggressive=args.use_aggressive_ajeya,
+    workers=args.workers,
+    seed=args.seed,
+    stream_trajectories=args.stream_trajectories,
+    checkpoint_dir=args.checkpoint_dir,
+    resume=args.resume,
+    adaptive=args.adaptive,
+    batch_size=args.batch_size,
+    quantile_ci_width=args.quantile_ci_width,
+    probability_ci_width=args.probability_ci_width,
+    qmc=args.qmc,
+    stratify_reqs=args.stratify_reqs,
+    antithetic=args.antithetic,
+    failure_classifier=failure_classifier,
+    prescreen_threshold=args.prescreen_threshold,
+    queue_dir=args.queue_dir,
+    queue_batch_size=args.queue_batch_size,
   )
@@ -0,0 +1,258 @@
+"""
+Conditional questions about the results of an MC analysis.
+"""
+
+from . import log
+from . import *
+
+import re
+from .mc_analysis import read_mc_analysis_results, get_grouped_quantiles, get_weighted_quantile, conditional_dist_graph
+
+class McQuery:
+  """ Conditional questions about the trials of an MC analysis, answered from the stored results (see
+      McAnalysisResults), without running any simulations. The columns are the scalar metrics and the parameters.
+
+      For example, the distribution of full_automation_gns when software_returns is in its top decile:
+
+        McQuery(results).where('software_returns', 0.9, quantiles = True).get_quantiles('full_automation_gns', [0.1, 0.5, 0.9])
+
+      The trials can be weighted (eg, with the weights of an ImportanceReweighting).
+  """
+
+  def __init__(self, results, weights = None, mask = None):
+    self.results = results
+    self.weights = np.ones(results.n_trials) if weights is None else np.asarray(weights, dtype = np.float64)
+    self.mask = np.ones(results.n_trials, dtype = bool) if mask is None else mask
+    self.conditions = []
+
+  def get_columns(self):
+    return list(self.results.scalar_metrics) + list(self.results.param_samples.columns)
+
+  def get_values(self, column):
+    """ Values of the column for every trial (selected or not) """
+    if column in self.results.scalar_metrics:
+      return np.asarray(self.results.scalar_metrics[column], dtype = np.float64)
+    if column in self.results.param_samples.columns:
+      return self.results.param_samples[column].to_numpy(dtype = np.float64)
+    raise ValueError(f'Unknown column: {column}')
+
+  def where(self, column, low = None, high = None, quantiles = False):
+    """ Keeps the trials whose `column` is in [low, high). If `quantiles`, `low` and `high` are
+        quantiles of the column among the trials kept so far. Returns a new query.
+    """
+    values = self.get_values(column)
+
+    bounds = [low, high]
+    if quantiles:
+      bounds = [None if q is None else self.get_quantiles(column, [q])[0] for q in bounds]
+    low_value, high_value = bounds
+
+    mask = self.mask.copy()
+    with np.errstate(invalid = 'ignore'):
+      if low_value is not None: mask &= (values >= low_value)
+      if high_value is not None: mask &= (values < high_value)
+
+    query = McQuery(self.results, self.weights, mask)
+    query.conditions = self.conditions + [(column, low, high, quantiles)]
+    return query
+
+  def get_count(self):
+    return int(np.sum(self.mask))
+
+  def get_probability(self):
+    """ Probability of the conditions (weighted share of the trials that meet them) """
+    return np.sum(self.weights[self.mask]) / np.sum(self.weights)
+
+  def get_quantiles(self, column, qs):
+    values = self.get_values(column)[self.mask]
+    weights = self.weights[self.mask]
+    return np.array([get_weighted_quantile(values, weights, q) for q in qs])
+
+  def get_mean(self, column):
+    values = self.get_values(column)[self.mask]
+    keep = ~np.isnan(values)
+    return np.average(values[keep], weights = self.weights[self.mask][keep]) if np.any(keep) else np.nan
+
+  def get_bins(self, column, bins = 10, spacing = 'quantile'):
+    """ Edges of `bins` bins of the column: of equal probability ('quantile'), equal width
+        ('linear') or equal width in log scale ('log'). An array of edges is returned as it is.
+    """
+    if not np.isscalar(bins):
+      return np.asarray(bins, dtype = np.float64)
+
+    if spacing == 'quantile':
+      return self.get_quantiles(column, np.linspace(0, 1, bins + 1))
+
+    values = self.get_values(column)[self.mask]
+    values = values[~np.isnan(values)]
+
+    if spacing == 'linear':
+      return np.linspace(np.min(values), np.max(values), bins + 1)
+    elif spacing == 'log':
+      return np.logspace(np.log10(np.min(values)), np.log10(np.max(values)), bins + 1)
+    raise ValueError("`spacing` must be one of 'quantile', 'linear' or 'log'")
+
+  def get_grouped_quantiles(self, column, by, qs = (0.1, 0.5, 0.9), bins = 10, spacing = 'quantile'):
+    """ Quantiles `qs` of `column` in each bin of `by` (see get_bins), as a DataFrame """
+    edges = self.get_bins(by, bins, spacing)
+
+    # (The last bin includes its upper edge)
+    by_values = self.get_values(by)
+    with np.errstate(invalid = 'ignore'):
+      inside = (by_values >= edges[0]) & (by_values <= edges[-1])
+    groups = np.where(self.mask & inside, np.digitize(by_values, edges[1:-1]), -1)
+
+    counts, quantiles = get_grouped_quantiles(groups, self.get_values(column), qs, len(edges) - 1, weights = self.weights)
+
+    table = pd.DataFrame({f'{by} from': edges[:-1], f'{by} to': edges[1:], 'Trials': counts})
+    for i, q in enumerate(qs):
+      table[f'{column} ({q:.0%})'] = quantiles[:, i]
+    return table
+
+  def describe_conditions(self, column_id_to_human = {}):
+    descriptions = []
+    for column, low, high, quantiles in self.conditions:
+      name = column_id_to_human.get(column, column)
+      format_bound = (lambda q: f'its {q:.0%} quantile') if quantiles else (lambda value: f'{value:.3g}')
+      if low is not None and high is not None:
+        descriptions.append(f'{name} between {format_bound(low)} and {format_bound(high)}')
+      elif low is not None:
+        descriptions.append(f'{name} over {format_bound(low)}')
+      elif high is not None:
+        descriptions.append(f'{name} under {format_bound(high)}')
+    return ', '.join(descriptions)
+
+def parse_condition(condition):
+  """ Parses a condition like "software_returns>=q0.9" or "full_automation_gns<2040" into
+      the arguments of McQuery.where (values starting with a "q" are quantiles)
+  """
+  match = re.fullmatch(r'\s*(\w+)\s*(>=|<)\s*(q?)([-+0-9.eE]+)\s*', condition)
+  if match is None:
+    raise ValueError(f'Invalid condition: "{condition}" (use COLUMN>=VALUE or COLUMN<VALUE; the VALUE can be a quantile, eg, q0.9)')
+
+  column, operator, quantile, value = match.groups()
+  value = float(value)
+  return {'column': column, 'low': value if operator == '>=' else None, 'high': value if operator == '<' else None, 'quantiles': bool(quantile)}
+
+def write_mc_query_report(quantity, conditions = [], by = None, bins = 10, spacing = 'quantile', quantiles = (0.1, 0.2, 0.5, 0.8, 0.9),
+    input_results_filename = None, results = None, report_file_path = None, report_dir_path = None, report = None):
+  """ Distribution of `quantity` given the `conditions` (see parse_condition), optionally by bins of `by` """
+
+  if report_file_path is None:
+    report_file_path = 'mc_query.html'
+
+  if not results:
+    results = read_mc_analysis_results(input_results_filename)
+
+  column_id_to_human = {**get_param_names(), **get_metric_names()}
+
+  query = McQuery(results)
+  for condition in conditions:
+    query = query.where(**parse_condition(condition))
+
+  log.info('Writing report...')
+  new_report = report is None
+  if new_report:
+    report = Report(report_file_path=report_file_path, report_dir_path=report_dir_path)
+
+  quantity_name = column_id_to_human.get(quantity, quantity)
+  given = query.describe_conditions(column_id_to_human)
+  report.add_paragraph(
+    f"Distribution of <span style='font-weight:bold'>{quantity_name}</span>" + (f" given {given}" if given else '') +
+    f": {query.get_count()} of the {results.n_trials} {pluralize('trial', results.n_trials)} ({query.get_probability():.1%})."
+  )
+
+  # Timelines metrics that aren't reached before the end of the simulations are stored as t_end
+  def format_value(value):
+    if quantity in SimulateTakeOff.timeline_metrics and value >= results.t_end:
+      return f'≥ {results.t_end}'
+    if not np.isfinite(value):
+      return '-'
+    # (The metrics are years or durations)
+    return f'{value:.1f}' if quantity in results.scalar_metrics else f'{value:.3g}'
+
+  all_trials = McQuery(results)
+  table = pd.DataFrame({
+    'Quantile': [f'{q:.0%}' for q in quantiles] + ['mean'],
+    'All trials': [format_value(v) for v in list(all_trials.get_quantiles(quantity, quantiles)) + [all_trials.get_mean(quantity)]],
+    'Given the conditions': [format_value(v) for v in list(query.get_quantiles(quantity, quantiles)) + [query.get_mean(quantity)]],
+  })
+  report.add_data_frame(table, show_index = False)
+
+  if by:
+    by_name = column_id_to_human.get(by, by)
+    report.add_header(f'{quantity_name} by {by_name}', level = 3)
+
+    grouped = query.get_grouped_quantiles(quantity, by, quantiles, bins, spacing)
+    for column in [f'{by} from', f'{by} to']:
+      grouped[column] = grouped[column].map(lambda value: f'{value:.3g}')
+    for q in quantiles:
+      grouped[f'{quantity} ({q:.0%})'] = grouped[f'{quantity} ({q:.0%})'].map(format_value)
+    grouped.columns = [column.replace(by, by_name, 1) if column.startswith(by) else column.replace(quantity, quantity_name, 1) for column in grouped.columns]
+    report.add_data_frame(grouped, show_index = False)
+
+    conditional_dist_graph(query.get_values(by)[query.mask], query.get_values(quantity)[query.mask], by_name, quantity_name,
+        xscale = 'log' if spacing == 'log' else 'linear')
+    report.add_figure()
+
+  if new_report:
+    report_path = report.write()
+    log.info(f'Report stored in {report_path}')
+
+  return query
+
+if __name__ == '__main__':
+  parser = init_cli_arguments()
+
+  parser.add_argument(
+    "--input-results-file",
+    required=True,
+    help="Directory with the results of the MC analysis (see the --output-results-file of mc_analysis)",
+  )
+
+  parser.add_argument(
+    "-q",
+    "--quantity",
+    required=True,
+    help="Metric or parameter whose distribution we want",
+  )
+
+  parser.add_argument(
+    "--condition",
+    action='append',
+    default=[],
+    help="Condition on the trials, as COLUMN>=VALUE or COLUMN<VALUE (eg, 'software_returns>=q0.9' for the top decile of software_returns). Can be given several times.",
+  )
+
+  parser.add_argument(
+    "--by",
+    default=None,
+    help="Show the distribution of the quantity in bins of this metric or parameter",
+  )
+
+  parser.add_argument(
+    "--bins",
+    type=int,
+    default=10,
+    help="Number of bins (with --by)",
+  )
+
+  parser.add_argument(
+    "--spacing",
+    choices=['quantile', 'linear', 'log'],
+    default='quantile',
+    help="Bins of equal probability, equal width or equal width in log scale (with --by)",
+  )
+
+  args = handle_cli_arguments(parser)
+
+  write_mc_query_report(
+    args.quantity,
+    conditions=args.condition,
+    by=args.by,
+    bins=args.bins,
+    spacing=args.spacing,
+    input_results_filename=args.input_results_file,
+    report_file_path=args.output_file,
+    report_dir_path=args.output_dir,
+  )
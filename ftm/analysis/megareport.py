@@ -5,11 +5,11 @@ from .report import Report
 from .exploration_analysis import explore
 from .sensitivity_analysis import write_sensitivity_analysis_report
 from .timelines_analysis import write_timelines_analysis_report
-from .mc_analysis import write_mc_analysis_report, McAnalysisResults
+from .mc_analysis import write_mc_analysis_report, mc_analysis, add_paired_differences_paragraph, McAnalysisResults
 
 def megareport(report_file_path=None, report_dir_path=None, quick_test_mode=False, report=None,
     mc_trials=None, mc_input_results_filename=None, mc_aggressive_input_results_filename=None, variance_reduction_params={}, variance_reduction_method=False):
-  if mc_trials is None: mc_trials = 100
+  n_trials = 4 if quick_test_mode and mc_trials is None else (mc_trials or 100)
   if report_file_path is None:
     report_file_path = 'megareport.html'
 
@@ -19,23 +19,28 @@ def megareport(report_file_path=None, report_dir_path=None, quick_test_mode=Fals
 
   report.begin_tab_group()
 
+  # Run the normal and the aggressive analyses together (with common random numbers), unless they were given
+  mc_results, mc_aggressive_results = None, None
+  if mc_input_results_filename is None and mc_aggressive_input_results_filename is None:
+    log.info('Running the Monte Carlo analyses')
+    log.indent()
+    mc_results, mc_aggressive_results = mc_analysis(n_trials = n_trials, paired = True)
+    log.deindent()
+    log.info()
+
   log.info('Generating Monte Carlo analysis tab')
   log.indent()
   report.begin_tab('Monte Carlo analysis', 'mc_analysis')
-  if quick_test_mode:
-    write_mc_analysis_report(report = report, n_trials = 4 if mc_trials is None else mc_trials, input_results_filename = mc_input_results_filename)
-  else:
-    write_mc_analysis_report(report = report, n_trials = mc_trials, input_results_filename = mc_input_results_filename)
+  write_mc_analysis_report(report = report, n_trials = n_trials, input_results_filename = mc_input_results_filename, results = mc_results)
   log.deindent()
   log.info()
 
   log.info('Generating aggressive Monte Carlo analysis tab')
   log.indent()
   report.begin_tab('Monte Carlo analysis (aggressive)', 'mc_analysis_aggressive')
-  if quick_test_mode:
-    write_mc_analysis_report(report = report, n_trials = 4 if mc_trials is None else mc_trials, input_results_filename = mc_aggressive_input_results_filename, aggressive = True)
-  else:
-    write_mc_analysis_report(report = report, n_trials = mc_trials, input_results_filename = mc_aggressive_input_results_filename, aggressive = True)
+  write_mc_analysis_report(report = report, n_trials = n_trials, input_results_filename = mc_aggressive_input_results_filename, aggressive = True, results = mc_aggressive_results)
+  if mc_results is not None:
+    add_paired_differences_paragraph(report, mc_results, mc_aggressive_results)
   log.deindent()
   log.info()
 
@@ -86,12 +91,12 @@ if __name__ == '__main__':
 
   parser.add_argument(
     "--mc-input-results-file",
-    help = 'Read the MC results from this file (pickle) instead of regenerating them',
+    help = 'Read the MC results from this directory (see mc_analysis --output-results-file) instead of regenerating them',
   )
 
   parser.add_argument(
     "--mc-aggressive-input-results-file",
-    help = 'Read the aggressive MC results from this file (pickle) instead of regenerating them',
+    help = 'Read the aggressive MC results from this directory (see mc_analysis --output-results-file) instead of regenerating them',
   )
 
   parser.add_argument(
@@ -8,12 +8,17 @@ import os
 import re
 import gzip
 import json
+import time
 import dill as pickle
 from multiprocessing import Pool
+from contextlib import nullcontext
 
 from . import log
 from . import *
 from ..stats.distributions import TakeoffParamsDist, PointDistribution, JointDistribution
+from ..core.perf import PerfCounters
+from ..core.cache import simulate
+from .work_queue import WorkQueue, run_worker
 
 main_metric = 'full_automation_gns'
 
@@ -45,7 +50,7 @@ def sensitivity_analysis(quick_test_mode = False, method = 'one_at_a_time', vari
     result = one_at_a_time_comparison(quick_test_mode = quick_test_mode, additional_columns = [['variance_reduction', var.table[main_metric]]])
     return result
 
-def variance_reduction_comparison(quick_test_mode = False, save_dir = None, restore_dir = None, method = 'variance_reduction_on_margin'):
+def variance_reduction_comparison(quick_test_mode = False, save_dir = None, restore_dir = None, queue_dir = None, method = 'variance_reduction_on_margin'):
   params_dist = TakeoffParamsDist(
       max_frac_automatable_tasks_goods = 0, max_frac_automatable_tasks_rnd = 0.05,
       use_ajeya_dist = False, ignore_rank_correlations = True, tradeoff_enabled = True, resampling_method = 'resample_all')
@@ -74,7 +79,7 @@ def variance_reduction_comparison(quick_test_mode = False, save_dir = None, rest
   param_importances, param_stds = get_parameter_importance(
       params_dist, get_parameter_importance_metrics, parameters = parameters, metric_arguments = metric_names,
       mean_samples = mean_samples, var_samples = var_samples, shapley_samples = shapley_samples, processes = processes,
-      save_dir = save_dir, restore_dir = restore_dir, method = method,
+      save_dir = save_dir, restore_dir = restore_dir, queue_dir = queue_dir, method = method,
   )
 
   if save_dir:
@@ -137,6 +142,9 @@ def one_at_a_time_comparison(quick_test_mode = False, additional_columns = []):
 
   parameter_count = len(parameter_table[parameter_table[['Conservative', 'Aggressive']].notna().all(1)])
 
+  # Aggregated profiling counters (if profiling is enabled)
+  perf = PerfCounters() if get_option('profile', False) else None
+
   table = []
   current_parameter_index = 0
   for parameter, row in parameter_table.iterrows():
@@ -158,16 +166,17 @@ def one_at_a_time_comparison(quick_test_mode = False, additional_columns = []):
     log.info(f"Running simulations for parameter '{parameter}' ({current_parameter_index + 1}/{parameter_count})...")
 
     log.info('  Conservative simulation...')
-    low_model = SimulateTakeOff(**low_params, dynamic_t_end = True)
-    low_model.run_simulation()
+    low_result = simulate(**low_params, dynamic_t_end = True)
 
     log.info('  Best guess simulation...')
-    med_model = SimulateTakeOff(**med_params, dynamic_t_end = True)
-    med_model.run_simulation()
+    med_result = simulate(**med_params, dynamic_t_end = True)
 
     log.info('  Aggressive simulation...')
-    high_model = SimulateTakeOff(**high_params, dynamic_t_end = True)
-    high_model.run_simulation()
+    high_result = simulate(**high_params, dynamic_t_end = True)
+
+    if perf is not None:
+      for simulation_result in [low_result, med_result, high_result]:
+        perf.merge(simulation_result.perf)
 
     log.info('  Collecting results...')
 
@@ -183,34 +192,34 @@ def one_at_a_time_comparison(quick_test_mode = False, additional_columns = []):
       'Parameter' : parameter,
     }
 
-    for metric in low_model.timeline_metrics:
-      result[f"{metric}"] = f"[{low_model.timeline_metrics[metric]:0.2f}, {med_model.timeline_metrics[metric]:0.2f}, {high_model.timeline_metrics[metric]:0.2f}]"
+    for metric in low_result.timeline_metrics:
+      result[f"{metric}"] = f"[{low_result.timeline_metrics[metric]:0.2f}, {med_result.timeline_metrics[metric]:0.2f}, {high_result.timeline_metrics[metric]:0.2f}]"
 
       if metric == 'agi_year':
         result["agi_year skew"] = skew(
-          high_model.agi_year,
-          med_model.agi_year,
-          low_model.agi_year
+          high_result.agi_year,
+          med_result.agi_year,
+          low_result.agi_year
         )
 
-    for metric in low_model.takeoff_metrics:
-      result[f"{metric}"] = f"[{low_model.takeoff_metrics[metric]:0.2f}, {med_model.takeoff_metrics[metric]:0.2f}, {high_model.takeoff_metrics[metric]:0.2f}]"
+    for metric in low_result.takeoff_metrics:
+      result[f"{metric}"] = f"[{low_result.takeoff_metrics[metric]:0.2f}, {med_result.takeoff_metrics[metric]:0.2f}, {high_result.takeoff_metrics[metric]:0.2f}]"
 
       if metric == 'full_automation_gns':
         result["full_automation_gns skew"] = skew(
-          high_model.takeoff_metrics[metric],
-          med_model.takeoff_metrics[metric],
-          low_model.takeoff_metrics[metric]
+          high_result.takeoff_metrics[metric],
+          med_result.takeoff_metrics[metric],
+          low_result.takeoff_metrics[metric]
         )
 
-    result["importance"] = np.abs(high_model.takeoff_metrics[main_metric] - low_model.takeoff_metrics[main_metric])
+    result["importance"] = np.abs(high_result.takeoff_metrics[main_metric] - low_result.takeoff_metrics[main_metric])
 
     def format_year(model, year):
       if year is None or np.isnan(year): return f'> {model.t_end}'
       return f"{year:0.2f}"
 
     # Add GWP doubling times
-    result["doubling_times"] = f"[{low_model.doubling_times[:4]}, {med_model.doubling_times[:4]}, {high_model.doubling_times[:4]}]"
+    result["doubling_times"] = f"[{low_result.doubling_times[:4]}, {med_result.doubling_times[:4]}, {high_result.doubling_times[:4]}]"
 
     table.append(result)
 
@@ -219,6 +228,12 @@ def one_at_a_time_comparison(quick_test_mode = False, additional_columns = []):
     if quick_test_mode and current_parameter_index >= 2:
       break
 
+  if perf is not None:
+    log.info('Simulation profile:')
+    log.indent()
+    log.info(perf)
+    log.deindent()
+
   table = pd.DataFrame(table)
   table = table.set_index('Parameter')
 
@@ -239,6 +254,7 @@ def one_at_a_time_comparison(quick_test_mode = False, additional_columns = []):
   results = SensitivityAnalysisResults()
   results.parameter_table = parameter_table
   results.table = table
+  results.perf = perf
 
   return results
 
@@ -390,7 +406,7 @@ def write_sensitivity_analysis_report(
 def get_parameter_importance(
     dist, get_metrics,
     mean_samples = 4, var_samples = 10, shapley_samples = 1, parameters = None, metric_arguments = None, processes = None,
-    save_dir = None, restore_dir = None, method = 'variance_reduction_on_margin'
+    save_dir = None, restore_dir = None, queue_dir = None, method = 'variance_reduction_on_margin'
   ):
 
   if parameters is None:
@@ -401,7 +417,7 @@ def get_parameter_importance(
 
   configured_g = lambda params: \
     g(dist, get_metrics, params, mean_samples = mean_samples, var_samples = var_samples,
-      metric_arguments = metric_arguments, processes = processes, save_dir = save_dir, restore_dir = restore_dir)
+      metric_arguments = metric_arguments, processes = processes, save_dir = save_dir, restore_dir = restore_dir, queue_dir = queue_dir)
 
   if method == 'variance_reduction_on_margin':
     log.info(f'Computing g_empty...')
@@ -467,9 +483,35 @@ def get_metric_values(get_metrics, dist, random_state, sample_count, conditions,
   metric_values = [get_metrics(s.to_dict(), metric_arguments) for _, s in conditional_samples.iterrows()]
   return metric_values, conditional_samples
 
-def g(dist, get_metrics, parameters, mean_samples = 1, var_samples = 10, processes = None, metric_arguments = None, save_dir = None, restore_dir = None):
+def get_metric_values_batch(queue_dir, context_name, tasks, sample_count):
+  """ Task of the work queue of g: get_metric_values for each (random_state, conditions) in `tasks` """
+  get_metrics, dist, metric_arguments = WorkQueue.get_context(queue_dir, context_name)
+  return [get_metric_values(get_metrics, dist, random_state, sample_count, conditions, metric_arguments) for random_state, conditions in tasks]
+
+def run_g_on_queue(queue_dir, get_metrics, dist, tasks, sample_count, metric_arguments, batch_size = 100):
+  """ Runs the (random_state, conditions) `tasks` of g through the work queue in `queue_dir` (see run_worker).
+      This process works on the queue too. Yields the results of get_metric_values in order.
+  """
+  queue = WorkQueue(queue_dir)
+  context_name = f'g_{os.getpid()}_{time.time_ns()}'
+  queue.put_context(context_name, (get_metrics, dist, metric_arguments))
+  task_ids = queue.add([
+    (get_metric_values_batch, (queue_dir, context_name, tasks[i:i + batch_size], sample_count))
+    for i in range(0, len(tasks), batch_size)
+  ])
+
+  log.info(f'Running the samples in the work queue in {queue_dir} (start more workers with python -m ftm.analysis.mc_analysis --worker {queue_dir})')
+  run_worker(queue_dir, wait = True)
+
+  for task_id in task_ids:
+    yield from queue.get_result(task_id)
+  queue.close()
+
+def g(dist, get_metrics, parameters, mean_samples = 1, var_samples = 10, processes = None, metric_arguments = None, save_dir = None, restore_dir = None, queue_dir = None):
   """
   Compute E[var(get_metrics | parameters)]
+
+  With a `queue_dir`, the outer samples are run by the workers of a work queue (see run_g_on_queue) instead of a local pool.
   """
 
   if restore_dir:
@@ -516,8 +558,20 @@ def g(dist, get_metrics, parameters, mean_samples = 1, var_samples = 10, process
 
   seeder = np.random.SeedSequence()
 
-  with Pool(processes = processes) as pool:
-    workers = []
+  tasks = [
+    (np.random.default_rng(seeder.spawn(1)[0]), {name: outer_sample[name] for name in parameters})
+    for row, outer_sample in outer_samples.iterrows()
+  ]
+
+  with (Pool(processes = processes) if not queue_dir else nullcontext()) as pool:
+    if queue_dir:
+      task_results = run_g_on_queue(queue_dir, get_metrics, dist, tasks, var_samples, metric_arguments)
+    else:
+      workers = [
+        pool.apply_async(get_metric_values, (get_metrics, dist, random_state, var_samples, conditions, metric_arguments))
+        for random_state, conditions in tasks
+      ]
+      task_results = (worker.get() for worker in workers)
 
     max_batch_size = 1000
     save_file_subindex = 0
@@ -556,17 +610,10 @@ def g(dist, get_metrics, parameters, mean_samples = 1, var_samples = 10, process
       metric_values_array.clear()
       conditional_samples_array.clear()
 
-    for row, outer_sample in outer_samples.iterrows():
-      worker = pool.apply_async(get_metric_values, (
-        get_metrics, dist, np.random.default_rng(seeder.spawn(1)[0]), var_samples, {name: outer_sample[name] for name in parameters}, metric_arguments
-      ))
-      workers.append(worker)
-
     vars = []
 
-    for i, worker in enumerate(workers):
+    for i, (metric_values, conditional_samples) in enumerate(task_results):
       log.info(f'Progress: {i:3}/{mean_samples}')
-      metric_values, conditional_samples = worker.get()
       vars += [np.var(metric_values, ddof = 1, axis = 0)]
 
       if save_dir:
@@ -608,6 +655,10 @@ if __name__ == '__main__':
   parser.add_argument(
     "--variance-reduction-save-dir",
   )
+  parser.add_argument(
+    "--variance-reduction-queue-dir",
+    help = "Run the samples through a work queue in this directory (start more workers with python -m ftm.analysis.mc_analysis --worker <dir>)",
+  )
   parser.add_argument(
     "-c",
     "--rank-correlations-url",
@@ -621,6 +672,7 @@ if __name__ == '__main__':
   variance_reduction_params = {
       'restore_dir': args.variance_reduction_restore_dir,
       'save_dir': args.variance_reduction_save_dir,
+      'queue_dir': args.variance_reduction_queue_dir,
   }
 
   write_sensitivity_analysis_report(report_file_path=args.output_file, report_dir_path=args.output_dir,
@@ -35,21 +35,21 @@ def write_timelines_analysis_report(report_file_path=None, report_dir_path=None,
   for group in results.scenario_groups:
     for scenario in group:
       row = {
-        **{f'FLOP to train AGI using {scenario.model.t_start} algorithms': f'{group.full_automation_reqs:.0e}'.replace('+', ''),
+        **{f'FLOP to train AGI using {scenario.result.t_start} algorithms': f'{group.full_automation_reqs:.0e}'.replace('+', ''),
            'Scenario' : scenario.name,
            'Training FLOP gap': f"{scenario.params['flop_gap_training']:.1e}"
         },
-        **scenario.model.timeline_metrics,
-        **scenario.model.takeoff_metrics,
+        **scenario.result.timeline_metrics,
+        **scenario.result.takeoff_metrics,
       }
       for metric in ['doubling_times']:
-        row[metric] = getattr(scenario.model, metric)
+        row[metric] = getattr(scenario.result, metric)
       table.append(row)
   table = pd.DataFrame(table)
 
   def nan_format(row, col, index_r, index_c, cell):
     if index_c in SimulateTakeOff.timeline_metrics:
-      return f'> {results.scenario_groups[0][0].model.t_end}'
+      return f'> {results.scenario_groups[0][0].result.t_end}'
     return '-'
 
   table_container = report.add_data_frame(table, show_index = False, nan_format = nan_format)
@@ -126,10 +126,10 @@ def write_timelines_analysis_report(report_file_path=None, report_dir_path=None,
   variable_names = get_variable_names()
 
   scenario = results.scenario_groups[0][0]
-  tr.append(et.fromstring(f'<th>FLOP to train AGI using {scenario.model.t_start} algorithms</th>'))
+  tr.append(et.fromstring(f'<th>FLOP to train AGI using {scenario.result.t_start} algorithms</th>'))
   tr.append(et.fromstring(f'<th>Scenario {report.generate_tooltip_html(scenario_tooltip_content, superscript = False)}</th>'))
   tr.append(et.fromstring(f'<th>Training FLOP gap</th>'))
-  for metric in scenario.model.get_summary_table().columns:
+  for metric in scenario.result.get_summary_table().columns:
     possible_suffixes = [' growth rate', ' doubling time', '']
     for suffix in possible_suffixes:
       if metric.endswith(suffix):
@@ -153,7 +153,7 @@ def write_timelines_analysis_report(report_file_path=None, report_dir_path=None,
   for group in results.scenario_groups:
     summaries_group = {}
     for scenario in group:
-      summary_table = scenario.model.get_summary_table().fillna('-')
+      summary_table = scenario.result.get_summary_table().fillna('-')
       summary_dict = summary_table.to_dict()
 
       # Humanize periods
@@ -165,7 +165,7 @@ def write_timelines_analysis_report(report_file_path=None, report_dir_path=None,
       }
       summary_dict['flop_gap_training'] = scenario.params['flop_gap_training']
       summary_dict['period'] = {k: human_period[v] for k, v in summary_dict['period'].items()}
-      summary_dict['year'] = {k: f'> {scenario.model.t_end}' if (v == '-') else v for k, v in summary_dict['year'].items()}
+      summary_dict['year'] = {k: f'> {scenario.result.t_end}' if (v == '-') else v for k, v in summary_dict['year'].items()}
 
       summaries_group[scenario.name] = summary_dict
       row_count = len(summary_table)
@@ -480,7 +480,7 @@ def timelines_analysis(report_file_path=None, report_dir_path=None):
 def plot_best_guesses_compute_increase():
   results = timelines_analysis()
   best_guesses_group = [scenario for group in results.scenario_groups for scenario in group if scenario.name == 'Best guess']
-  plot_compute_increase(best_guesses_group, get_label = lambda scenario: f'{scenario.model.full_automation_requirements_training} FLOP')
+  plot_compute_increase(best_guesses_group, get_label = lambda scenario: f'{scenario.result.full_automation_requirements_training} FLOP')
   plt.show()
 
 if __name__ == '__main__':
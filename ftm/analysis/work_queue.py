@@ -0,0 +1,224 @@
+"""
+Work queue shared through the filesystem, to spread an analysis over several machines.
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import tempfile
+import threading
+import traceback
+import dill as pickle
+from contextlib import contextmanager
+
+from . import log
+
+class TaskFailed(Exception):
+  pass
+
+class WorkQueue:
+  """ Queue of tasks in a directory of a shared filesystem: a SQLite database with the
+      state of the tasks, plus one file per result and per shared context.
+
+      A task is a (function, args) pair. Workers (see run_worker) lease the tasks for
+      `lease_time` seconds, and renew the leases while they work on them. If a worker dies,
+      its tasks go back to the queue when their leases expire.
+
+      Tasks must be idempotent: a task can be run twice (eg, by a worker that stalled
+      for longer than the lease time), in which case the last result wins.
+  """
+
+  db_file = 'queue.sqlite'
+
+  def __init__(self, path, lease_time = 600):
+    self.path = path
+    self.lease_time = lease_time
+
+    os.makedirs(os.path.join(path, 'results'), exist_ok = True)
+    os.makedirs(os.path.join(path, 'contexts'), exist_ok = True)
+
+    self.db = sqlite3.connect(os.path.join(path, WorkQueue.db_file), timeout = 60, isolation_level = None)
+    with self.transaction():
+      self.db.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+          id           INTEGER PRIMARY KEY,
+          payload      BLOB NOT NULL,
+          status       TEXT NOT NULL DEFAULT 'pending',
+          owner        TEXT,
+          lease_expiry REAL,
+          attempts     INTEGER NOT NULL DEFAULT 0,
+          error        TEXT
+        )
+      ''')
+
+  def close(self):
+    self.db.close()
+
+  @contextmanager
+  def transaction(self):
+    # BEGIN IMMEDIATE takes the write lock right away, so two workers can't claim the same task
+    self.db.execute('BEGIN IMMEDIATE')
+    try:
+      yield
+    except BaseException:
+      self.db.execute('ROLLBACK')
+      raise
+    self.db.execute('COMMIT')
+
+  def add(self, tasks):
+    """ Adds the (function, args) `tasks`. Returns their ids. """
+    with self.transaction():
+      return [self.db.execute('INSERT INTO tasks (payload) VALUES (?)', (pickle.dumps(task),)).lastrowid for task in tasks]
+
+  def get_task_ids(self):
+    return [row[0] for row in self.db.execute('SELECT id FROM tasks ORDER BY id')]
+
+  def claim(self, owner):
+    """ Leases the first pending task (or the first one whose lease expired).
+        Returns (id, function, args), or None if there are no tasks available.
+    """
+    now = time.time()
+    with self.transaction():
+      row = self.db.execute('''
+        SELECT id, payload FROM tasks
+        WHERE status = 'pending' OR (status = 'leased' AND lease_expiry < ?)
+        ORDER BY id LIMIT 1
+      ''', (now,)).fetchone()
+
+      if row is None:
+        return None
+
+      task_id, payload = row
+      self.db.execute(
+        "UPDATE tasks SET status = 'leased', owner = ?, lease_expiry = ?, attempts = attempts + 1 WHERE id = ?",
+        (owner, now + self.lease_time, task_id)
+      )
+
+    function, args = pickle.loads(payload)
+    return task_id, function, args
+
+  def renew(self, task_id, owner):
+    """ Extends the lease of the task. Returns False if the worker lost it. """
+    with self.transaction():
+      cursor = self.db.execute(
+        "UPDATE tasks SET lease_expiry = ? WHERE id = ? AND status = 'leased' AND owner = ?",
+        (time.time() + self.lease_time, task_id, owner)
+      )
+    return cursor.rowcount > 0
+
+  def complete(self, task_id, result):
+    # The result is in place before the task is marked as done
+    self._write_atomically(self.get_result_path(task_id), pickle.dumps(result))
+    with self.transaction():
+      self.db.execute("UPDATE tasks SET status = 'done', lease_expiry = NULL WHERE id = ?", (task_id,))
+
+  def fail(self, task_id, error):
+    with self.transaction():
+      self.db.execute("UPDATE tasks SET status = 'failed', lease_expiry = NULL, error = ? WHERE id = ?", (error, task_id))
+
+  def get_result_path(self, task_id):
+    return os.path.join(self.path, 'results', f'{task_id:08d}.pkl')
+
+  def get_result(self, task_id):
+    with open(self.get_result_path(task_id), 'rb') as f:
+      return pickle.load(f)
+
+  def get_counts(self):
+    """ Number of tasks in each status (pending, leased, done, failed) """
+    counts = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+    for status, count in self.db.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status'):
+      counts[status] = count
+    return counts
+
+  def check_failures(self):
+    row = self.db.execute("SELECT id, error FROM tasks WHERE status = 'failed' ORDER BY id LIMIT 1").fetchone()
+    if row is not None:
+      raise TaskFailed(f'Task {row[0]} of the queue in {self.path} failed:\n{row[1]}')
+
+  def is_finished(self):
+    counts = self.get_counts()
+    return counts['pending'] == 0 and counts['leased'] == 0
+
+  def put_context(self, name, obj):
+    """ Stores an object shared by many tasks (eg, a parameter distribution), so that it isn't pickled into each of them """
+    self._write_atomically(os.path.join(self.path, 'contexts', f'{name}.pkl'), pickle.dumps(obj))
+
+  _contexts = {}
+
+  @staticmethod
+  def get_context(path, name):
+    """ Reads the context stored with put_context (once per process) """
+    context_path = os.path.join(path, 'contexts', f'{name}.pkl')
+    key = (os.path.abspath(context_path), os.path.getmtime(context_path))
+    if key not in WorkQueue._contexts:
+      with open(context_path, 'rb') as f:
+        WorkQueue._contexts[key] = pickle.load(f)
+    return WorkQueue._contexts[key]
+
+  def _write_atomically(self, path, data):
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+      os.replace(tmp_path, path)
+    except BaseException:
+      if os.path.exists(tmp_path): os.remove(tmp_path)
+      raise
+
+@contextmanager
+def keep_leased(path, task_id, owner, lease_time):
+  """ Renews the lease of the task in the background while the body runs """
+  stop = threading.Event()
+
+  def renew():
+    queue = WorkQueue(path, lease_time)
+    while not stop.wait(lease_time / 3):
+      if not queue.renew(task_id, owner):
+        log.info(f'Lost the lease of task {task_id}')
+    queue.close()
+
+  thread = threading.Thread(target = renew, daemon = True)
+  thread.start()
+  try:
+    yield
+  finally:
+    stop.set()
+    thread.join()
+
+def run_worker(path, lease_time = 600, wait = False, poll_interval = 10):
+  """ Runs the tasks of the queue in `path` until there are none left.
+      If `wait`, also waits for the tasks leased by other workers to finish (taking them over if their leases expire).
+  """
+  queue = WorkQueue(path, lease_time)
+  owner = f'{socket.gethostname()}:{os.getpid()}'
+  tasks_done = 0
+
+  while True:
+    claimed = queue.claim(owner)
+
+    if claimed is None:
+      if wait and not queue.is_finished():
+        time.sleep(poll_interval)
+        continue
+      break
+
+    task_id, function, args = claimed
+    log.info(f'Running task {task_id} of the queue in {path}')
+    log.indent()
+    try:
+      with keep_leased(path, task_id, owner, lease_time):
+        result = function(*args)
+    except Exception:
+      # Other workers would fail the same way, so we don't requeue it
+      queue.fail(task_id, traceback.format_exc())
+      log.deindent()
+      raise
+    log.deindent()
+
+    queue.complete(task_id, result)
+    tasks_done += 1
+
+  queue.check_failures()
+  queue.close()
+  return tasks_done
@@ -0,0 +1,214 @@
+"""
+Caches of simulation results.
+
+Results are stored as SimulationResult files under `<cache_dir>/simulations`,
+keyed by a hash of the full parameter set of the simulation (after resolving
+the defaults and the time settings) and of the model code.
+
+The cache is disabled by default. Enable it with the `simulation_cache` option
+(or with --cache from the command line).
+
+SimulationMemo additionally deduplicates identical simulations within a process.
+"""
+
+import os
+import json
+import inspect
+import hashlib
+import tempfile
+
+from .model import SimulateTakeOff
+from .results import SimulationResult
+from .utils import get_option, NumpyJSONEncoder, log
+
+# Parameters that don't affect the results
+IGNORED_PARAMETERS = ['title', 'profile']
+
+_model_version = None
+
+def get_model_version():
+  """ Hash of the code that determines the results of a simulation """
+  global _model_version
+  if _model_version is None:
+    from . import model, results
+    h = hashlib.sha256()
+    for module in [model, results]:
+      with open(inspect.getsourcefile(module), 'rb') as f:
+        h.update(f.read())
+    _model_version = h.hexdigest()
+  return _model_version
+
+def get_simulation_parameters(params):
+  """ Returns the full set of parameters SimulateTakeOff(**params) would end up using """
+  full_params = {
+    name: parameter.default
+    for name, parameter in inspect.signature(SimulateTakeOff).parameters.items()
+    if parameter.default is not inspect.Parameter.empty
+  }
+  full_params.update(params)
+
+  # Resolve the defaults that come from the options (see SimulateTakeOff.__init__)
+  for name, default in SimulateTakeOff.option_defaults.items():
+    if full_params[name] is None:
+      full_params[name] = get_option(name, default)
+
+  if full_params['dynamic_t_end']:
+    full_params['t_end'] = None
+
+  for name in IGNORED_PARAMETERS:
+    full_params.pop(name, None)
+
+  return full_params
+
+def get_simulation_key(params):
+  key_object = {
+    'params': get_simulation_parameters(params),
+    'model_version': get_model_version(),
+  }
+  serialized = json.dumps(key_object, sort_keys = True, cls = NumpyJSONEncoder)
+  return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+class SimulationCache:
+  """ Content-addressed store of SimulationResults with LRU eviction """
+
+  extension = '.ftmr'
+
+  def __init__(self, cache_dir = None, max_size = None):
+    if cache_dir is None:
+      cache_dir = os.path.join(get_option('cache_dir'), 'simulations')
+
+    if max_size is None:
+      max_size = get_option('simulation_cache_max_size_mb', 512) * 2**20
+
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+
+    self.hits = 0
+    self.misses = 0
+
+  def get_path(self, key):
+    return os.path.join(self.cache_dir, key + SimulationCache.extension)
+
+  def get(self, key):
+    path = self.get_path(key)
+    try:
+      with open(path, 'rb') as f:
+        data = f.read()
+      result = SimulationResult.from_bytes(data)
+    except (OSError, ValueError):
+      self.misses += 1
+      return None
+
+    # Mark as recently used
+    try:
+      os.utime(path)
+    except OSError:
+      pass
+
+    self.hits += 1
+    return result
+
+  def put(self, key, result):
+    os.makedirs(self.cache_dir, exist_ok = True)
+
+    # Write atomically, so that concurrent readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir, suffix = '.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(result.to_bytes())
+      os.replace(tmp_path, self.get_path(key))
+    except BaseException:
+      if os.path.exists(tmp_path): os.remove(tmp_path)
+      raise
+
+    self.evict()
+
+  def evict(self):
+    """ Removes the least recently used entries until the cache fits in `max_size` """
+    entries = []
+    total_size = 0
+    for entry in os.scandir(self.cache_dir):
+      if entry.name.endswith(SimulationCache.extension):
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size += stat.st_size
+
+    entries.sort()
+    for mtime, size, path in entries:
+      if total_size <= self.max_size:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      total_size -= size
+
+  def clear(self):
+    if not os.path.isdir(self.cache_dir):
+      return
+    for entry in os.scandir(self.cache_dir):
+      if entry.name.endswith(SimulationCache.extension):
+        os.remove(entry.path)
+
+_cache = None
+
+def get_simulation_cache():
+  """ Returns the cache, or None if it's disabled """
+  global _cache
+
+  # Profiling runs want to actually run the simulations
+  if not get_option('simulation_cache', False) or get_option('profile', False):
+    return None
+
+  if _cache is None:
+    _cache = SimulationCache()
+  return _cache
+
+def with_title(result, params):
+  """ The title is not part of the key, so a stored result may carry the title of another run """
+  title = params.get('title')
+  if result.params.get('title') == title:
+    return result
+  return result.with_params(title = title)
+
+def simulate(**params):
+  """ Equivalent to SimulateTakeOff(**params).run_simulation(return_result = True),
+      but going through the cache (if enabled)
+  """
+  cache = get_simulation_cache()
+  if cache is None:
+    return SimulateTakeOff(**params).run_simulation(return_result = True)
+
+  key = get_simulation_key(params)
+  result = cache.get(key)
+  if result is not None:
+    log.trace(f'Simulation result read from the cache ({key[:12]})')
+    return with_title(result, params)
+
+  result = SimulateTakeOff(**params).run_simulation(return_result = True)
+  cache.put(key, result)
+
+  return result
+
+class SimulationMemo:
+  """ Per-process memo that avoids running twice simulations with identical parameters """
+
+  def __init__(self):
+    self.results = {}
+    self.requested = 0
+    self.saved = 0
+
+  def simulate(self, **params):
+    self.requested += 1
+
+    key = get_simulation_key(params)
+    if key in self.results:
+      self.saved += 1
+      return with_title(self.results[key], params)
+
+    result = simulate(**params)
+    self.results[key] = result
+    return result
+
+  def log_summary(self):
+    log.info(f'Simulations: {self.requested - self.saved} run, {self.saved} reused (identical parameters)')
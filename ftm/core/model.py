@@ -5,9 +5,11 @@ import pandas as pd
 import math
 import matplotlib.ticker as _mticker
 import os
+import time
 
 from . import utils
 from .utils import get_option, get_parameter_table, init_cli_arguments, handle_cli_arguments
+from .perf import PerfCounters
 
 # TODO Temporary really hacky way to handle the state (as a middle step in the transition to the final code)
 class StateDef:
@@ -30,6 +32,17 @@ class SimulateTakeOff():
         - We use a CES production function to estimate goods production
         - We use a CES production function to estimate rnd production
   """
+
+  # Values of the parameters that are read from the options when they are None
+  option_defaults = {
+    't_start': 2022,
+    't_end': 2100,
+    't_step': 0.1,
+    'disable_automation': False,
+    'profile': False,
+    'dynamic_t_end': False,
+  }
+
   def __init__(self,
 
       # Automation thesholds
@@ -139,6 +152,9 @@ class SimulateTakeOff():
 
       disable_automation = None,
 
+      # Accumulate per-phase timings in self.perf
+      profile = None,
+
       # Metadata
       title = None,
 
@@ -165,21 +181,33 @@ class SimulateTakeOff():
       cooldown_enabled = True,
       ):
 
-    if t_start is None: t_start = get_option('t_start', 2022)
-    if t_end   is None: t_end   = get_option('t_end',   2100)
-    if t_step  is None: t_step  = get_option('t_step',  0.1)
+    defaults = SimulateTakeOff.option_defaults
+
+    if t_start is None: t_start = get_option('t_start', defaults['t_start'])
+    if t_end   is None: t_end   = get_option('t_end',   defaults['t_end'])
+    if t_step  is None: t_step  = get_option('t_step',  defaults['t_step'])
+
+    if disable_automation is None: disable_automation = get_option('disable_automation', defaults['disable_automation'])
 
-    if disable_automation is None: disable_automation = get_option('disable_automation', False)
+    if profile is None: profile = get_option('profile', defaults['profile'])
 
-    if dynamic_t_end is None: dynamic_t_end = get_option('dynamic_t_end', False)
+    if dynamic_t_end is None: dynamic_t_end = get_option('dynamic_t_end', defaults['dynamic_t_end'])
 
     if dynamic_t_end:
       # We'll compute it at the end of the simulation
       t_end = None
 
     # Add all inputs to model parameters
+    self.input_parameters = {}
     for item in inspect.signature(SimulateTakeOff).parameters:
       setattr(self, item, eval(item))
+      self.input_parameters[item] = eval(item)
+
+    # Instrumentation
+    self.perf = None
+    if self.profile:
+      self.perf = PerfCounters()
+      self.perf.instrument(self)
 
     # Checks
     self.check_input_validity()
@@ -526,7 +554,12 @@ class SimulateTakeOff():
     self.state_lists = []
 
     self.state_list_len = 0
-    self.actual_state_list_len = int(100/self.t_step)
+
+    # Preallocate the whole run if we know how long it is (the state grows as needed anyway)
+    if self.dynamic_t_end or self.t_end is None:
+      self.actual_state_list_len = int(100/self.t_step)
+    else:
+      self.actual_state_list_len = max(1, int(np.ceil((self.t_end - self.t_start)/self.t_step)) + 1)
 
     for attribute, var_def in self.state_def.__dict__.items():
       if var_def.shape == ():
@@ -564,8 +597,14 @@ class SimulateTakeOff():
 
   ########################################################################
 
-  def run_simulation(self):
+  def run_simulation(self, return_result = False):
+    """ Runs the simulation. If `return_result` is True, returns a SimulationResult
+        (see `get_result`).
+    """
     # Treat NumPy's floating-point warnings as exceptions
+    if self.perf is not None:
+      start_time = time.perf_counter()
+
     with np.errstate(invalid = 'raise'):
       self.reset_state()
 
@@ -593,11 +632,40 @@ class SimulateTakeOff():
         self.n_timesteps = t_idx
         self.t_end = self.index_to_time(t_idx)
 
+    if self.perf is not None:
+      self.perf.record_run(time.perf_counter() - start_time, self.actual_state_list_len)
+
     self.post_process_state()
 
     # Compute takeoff metrics
     self.compute_metrics()
 
+    if return_result:
+      return self.get_result()
+
+  def get_no_automation_counterfactual(self, t_end):
+    """ Returns a (not yet run) simulation with the same inputs as this one, but in which
+        no task (besides the initial compute task) becomes automatable, from t_start to `t_end`
+    """
+    params = dict(self.input_parameters)
+    params.update(
+      full_automation_requirements_training = 1e100,
+      flop_gap_training = 2,
+      t_end = t_end,
+      dynamic_t_end = False,
+      t_end_min = None,
+      t_end_max = None,
+      compute_shares = False,
+    )
+    return SimulateTakeOff(**params)
+
+  def get_result(self, arrays = None):
+    """ Returns a slim, read-only copy of the results of the simulation,
+        with no references to the model.
+    """
+    from .results import SimulationResult
+    return SimulationResult.from_model(self, arrays)
+
   def continue_simulation(self, t_idx):
     t_year = self.index_to_time(t_idx)
 
@@ -874,7 +942,7 @@ class SimulateTakeOff():
     # Compute optimal task allocation
     self.labour_task_input_goods[t_idx][:], \
     self.compute_task_input_goods[t_idx][:] = \
-      SimulateTakeOff.solve_allocation(
+      self.solve_allocation(
           self.labour_goods[t_idx],
           self.compute_goods[t_idx],
           self.labour_task_weights_goods,
@@ -898,7 +966,7 @@ class SimulateTakeOff():
       self.cognitive_share_goods[t_idx], \
       self.labour_share_goods[t_idx],    \
       self.compute_share_goods[t_idx] =  \
-        SimulateTakeOff.compute_shares(
+        self._compute_shares(
             self.capital_goods[t_idx],
             self.labour_task_input_goods[t_idx],
             self.compute_task_input_goods[t_idx],
@@ -925,7 +993,7 @@ class SimulateTakeOff():
     # Compute optimal task allocation
     no_automation_labour_task_input_goods, \
     no_automation_compute_task_input_goods = \
-      SimulateTakeOff.solve_allocation(
+      self.solve_allocation(
           self.labour_goods[t_idx],
           self.compute_goods[t_idx],
           self.labour_task_weights_goods,
@@ -996,7 +1064,7 @@ class SimulateTakeOff():
     # Compute optimal task allocation
     self.labour_task_input_hardware_rnd[t_idx][:], \
     self.compute_task_input_hardware_rnd[t_idx][:] = \
-      SimulateTakeOff.solve_allocation(
+      self.solve_allocation(
           self.labour_hardware_rnd[t_idx],
           self.compute_hardware_rnd[t_idx],
           self.labour_task_weights_hardware_rnd,
@@ -1021,7 +1089,7 @@ class SimulateTakeOff():
       self.cognitive_share_hardware_rnd[t_idx], \
       self.labour_share_hardware_rnd[t_idx], \
       self.compute_share_hardware_rnd[t_idx] =\
-        SimulateTakeOff.compute_shares(
+        self._compute_shares(
             self.capital_hardware_rnd[t_idx],
             self.labour_task_input_hardware_rnd[t_idx],
             self.compute_task_input_hardware_rnd[t_idx],
@@ -1049,7 +1117,7 @@ class SimulateTakeOff():
     # Compute optimal task allocation
     no_automation_labour_task_input_rnd, \
     no_automation_compute_task_input_rnd = \
-      SimulateTakeOff.solve_allocation(
+      self.solve_allocation(
           self.labour_hardware_rnd[t_idx],
           self.compute_hardware_rnd[t_idx],
           self.labour_task_weights_hardware_rnd,
@@ -1122,7 +1190,7 @@ class SimulateTakeOff():
     # Compute optimal task allocation
     self.labour_task_input_software_rnd[t_idx][:], \
     self.compute_task_input_software_rnd[t_idx][:] = \
-      SimulateTakeOff.solve_allocation(
+      self.solve_allocation(
           self.labour_software_rnd[t_idx],
           self.compute_software_rnd[t_idx],
           self.labour_task_weights_software_rnd,
@@ -1142,7 +1210,7 @@ class SimulateTakeOff():
       self.cognitive_share_software_rnd[t_idx], \
       self.labour_share_software_rnd[t_idx], \
       self.compute_share_software_rnd[t_idx] =\
-        SimulateTakeOff.compute_shares(
+        self._compute_shares(
             self.compute_software_rnd_experiments[t_idx],
             self.labour_task_input_software_rnd[t_idx],
             self.compute_task_input_software_rnd[t_idx],
@@ -1175,7 +1243,7 @@ class SimulateTakeOff():
     # Compute optimal task allocation
     no_automation_labour_task_input_software_rnd, \
     no_automation_compute_task_input_software_rnd = \
-      SimulateTakeOff.solve_allocation(
+      self.solve_allocation(
           self.labour_software_rnd[t_idx],
           self.compute_software_rnd[t_idx],
           self.labour_task_weights_software_rnd,
@@ -1508,7 +1576,58 @@ class SimulateTakeOff():
     return result
 
   @staticmethod
-  def solve_allocation(L, C, β, ρ, η, AT):
+  def get_initial_frac_automatable_tasks(
+      full_automation_requirements_training, flop_gap_training, goods_vs_rnd_requirements_training,
+      runtime_training_tradeoff, runtime_training_max_tradeoff,
+      initial_hardware_production, ratio_hardware_to_initial_hardware_production, initial_biggest_training_run,
+      training_requirements_steepness = 0, n_labour_tasks = 100, **other_parameters):
+    """ Vectorized equivalent of frac_automatable_tasks_goods[0] and frac_automatable_tasks_rnd[0]
+        (after initialize_inputs() and automate_tasks(0)) for arrays of parameters, without building
+        the model. Returns NaN for the parameters the model can't be initialized with.
+    """
+    # The requirements (see process_automation_costs) are log-linear interpolations between the
+    # quantiles of quantiles_from_gap, so they are affine in log10(top) and log10(gap):
+    # log10(requirements) = log10(top) - log10(gap)/7 * exponents (with top = 1 and gap = 10^7, 10^-exponents)
+    q = np.linspace(0, 1, n_labour_tasks)
+    unit_quantiles = SimulateTakeOff.quantiles_from_gap(1, 10**7)
+    knots = sorted(unit_quantiles)
+    exponents = np.interp(q, knots, [-np.log10(unit_quantiles[knot]) for knot in knots])
+
+    log_gap   = np.log10(np.asarray(flop_gap_training, dtype = float))[..., np.newaxis]
+    steepness = np.asarray(training_requirements_steepness, dtype = float)[..., np.newaxis]
+
+    # Biggest training run at t_idx = 0 (see initialize_total_inputs and initialize_fractional_inputs)
+    compute = np.asarray(initial_hardware_production * ratio_hardware_to_initial_hardware_production, dtype = float)
+    biggest_training_run = compute * (initial_biggest_training_run / compute)
+    biggest_training_run = np.where(initial_biggest_training_run > compute, np.nan, biggest_training_run)
+
+    runtime_training_tradeoff = np.asarray(runtime_training_tradeoff, dtype = float)
+    tradeoff_enabled = ~((runtime_training_tradeoff <= 0) | np.isnan(runtime_training_tradeoff))
+    threshold = biggest_training_run * np.where(tradeoff_enabled, runtime_training_max_tradeoff, 1.)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+      log_threshold = np.log10(threshold)[..., np.newaxis]
+
+      def get_frac_automatable_tasks(full_requirements):
+        log_full = np.log10(np.asarray(full_requirements, dtype = float))[..., np.newaxis]
+        log_requirements = log_full - log_gap/7 * exponents
+
+        # See add_steepness
+        log_gap_low = log_full - log_gap
+        stepped = log_gap_low + np.ceil((log_requirements - log_gap_low)/steepness) * steepness
+        log_requirements = np.where(steepness == 0, log_requirements, np.minimum(stepped, log_full))
+
+        # The first task (whose requirements are 1) is always there, but we don't count it
+        automatable_tasks = np.sum(log_requirements < log_threshold, axis = -1) + (threshold > 1)
+        return np.where(np.isnan(threshold), np.nan, (automatable_tasks - 1) / n_labour_tasks)
+
+      frac_goods = get_frac_automatable_tasks(full_automation_requirements_training)
+      frac_rnd = get_frac_automatable_tasks(full_automation_requirements_training / goods_vs_rnd_requirements_training)
+
+    return frac_goods, frac_rnd
+
+  @staticmethod
+  def solve_allocation(L, C, β, ρ, η, AT, perf = None):
       """
       Solve the input allocation problem for
       L = Labour budget
@@ -1517,6 +1636,7 @@ class SimulateTakeOff():
       ρ = labour / capital substitution parameter
       η = compute / labour substitution ratio
       AT = number of automatable tasks
+      perf = optional PerfCounters where to accumulate the number of iterations
 
       See description of solution at the end of the notebook
       We assume that
@@ -1608,6 +1728,9 @@ class SimulateTakeOff():
       if np.all(labour_input_task==0):
         labour_input_task[-1] = L
 
+      if perf is not None:
+        perf.solve_allocation_iterations += I + 1
+
       return labour_input_task, compute_input_task
 
   @staticmethod
@@ -1751,6 +1874,9 @@ class SimulateTakeOff():
 
     return capital_share, cognitive_share, labour_share, compute_share
 
+  # Instances have to call compute_shares through this alias, as the name is shadowed by the flag
+  _compute_shares = compute_shares
+
   def ces_production_function(inputs, alphas, rho, tfp=1):
     return tfp*np.sum(alphas*(inputs**rho) / alphas.sum())**(1./rho)
 
@@ -2226,6 +2352,10 @@ if __name__ == "__main__":
 
   model.run_simulation()
 
+  if model.perf is not None:
+    print(model.perf)
+    print()
+
   # ----------------------------
   # Plot customisation settings
   # ----------------------------
@@ -0,0 +1,110 @@
+"""
+Per-phase profiling counters for SimulateTakeOff.
+"""
+
+import time
+import pandas as pd
+
+class PerfCounters:
+  """ Accumulates wall time and call counts per simulation phase.
+
+      Timings are inclusive: `production` includes the time spent in
+      `goods_production`, which includes the time spent in `solve_allocation`, etc.
+  """
+
+  # Phase -> name of the SimulateTakeOff attribute we instrument
+  phases = {
+    'continue_simulation':     'continue_simulation',
+    'tick':                    'tick',
+    'update_rnd':              'update_rnd',
+    'automate_tasks':          'automate_tasks',
+    'production':              'production',
+    'goods_production':        'goods_production',
+    'hardware_rnd_production': 'hardware_rnd_production',
+    'software_rnd_production': 'software_rnd_production',
+    'solve_allocation':        'solve_allocation',
+    'compute_shares':          '_compute_shares',
+  }
+
+  def __init__(self):
+    self.times = {phase: 0. for phase in self.phases}
+    self.calls = {phase: 0 for phase in self.phases}
+    self.solve_allocation_iterations = 0
+    self.peak_state_capacity = 0
+    self.total_time = 0.
+    self.n_runs = 0
+
+  def instrument(self, model):
+    """ Shadows the phase methods of the model with timed versions """
+    for phase, attribute in self.phases.items():
+      fn = getattr(model, attribute)
+      if phase == 'solve_allocation':
+        fn = self._with_iteration_count(fn)
+      setattr(model, attribute, self.timed(phase, fn))
+
+  def timed(self, phase, fn):
+    def timed_fn(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        self.times[phase] += time.perf_counter() - start
+        self.calls[phase] += 1
+    return timed_fn
+
+  def _with_iteration_count(self, fn):
+    def counted_fn(*args, **kwargs):
+      return fn(*args, **kwargs, perf = self)
+    return counted_fn
+
+  def record_run(self, run_time, state_capacity):
+    self.total_time += run_time
+    self.peak_state_capacity = max(self.peak_state_capacity, state_capacity)
+    self.n_runs += 1
+
+  def merge(self, other):
+    """ Adds the counters of `other` to these ones (useful to aggregate across trials) """
+    for phase in self.phases:
+      self.times[phase] += other.times[phase]
+      self.calls[phase] += other.calls[phase]
+    self.solve_allocation_iterations += other.solve_allocation_iterations
+    self.peak_state_capacity = max(self.peak_state_capacity, other.peak_state_capacity)
+    self.total_time += other.total_time
+    self.n_runs += other.n_runs
+    return self
+
+  def to_dict(self):
+    return {key: (value.copy() if isinstance(value, dict) else value) for key, value in self.__dict__.items()}
+
+  @staticmethod
+  def from_dict(d):
+    perf = PerfCounters()
+    for key, value in d.items():
+      setattr(perf, key, value.copy() if isinstance(value, dict) else value)
+    return perf
+
+  def get_table(self):
+    rows = []
+    for phase in self.phases:
+      calls = self.calls[phase]
+      rows.append({
+        'phase':        phase,
+        'calls':        calls,
+        'time (s)':     self.times[phase],
+        'per call (us)': 1e6 * self.times[phase] / calls if calls else 0.,
+        '% of run':     100 * self.times[phase] / self.total_time if self.total_time else 0.,
+      })
+    return pd.DataFrame(rows).set_index('phase')
+
+  def summary(self):
+    lines = []
+    lines.append(f'Profiled runs: {self.n_runs}, total time: {self.total_time:.3f} s')
+    lines.append(self.get_table().to_string(float_format = lambda x: f'{x:.3f}'))
+    calls = self.calls['solve_allocation']
+    mean_iterations = self.solve_allocation_iterations / calls if calls else 0.
+    lines.append(f'solve_allocation iterations: {self.solve_allocation_iterations} ({mean_iterations:.2f} per call)')
+    lines.append(f'Peak state capacity: {self.peak_state_capacity} timesteps')
+    return '\n'.join(lines)
+
+  def __str__(self):
+    return self.summary()
@@ -0,0 +1,203 @@
+"""
+Slim, read-only results of a simulation.
+"""
+
+import json
+import struct
+import numpy as np
+
+from .model import SimulateTakeOff
+from .perf import PerfCounters
+from .utils import NumpyJSONEncoder
+
+class SimulationResult:
+  """ What remains of a SimulateTakeOff run once the model is gone: the
+      parameters, a selection of (1D) state arrays, the metrics and a handful of scalars.
+
+      `params` holds the values of the parameters as the model used them (after
+      `process_input_parameters`), and `input_params` the values it was created
+      with (to run the simulation again).
+
+      It holds no reference to the model and can be serialized to a compact
+      binary blob with `to_bytes` (and back with `from_bytes`).
+
+      State arrays and parameters can be accessed as attributes (`result.gwp`,
+      `result.flop_gap_training`), so most of the code that consumes models
+      can consume results unchanged.
+  """
+
+  __slots__ = (
+    'params', 'input_params', 'arrays',
+    't_start', 't_end', 't_step', 't_idx', 'n_timesteps',
+    'timeline_metrics', 'takeoff_metrics', 'doubling_times',
+    'rampup_start', 'rampup_mid', 'cooldown_start', 'agi_year', 'sub_agi_year',
+    'perf',
+  )
+
+  scalars = ['t_start', 't_end', 't_step', 't_idx', 'n_timesteps', 'rampup_start', 'rampup_mid', 'cooldown_start', 'agi_year', 'sub_agi_year']
+
+  # Non-state arrays kept by default
+  extra_arrays = [
+    'gwp_growth',
+    'automation_training_flops_goods', 'automation_runtime_flops_goods',
+    'automation_training_flops_rnd', 'automation_runtime_flops_rnd',
+  ]
+
+  magic = b'FTMRES02'
+
+  def __init__(self, params, arrays, timeline_metrics, takeoff_metrics, doubling_times, perf = None, input_params = None, **scalars):
+    arrays = {name: SimulationResult._read_only(array) for name, array in arrays.items()}
+
+    if input_params is None:
+      input_params = params
+
+    object.__setattr__(self, 'params', dict(params))
+    object.__setattr__(self, 'input_params', dict(input_params))
+    object.__setattr__(self, 'arrays', arrays)
+    object.__setattr__(self, 'timeline_metrics', dict(timeline_metrics))
+    object.__setattr__(self, 'takeoff_metrics', dict(takeoff_metrics))
+    object.__setattr__(self, 'doubling_times', list(doubling_times))
+    object.__setattr__(self, 'perf', perf)
+    for name in SimulationResult.scalars:
+      object.__setattr__(self, name, scalars.get(name))
+
+  @staticmethod
+  def from_model(model, arrays = None):
+    """ Extracts the results of a model that has already been run.
+        `arrays` is the list of arrays to keep (by default, every 1D state array plus `extra_arrays`).
+    """
+    if arrays is None:
+      arrays = [name for name, var_def in model.state_def.__dict__.items() if var_def.shape == ()]
+      arrays += SimulationResult.extra_arrays
+
+    return SimulationResult(
+      params           = {name: getattr(model, name) for name in model.input_parameters},
+      input_params     = model.input_parameters,
+      arrays           = {name: getattr(model, name) for name in arrays},
+      timeline_metrics = model.timeline_metrics,
+      takeoff_metrics  = model.takeoff_metrics,
+      doubling_times   = model.doubling_times,
+      perf             = model.perf,
+      **{name: getattr(model, name) for name in SimulationResult.scalars},
+    )
+
+  def with_params(self, **params):
+    """ Returns a copy of the result (sharing the arrays) with some of the parameters replaced """
+    return SimulationResult(
+      params           = {**self.params, **params},
+      input_params     = {**self.input_params, **params},
+      arrays           = self.arrays,
+      timeline_metrics = self.timeline_metrics,
+      takeoff_metrics  = self.takeoff_metrics,
+      doubling_times   = self.doubling_times,
+      perf             = self.perf,
+      **{name: getattr(self, name) for name in SimulationResult.scalars},
+    )
+
+  @staticmethod
+  def _read_only(array):
+    array = np.ascontiguousarray(array)
+    if array.flags.writeable:
+      array = array.copy()
+      array.flags.writeable = False
+    return array
+
+  def __getattr__(self, name):
+    # Only called when the normal lookup fails
+    try:
+      arrays = object.__getattribute__(self, 'arrays')
+      if name in arrays:
+        return arrays[name]
+      params = object.__getattribute__(self, 'params')
+      if name in params:
+        return params[name]
+    except AttributeError:
+      pass
+    raise AttributeError(f"'SimulationResult' object has no attribute '{name}'")
+
+  def __setattr__(self, name, value):
+    raise AttributeError('SimulationResult objects are read-only')
+
+  def __delattr__(self, name):
+    raise AttributeError('SimulationResult objects are read-only')
+
+  def __reduce__(self):
+    # Pickle (eg, to send the result to another process) through the binary format
+    return (SimulationResult.from_bytes, (self.to_bytes(),))
+
+  #--------------------------------------------------------------------------
+  # Serialization
+  #--------------------------------------------------------------------------
+
+  # Layout: magic | header length (uint64) | JSON header | padding | arrays (each 8-byte aligned)
+
+  def to_bytes(self):
+    array_entries = []
+    chunks = []
+    offset = 0
+    for name, array in self.arrays.items():
+      array_entries.append([name, array.dtype.str, list(array.shape), offset])
+      data = array.tobytes()
+      chunks.append(data)
+      padding = -len(data) % 8
+      if padding: chunks.append(b'\0' * padding)
+      offset += len(data) + padding
+
+    header = {
+      'params':           self.params,
+      'input_params':     self.input_params,
+      'timeline_metrics': self.timeline_metrics,
+      'takeoff_metrics':  self.takeoff_metrics,
+      'doubling_times':   self.doubling_times,
+      'scalars':          {name: getattr(self, name) for name in SimulationResult.scalars},
+      'perf':             self.perf.to_dict() if (self.perf is not None) else None,
+      'arrays':           array_entries,
+    }
+    header = json.dumps(header, cls = NumpyJSONEncoder).encode('utf-8')
+    header += b' ' * (-(len(SimulationResult.magic) + 8 + len(header)) % 8)
+
+    return b''.join([SimulationResult.magic, struct.pack('<Q', len(header)), header] + chunks)
+
+  @staticmethod
+  def from_bytes(data):
+    """ The arrays of the returned result are views into `data` (no copies) """
+    magic = SimulationResult.magic
+    if data[:len(magic)] != magic:
+      raise ValueError('Not a serialized SimulationResult')
+
+    header_start = len(magic) + 8
+    header_len, = struct.unpack('<Q', data[len(magic):header_start])
+    header = json.loads(bytes(data[header_start:header_start + header_len]).decode('utf-8'))
+    data_start = header_start + header_len
+
+    arrays = {}
+    for name, dtype, shape, offset in header['arrays']:
+      dtype = np.dtype(dtype)
+      count = int(np.prod(shape))
+      arrays[name] = np.frombuffer(data, dtype = dtype, count = count, offset = data_start + offset).reshape(shape)
+
+    return SimulationResult(
+      params           = header['params'],
+      input_params     = header['input_params'],
+      arrays           = arrays,
+      timeline_metrics = header['timeline_metrics'],
+      takeoff_metrics  = header['takeoff_metrics'],
+      doubling_times   = header['doubling_times'],
+      perf             = PerfCounters.from_dict(header['perf']) if (header['perf'] is not None) else None,
+      **header['scalars'],
+    )
+
+  #--------------------------------------------------------------------------
+  # Model methods that only need the results
+  #--------------------------------------------------------------------------
+
+  time_to_index                               = SimulateTakeOff.time_to_index
+  index_to_time                               = SimulateTakeOff.index_to_time
+  plot                                        = SimulateTakeOff.plot
+  _plot_vlines                                = SimulateTakeOff._plot_vlines
+  plot_compute_decomposition                  = SimulateTakeOff.plot_compute_decomposition
+  plot_compute_decomposition_bioanchors_style = SimulateTakeOff.plot_compute_decomposition_bioanchors_style
+  get_summary_table                           = SimulateTakeOff.get_summary_table
+  display_summary_table                       = SimulateTakeOff.display_summary_table
+  get_takeoff_metrics                         = SimulateTakeOff.get_takeoff_metrics
+  display_takeoff_metrics                     = SimulateTakeOff.display_takeoff_metrics
@@ -1,6 +1,7 @@
 from . import utils
 from .utils import log, get_parameter_table, get_timelines_parameters
 from .model import SimulateTakeOff
+from .cache import SimulationMemo
 
 import numpy as np
 
@@ -8,6 +9,7 @@ class ScenarioRunner:
   def __init__(self):
     self.groups = None
     self.metrics = None
+    self.memo = SimulationMemo()
 
   def simulate_all_scenarios(self):
     parameter_table = get_parameter_table()
@@ -54,6 +56,8 @@ class ScenarioRunner:
 
     self.groups = groups
 
+    self.memo.log_summary()
+
     return groups
 
   def simulate_scenario_group(self, parameter_table, simulation_type = 'compare'):
@@ -106,25 +110,22 @@ class ScenarioRunner:
     high_params['dynamic_t_end'] = True
 
     log.info('  Conservative simulation')
-    low_model = SimulateTakeOff(**low_params)
-    low_model.run_simulation()
+    low_result = self.memo.simulate(**low_params)
 
     log.info('  Best guess simulation')
-    med_model = SimulateTakeOff(**med_params)
-    med_model.run_simulation()
+    med_result = self.memo.simulate(**med_params)
 
     log.info('  Aggressive simulation')
-    high_model = SimulateTakeOff(**high_params)
-    high_model.run_simulation()
+    high_result = self.memo.simulate(**high_params)
 
     # hacky
     if self.metrics is None:
-      self.metrics = [MetricDescription(name, name) for name in med_model.get_takeoff_metrics()]
+      self.metrics = [MetricDescription(name, name) for name in med_result.get_takeoff_metrics()]
 
     scenarios = [
-      Scenario('Conservative', low_model,  low_params),
-      Scenario('Best guess',   med_model,  med_params),
-      Scenario('Aggressive',   high_model, high_params),
+      Scenario('Conservative', low_result,  low_params),
+      Scenario('Best guess',   med_result,  med_params),
+      Scenario('Aggressive',   high_result, high_params),
     ]
 
     return scenarios
@@ -144,11 +145,11 @@ class ScenarioGroup:
     return len(self.scenarios)
 
 class Scenario:
-  def __init__(self, name, model, params):
+  def __init__(self, name, result, params):
     self.name    = name
-    self.model   = model
+    self.result  = result # SimulationResult
     self.params  = params
-    self.metrics = [Metric(name, value[0]) for name, value in model.get_takeoff_metrics().items()]
+    self.metrics = [Metric(name, value[0]) for name, value in result.get_takeoff_metrics().items()]
 
 class MetricDescription:
   def __init__(self, name, meaning):
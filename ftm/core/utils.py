@@ -6,6 +6,7 @@ import os
 import io
 import re
 import sys
+import json
 import math
 import yaml
 import inspect
@@ -292,7 +293,7 @@ def get_ajeya_dist(aggressive = False):
   global cached_ajeya_dist
   global cached_aggressive_ajeya_dist
 
-  cached_dist = cached_ajeya_dist if aggressive else cached_aggressive_ajeya_dist
+  cached_dist = cached_aggressive_ajeya_dist if aggressive else cached_ajeya_dist
 
   if cached_dist is None:
     url = get_option('aggressive_ajeya_dist_url' if aggressive else 'ajeya_dist_url')
@@ -312,20 +313,27 @@ def get_ajeya_dist(aggressive = False):
 
   return cached_dist.copy()
 
-def get_clipped_ajeya_dist(lower_bound, aggressive = False):
-  ajeya_dist = get_ajeya_dist(aggressive)
+def get_clipped_ajeya_dist(lower_bound, aggressive = False, ajeya_dist = None):
+  if ajeya_dist is None:
+    ajeya_dist = get_ajeya_dist(aggressive)
+  else:
+    ajeya_dist = ajeya_dist.copy()
 
-  if lower_bound:
+  if lower_bound and np.log10(lower_bound) > ajeya_dist.iloc[0, 0]:
     lower_bound = np.log10(lower_bound)
-    i = np.argmax(ajeya_dist.iloc[:, 0] >= lower_bound)
-    clip_p = ajeya_dist.iloc[i, 1]
+    v = ajeya_dist.iloc[:, 0].to_numpy(dtype = np.float64)
+    p = ajeya_dist.iloc[:, 1].to_numpy(dtype = np.float64)
+
+    # The CDF is piecewise linear in log10 FLOP, so the support can start right at the bound
+    clip_p = np.interp(lower_bound, v, p)
+    first_point = pd.DataFrame([[lower_bound, clip_p]], columns = ajeya_dist.columns)
 
-    # Clip...
-    ajeya_dist.iloc[i:, 1] -= clip_p
-    ajeya_dist.iloc[:i, 1] = 0
+    # Clip (replacing the points below the bound with the bound itself)...
+    ajeya_dist = pd.concat([first_point, ajeya_dist[v > lower_bound]], ignore_index = True)
+    ajeya_dist.iloc[:, 1] -= clip_p
 
     # ... and renormalize
-    ajeya_dist.iloc[i:, 1] /= ajeya_dist.iloc[-1, 1]
+    ajeya_dist.iloc[:, 1] /= ajeya_dist.iloc[-1, 1]
 
   return ajeya_dist
 
@@ -334,11 +342,11 @@ def set_ajeya_dist_url(url, aggressive = False):
   global cached_aggressive_ajeya_dist
 
   if aggressive:
-    set_option('ajeya_dist_url', url)
-    cached_ajeya_dist = None
-  else:
     set_option('aggressive_ajeya_dist_url', url)
     cached_aggressive_ajeya_dist = None
+  else:
+    set_option('ajeya_dist_url', url)
+    cached_ajeya_dist = None
 
 def get_rank_correlations():
   global cached_rank_correlations
@@ -512,6 +520,30 @@ def init_cli_arguments():
     help="Disable automation",
   )
 
+  parser.add_argument(
+    "--profile",
+    action='store_true',
+    default=None,
+    help="Accumulate per-phase timings of the simulations and print a breakdown at the end",
+  )
+
+  parser.add_argument(
+    "--cache",
+    dest='simulation_cache',
+    action='store_const',
+    const=True,
+    default=None,
+    help="Store the results of the simulations in the cache directory and reuse them in later runs",
+  )
+
+  parser.add_argument(
+    "--no-cache",
+    dest='simulation_cache',
+    action='store_const',
+    const=False,
+    help="Don't use the cache of simulation results, even if it's enabled in the config",
+  )
+
   return parser
 
 def handle_cli_arguments(parser):
@@ -545,6 +577,11 @@ def handle_cli_arguments(parser):
   if args.disable_automation:
     set_option('disable_automation', True)
 
+  if args.profile:
+    set_option('profile', True)
+
+  if args.simulation_cache is not None: set_option('simulation_cache', args.simulation_cache)
+
   if args.human_names is not None: set_option('human_names', args.human_names)
 
   if args.t_start is not None: set_option('t_start', args.t_start)
@@ -566,6 +603,15 @@ class InvalidCsvError(Exception):
 class InvalidZipError(Exception):
   pass
 
+class NumpyJSONEncoder(json.JSONEncoder):
+  """ JSON encoder that also understands NumPy scalars and arrays """
+  def default(self, obj):
+    if isinstance(obj, np.integer): return int(obj)
+    if isinstance(obj, np.floating): return float(obj)
+    if isinstance(obj, np.bool_): return bool(obj)
+    if isinstance(obj, np.ndarray): return obj.tolist()
+    return super().default(obj)
+
 
 def get_csv_from_sheet_url(url, usecols = None, skiprows = None):
   pattern = r'https://docs.google.com/spreadsheets/d/([a-zA-Z0-9-_]*)/.*\bgid\b=([0-9]*)?.*'
@@ -1,9 +1,10 @@
+from abc import ABC, abstractmethod
 import scipy.stats
 import numpy as np
 import pandas as pd
 from scipy.stats import rv_continuous
 from scipy.interpolate import interp1d
-from scipy.stats import multivariate_normal
+from scipy.stats import multivariate_normal, norm, qmc
 import statsmodels.distributions.copula.api as sm_api
 import statsmodels.distributions.copula.copulas as sm_copulas
 
@@ -17,7 +18,7 @@ class TakeoffParamsDist():
 
   def __init__(self, max_frac_automatable_tasks_goods = 0, max_frac_automatable_tasks_rnd = 0,
       ignore_rank_correlations = False, use_ajeya_dist = True, resampling_method = 'all_but_training_requirements',
-      tradeoff_enabled = True, parameter_table = None, aggressive = False):
+      tradeoff_enabled = True, parameter_table = None, aggressive = False, rank_correlations = None, ajeya_cdf = None):
 
     if resampling_method not in ('all_but_training_requirements', 'resample_all'):
       raise ValueError("`resampling_method` must be one of 'all_but_training_requirements' or 'resample_all'")
@@ -32,9 +33,12 @@ class TakeoffParamsDist():
 
     self.parameter_table = parameter_table
 
-    self.rank_correlations = get_rank_correlations()
+    if rank_correlations is None:
+      rank_correlations = get_rank_correlations()
 
-    self.marginals = self.get_marginals(parameter_table, use_ajeya_dist, use_aggressive_ajeya_dist = aggressive)
+    self.rank_correlations = rank_correlations
+
+    self.marginals = self.get_marginals(parameter_table, use_ajeya_dist, use_aggressive_ajeya_dist = aggressive, ajeya_cdf = ajeya_cdf)
 
     if ignore_rank_correlations:
       self.pairwise_rank_corr = {}
@@ -53,7 +57,7 @@ class TakeoffParamsDist():
         directions[parameter] = +1 if (row['Conservative'] < row['Aggressive']) else -1
     return directions
 
-  def get_marginals(self, parameter_table, use_ajeya_dist, use_aggressive_ajeya_dist):
+  def get_marginals(self, parameter_table, use_ajeya_dist, use_aggressive_ajeya_dist, ajeya_cdf = None):
     marginals = {}
     for parameter, row in parameter_table.iterrows():
       if not np.isnan(row['Conservative']) and not np.isnan(row['Aggressive']) and not row['Type'] == 'delta':
@@ -68,7 +72,7 @@ class TakeoffParamsDist():
       marginals[parameter] = marginal
 
     if use_ajeya_dist:
-      marginals['full_automation_requirements_training'] = AjeyaDistribution(aggressive = use_aggressive_ajeya_dist)
+      marginals['full_automation_requirements_training'] = AjeyaDistribution(aggressive = use_aggressive_ajeya_dist, cdf = ajeya_cdf)
     else:
       marginals['full_automation_requirements_training'] = SkewedLogUniform(
         parameter_table.at['full_automation_requirements_training', 'Conservative'],
@@ -107,74 +111,284 @@ class TakeoffParamsDist():
 
     return self.params_are_good(most_favorable_params)
 
-  def sample_is_good(self, pd_sample):
-    return self.params_are_good(pd_sample.to_dict())
+  def get_admissible_reqs_quantile(self, tolerance = 1e-6):
+    """ Quantile of the training requirements marginal below which the samples are inadmissible.
+        Admissibility is monotone in the training requirements, so we can find it by bisection.
+    """
+    if getattr(self, '_admissible_reqs_quantile', None) is None:
+      marginal = self.marginals['full_automation_requirements_training']
+      is_admissible = lambda q: self.sample_is_admissible(marginal.ppf(q))
+
+      low, high = 0, 1 - tolerance
+      if is_admissible(low):
+        high = low
+      elif not is_admissible(high):
+        raise ValueError('No value of the training requirements is admissible')
+
+      while high - low > tolerance:
+        mid = (low + high)/2
+        if is_admissible(mid):
+          high = mid
+        else:
+          low = mid
 
-  def params_are_good(self, params):
-    model = SimulateTakeOff(**params, t_start = 2022, t_end = 2023)
-    model.initialize_inputs()
-    model.automate_tasks(0)
+      self._admissible_reqs_quantile = high
 
-    return model.frac_automatable_tasks_goods[0] <= self.max_frac_automatable_tasks_goods \
-        and model.frac_automatable_tasks_rnd[0] <= self.max_frac_automatable_tasks_rnd
+    return self._admissible_reqs_quantile
 
-  def rvs(self, count, random_state = None, conditions = {}, resampling_method = None):
-    # statsmodels.distributions.copula.copulas throws an exception when we ask less than 2 samples from it.
-    # We could make this more efficient, but it's probably not worth it.
+  def get_admissible_reqs_marginal(self):
+    """ Training requirements marginal truncated to its admissible values """
+    if getattr(self, '_admissible_reqs_marginal', None) is None:
+      marginal = self.marginals['full_automation_requirements_training']
+      admissible_quantile = self.get_admissible_reqs_quantile()
 
-    if resampling_method is None: resampling_method = self.resampling_method
+      if admissible_quantile == 0:
+        self._admissible_reqs_marginal = marginal
+      elif isinstance(marginal, AjeyaDistribution):
+        # Same as TruncatedDistribution(marginal, admissible_quantile), but keeping the table of the CDF (eg, to store it in the MC results)
+        self._admissible_reqs_marginal = AjeyaDistribution(lower_bound = marginal.ppf(admissible_quantile), aggressive = marginal.aggressive, cdf = marginal.cdf_pd)
+      else:
+        self._admissible_reqs_marginal = TruncatedDistribution(marginal, admissible_quantile)
 
-    # TODO Simplify
+    return self._admissible_reqs_marginal
 
-    if resampling_method == 'all_but_training_requirements':
-      samples = []
-      for sample_index in range(count):
-        while True:
-          training_reqs_sample = self.marginals['full_automation_requirements_training'].rvs(count)
-          if self.sample_is_admissible(training_reqs_sample):
-            break
+  def get_stratified_reqs_quantiles(self, count, random_state = None):
+    """ Latin hypercube sample (in random order) of quantiles of the admissible training requirements
+        marginal (see get_admissible_reqs_marginal). Since every stratum has the same probability
+        under the truncated marginal, all the samples have the same weight.
+    """
+    rng = np.random.default_rng(random_state)
+    return (rng.permutation(count) + rng.random(count)) / count
+
+  def sample_is_good(self, pd_sample):
+    return self.params_are_good(pd_sample.to_dict())
+
+  def params_are_good(self, params):
+    return bool(self.samples_are_good(params))
+
+  def samples_are_good(self, samples):
+    """ Vectorized check of the initial fractions of automatable tasks.
+        `samples` maps each parameter to a value or to an array of values (eg, a DataFrame).
+    """
+    frac_goods, frac_rnd = SimulateTakeOff.get_initial_frac_automatable_tasks(**{name: np.asarray(samples[name]) for name in samples})
+    return (frac_goods <= self.max_frac_automatable_tasks_goods) & (frac_rnd <= self.max_frac_automatable_tasks_rnd)
 
-          log.trace('Inadmissible sample. Resampling.')
+  def get_good_probability(self, training_reqs, n_candidates = 1000, random_state = None):
+    """ Probability that a sample drawn conditional on each of the `training_reqs` is good
+        (estimated from `n_candidates` candidates each, with add-one smoothing so that it's never 0)
+    """
+    training_reqs = np.atleast_1d(training_reqs)
+    candidates = self.joint_dist.rvs(len(training_reqs) * n_candidates, random_state = random_state,
+        conditions = {'full_automation_requirements_training': np.repeat(training_reqs, n_candidates)})
+    good_counts = self.samples_are_good(candidates).reshape(len(training_reqs), n_candidates).sum(axis = 1)
+    return (good_counts + 1) / (n_candidates + 2)
+
+  def logpdf(self, samples, n_grid = 30, n_candidates = 1000, random_state = None):
+    """ Log density (up to a constant) of the distribution rvs() draws the `samples` (a DataFrame) from.
+        The parameters with point distributions are left out.
+
+        With the 'all_but_training_requirements' resampling method, the rest of the parameters are resampled
+        conditional on the training requirements, so the density is divided by the probability of drawing a
+        good sample for them (see get_good_probability). We estimate it at `n_grid` quantiles of the
+        training requirements and interpolate in between.
+    """
+    u = np.full((len(samples), len(self.marginals)), 0.5)
+    log_density = np.zeros(len(samples))
+    for name, marginal in self.marginals.items():
+      if isinstance(marginal, PointDistribution): continue
+      values = np.asarray(samples[name], dtype = np.float64)
+      u[:, self.joint_dist.dimension_names[name]] = marginal.cdf(values)
+      if name == 'full_automation_requirements_training' and self.resampling_method == 'all_but_training_requirements':
+        marginal = self.get_admissible_reqs_marginal()
+      with np.errstate(divide = 'ignore'):
+        log_density += marginal.logpdf(values)
+
+    # Same clipping as in GaussianCopula.rvs
+    u = 0.5 + (1 - 1e-10) * (u - 0.5)
+    log_density += self.joint_dist.wrapped.copula.logpdf(u)
+
+    if self.resampling_method == 'all_but_training_requirements':
+      reqs_marginal = self.get_admissible_reqs_marginal()
+      grid = reqs_marginal.ppf((np.arange(n_grid) + 0.5) / n_grid)
+      good_probability = self.get_good_probability(grid, n_candidates, random_state)
+      reqs = np.asarray(samples['full_automation_requirements_training'], dtype = np.float64)
+      log_density -= np.interp(np.log10(reqs), np.log10(grid), np.log(good_probability))
+
+    return np.where(self.samples_are_good(samples), log_density, -np.inf)
+
+  def rvs(self, count, random_state = None, conditions = {}, resampling_method = None, max_batch_size = 10000, antithetic = False):
+    """ Draws the candidates in batches, oversampling according to the acceptance rate observed so far.
+
+        If `antithetic`, the samples come in antithetic pairs (consecutive rows, see JointDistribution.rvs), including
+        the training requirements when they are drawn separately. Each sample of a pair is still resampled on its own
+        until it is good, so a pair stays antithetic as long as both of its first good candidates are mirror images.
+    """
 
-        sub_conditions = conditions.copy()
-        sub_conditions['full_automation_requirements_training'] = training_reqs_sample
+    if resampling_method is None: resampling_method = self.resampling_method
+    if antithetic and random_state is None: random_state = np.random.default_rng()
 
-        # Resample until we get a good sample
-        while True:
-        # statsmodels.distributions.copula.copulas throws an exception when we ask less than 2 samples from it
-          sample = self.joint_dist.rvs(2, random_state = random_state, conditions = sub_conditions).iloc[0]
-          if self.sample_is_good(sample):
-            break
+    names = list(self.marginals)
+    samples = np.full((count, len(names)), np.nan)
 
-          log.trace('Resampling')
+    def get_batch_size(needed, accepted, tried):
+      acceptance_rate = max((accepted + 1) / (tried + 1), 1e-3)
+      return int(min(max_batch_size, max(needed, np.ceil(1.2 * needed / acceptance_rate))))
 
-        samples.append(sample)
+    def get_uniforms(n, d):
+      """ Uniforms in antithetic pairs (u, 1 - u) if `antithetic` """
+      m = (n + 1)//2 if antithetic else n
+      u = random_state.random(m) if isinstance(random_state, UniformPoints) else random_state.random((m, d))
+      return np.stack([u, 1 - u], axis = 1).reshape(-1, d)[:n] if antithetic else u
 
-      return pd.DataFrame(samples)
+    if resampling_method == 'all_but_training_requirements':
+      # Draw the training requirements directly from their admissible values
+      reqs_marginal = self.get_admissible_reqs_marginal()
+      reqs_index = self.joint_dist.dimension_names['full_automation_requirements_training']
+
+      if isinstance(random_state, UniformPoints):
+        # Use the same point for the training requirements and for the first candidate for the rest of the parameters
+        uniforms = get_uniforms(count, random_state.d)
+        training_reqs = reqs_marginal.ppf(uniforms[:, reqs_index])
+      elif antithetic:
+        uniforms = None
+        training_reqs = reqs_marginal.ppf(get_uniforms(count, 1)[:, 0])
+      else:
+        uniforms = None
+        training_reqs = reqs_marginal.rvs(size = count, random_state = random_state)
+
+      # Resample each sample until it is good (conditional on its training requirements)
+      pending = np.arange(count)
+      accepted, tried = 0, 0
+      rounds = 0
+      while len(pending) > 0:
+        if uniforms is not None:
+          candidate_owners = [pending]
+          candidate_uniforms = [uniforms[pending]]
+          uniforms = None
+        else:
+          # Some training requirements are much harder to satisfy than the average, so we
+          # also grow the number of candidates geometrically with the number of rounds
+          repeats = get_batch_size(len(pending), accepted, tried) // len(pending)
+          repeats = max(1, min(max(repeats, 2**rounds), max_batch_size // len(pending)))
+
+          if antithetic:
+            # The pairs whose samples are both pending get mirrored candidates (in consecutive rows), the rest get independent ones
+            first = pending[(pending % 2 == 0) & np.isin(pending + 1, pending)]
+            singles = np.setdiff1d(pending, np.concatenate([first, first + 1]))
+            candidate_owners = [np.repeat(np.column_stack([first, first + 1]), repeats, axis = 0).ravel(), np.repeat(singles, repeats)]
+          else:
+            candidate_owners = [np.repeat(pending, repeats)]
+          candidate_uniforms = [random_state.random(len(owners)) if isinstance(random_state, UniformPoints) and not antithetic else None for owners in candidate_owners]
+
+        candidates = []
+        for i, (owners, owners_uniforms) in enumerate(zip(candidate_owners, candidate_uniforms)):
+          if len(owners) == 0: continue
+          sub_conditions = conditions.copy()
+          sub_conditions['full_automation_requirements_training'] = training_reqs[owners]
+          candidates.append(self.joint_dist.rvs(len(owners), random_state = random_state, conditions = sub_conditions,
+            uniforms = owners_uniforms, antithetic = antithetic and (i == 0) and (owners_uniforms is None)))
+        candidate_owners = np.concatenate(candidate_owners)
+        candidates = pd.concat(candidates, ignore_index = True) if len(candidates) > 1 else candidates[0]
+
+        good = self.samples_are_good(candidates)
+        tried += len(candidate_owners)
+
+        # Keep the first good candidate of each pending sample
+        good_owners, first_good = np.unique(candidate_owners[good], return_index = True)
+        samples[good_owners] = candidates[names].to_numpy()[np.nonzero(good)[0][first_good]]
+        accepted += len(good_owners)
+
+        pending = np.setdiff1d(pending, good_owners)
+        rounds += 1
+        if len(pending) > 0:
+          log.trace(f'Resampling {len(pending)} samples')
     else:
       # Resample all
+      # With antithetic pairs, the first (second) samples of the pairs are taken from the first (second) candidates of the candidate pairs
+      slots = [np.arange(0, count, 2), np.arange(1, count, 2)] if antithetic else [np.arange(count)]
+      filled = [0] * len(slots)
+      accepted, tried = 0, 0
+      while any(filled[i] < len(slots[i]) for i in range(len(slots))):
+        needed = max(len(slots[i]) - filled[i] for i in range(len(slots))) * len(slots)
+        batch_size = get_batch_size(needed, accepted, tried)
+        if antithetic: batch_size += batch_size % 2
+
+        candidates = self.joint_dist.rvs(batch_size, random_state = random_state, conditions = conditions, antithetic = antithetic)
+        good = self.samples_are_good(candidates)
+        tried += batch_size
+        accepted += np.sum(good)
+
+        # Only add the samples that make sense
+        candidate_values = candidates[names].to_numpy()
+        for i in range(len(slots)):
+          good_samples = candidate_values[i::len(slots)][good[i::len(slots)]][:len(slots[i]) - filled[i]]
+          samples[slots[i][filled[i]:filled[i] + len(good_samples)]] = good_samples
+          filled[i] += len(good_samples)
+
+    return pd.DataFrame(samples, columns = names)
+
+class UniformPoints(ABC):
+  """ Source of points in the unit hypercube that can be passed as `random_state`
+      to TakeoffParamsDist.rvs and JointDistribution.rvs in place of a random generator.
+      Each sample takes one point, whose coordinates are used as the uniforms of the
+      copula (one dimension per marginal, in the order of the marginals).
+  """
+  def __init__(self, d):
+    self.d = d
 
-      output_samples = pd.DataFrame(columns = [name for name in self.marginals], index = range(count), dtype = np.float64)
-      output_samples_count = 0
+  @abstractmethod
+  def random(self, n):
+    """ Returns the next `n` points, as an (n, d) array """
 
-      while output_samples_count < count:
-        samples_to_read = count - output_samples_count
+class QuasiRandomPoints(UniformPoints):
+  """ Scrambled low-discrepancy sequence ('sobol' or 'halton'), handed out in order """
 
-        # statsmodels.distributions.copula.copulas throws an exception when we ask less than 2 samples from it
-        # (hence the max)
-        # TODO Come on, fix that
-        samples = self.joint_dist.rvs(max(2, samples_to_read), random_state = random_state, conditions = conditions)[:samples_to_read]
+  def __init__(self, d, method = 'sobol', seed = None, block_size = 1024):
+    super().__init__(d)
 
-        for i, sample in samples.iterrows():
-          # Only add the sample if it makes sense
-          if not self.sample_is_good(sample):
-            continue
+    if method == 'sobol':
+      self.engine = qmc.Sobol(d, scramble = True, seed = seed)
+    elif method == 'halton':
+      self.engine = qmc.Halton(d, scramble = True, seed = seed)
+    else:
+      raise ValueError("`method` must be one of 'sobol' or 'halton'")
+
+    # We generate the points in blocks of a power of 2 (to preserve the balance properties of Sobol' sequences)
+    self.block_size = block_size
+    self.points = np.empty((0, d))
+
+  def random(self, n):
+    while len(self.points) < n:
+      self.points = np.concatenate([self.points, self.engine.random(self.block_size)])
+    points, self.points = self.points[:n], self.points[n:]
+    return points
+
+class PresetPoints(UniformPoints):
+  """ Hands out the given points, and then uniform random points from `rng` """
+
+  def __init__(self, points, rng = None):
+    points = np.atleast_2d(points)
+    super().__init__(points.shape[1])
+    self.points = points
+    self.rng = rng if (rng is not None) else np.random.default_rng()
+
+  def random(self, n):
+    points, self.points = self.points[:n], self.points[n:]
+    if len(points) < n:
+      points = np.concatenate([points, self.rng.random((n - len(points), self.d))])
+    return points
+
+class MirroredPoints(UniformPoints):
+  """ Hands out the points of another source of UniformPoints, mirrored (1 - u). Two samples drawn
+      from the same source, one of them through MirroredPoints, are antithetic.
+  """
 
-          # OK, looks good
-          output_samples.loc[output_samples_count] = samples.loc[i]
-          output_samples_count += 1
+  def __init__(self, points):
+    super().__init__(points.d)
+    self.source = points
 
-      return output_samples
+  def random(self, n):
+    return 1 - self.source.random(n)
 
 class BioAnchorsAGIDistribution():
   """
@@ -208,8 +422,10 @@ class BioAnchorsAGIDistribution():
 
 # TODO Change the name
 class AjeyaDistribution(rv_continuous):
-  def __init__(self, lower_bound = None, aggressive = False):
-    self.cdf_pd = get_clipped_ajeya_dist(lower_bound = lower_bound, aggressive = aggressive)
+  def __init__(self, lower_bound = None, aggressive = False, cdf = None):
+    """ `cdf` is a table of (log10 FLOP, probability) points (by default, the one in the workbook or in the Ajeya distribution sheet) """
+    self.aggressive = aggressive
+    self.cdf_pd = get_clipped_ajeya_dist(lower_bound = lower_bound, aggressive = aggressive, ajeya_dist = cdf)
 
     cdf = self.cdf_pd.to_numpy()
     self.v = cdf[:, 0]
@@ -225,41 +441,84 @@ class AjeyaDistribution(rv_continuous):
     # SciPy has a hard time computing the PPF from the CDF, so we are doing it ourselves
     return 10**interp1d(self.p, self.v)(p)
 
+  def _pdf(self, v):
+    # The CDF is piecewise linear in log10(v)
+    log_v = np.log10(v)
+    segment = np.clip(np.searchsorted(self.v, log_v, side = 'right') - 1, 0, len(self.v) - 2)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+      slope = np.diff(self.p)[segment] / np.diff(self.v)[segment]
+    return np.nan_to_num(slope) / (v * np.log(10))
+
+class TruncatedDistribution(rv_continuous):
+  """ `marginal` restricted to the values above its quantile `lower_quantile` """
+
+  def __init__(self, marginal, lower_quantile):
+    self.marginal = marginal
+    self.lower_quantile = lower_quantile
+    super().__init__(a = marginal.ppf(lower_quantile), b = marginal.b)
+
+  def _cdf(self, v):
+    return (self.marginal.cdf(v) - self.lower_quantile) / (1 - self.lower_quantile)
+
+  def _ppf(self, p):
+    return self.marginal.ppf(self.lower_quantile + p * (1 - self.lower_quantile))
+
+  def _pdf(self, v):
+    return self.marginal.pdf(v) / (1 - self.lower_quantile)
+
 class GaussianCopula(sm_api.GaussianCopula):
   def __init__(self, corr=None, k_dim=2):
     super().__init__(corr=corr, k_dim=k_dim)
     self.mu = np.zeros(len(corr))
 
-  def rvs(self, nobs=1, args=[], random_state=None):
+  def rvs(self, nobs=1, args=[], random_state=None, uniforms=None, antithetic=False):
+    """ `args` are the fixed values of the dimensions (NaN for the free ones). It can also be
+        an (nobs x k_dim) array to condition each sample on different values (the free dimensions
+        must be the same for all of them). See sample_normal_cond for `antithetic`.
+    """
     # The "0.5 + (1 - 1e-10) * (x - 0.5)" below is to ensure we pass to the normal ppf only values inside (0, 1).
     # TODO: Is this reasonable? sm_copulas.CopulaDistribution does the same
-    fixed_values = [self.distr_uv.ppf(0.5 + (1 - 1e-10) * (x - 0.5)) for x in args]
-    x = self.sample_normal_cond(values = fixed_values, nobs = nobs, random_state = random_state)
+    fixed_values = self.distr_uv.ppf(0.5 + (1 - 1e-10) * (np.asarray(args, dtype=np.float64) - 0.5))
+    x = self.sample_normal_cond(values = fixed_values, nobs = nobs, random_state = random_state, uniforms = uniforms, antithetic = antithetic)
     return self.distr_uv.cdf(x)
 
-  def sample_normal_cond(self, values=[], nobs=1, random_state=None):
-    # NOTE: Code by Ege (with some minor modifications)
+  def sample_normal_cond(self, values=[], nobs=1, random_state=None, uniforms=None, antithetic=False):
+    """ If `uniforms` (nobs x k_dim) is given, the free dimensions are computed from it
+        (through the Cholesky factor of the covariance) instead of being drawn at random.
+        `values` can be a vector or an (nobs x k_dim) array (see rvs). Returns an (nobs x k_dim) array.
 
-    S = []
-    D = []
-    a = []
+        If `antithetic`, the samples come in pairs (consecutive rows): the deviation from the (conditional)
+        mean of the free dimensions of the second one is minus the one of the first one. Only the first
+        row of each pair is drawn (or taken from `uniforms`).
+    """
+    # NOTE: Code by Ege (with some minor modifications)
 
-    values = np.array(values)
-    for count, q in enumerate(values):
-      if not np.isnan(q):
-        S.append(count)
-        a.append(q)
+    def sample_normal(cov, free_dims):
+      # Zero mean
+      n = (nobs + 1)//2 if antithetic else nobs
+      if uniforms is None:
+        z = multivariate_normal.rvs(mean=np.zeros(len(free_dims)), cov=cov, size=n, random_state=random_state)
+        z = np.reshape(z, (n, len(free_dims)))
       else:
-        D.append(count)
-    
-    if S == []:
-      return multivariate_normal.rvs(cov=self.corr, size=nobs, random_state=random_state)
-    elif D == []:
-      return []
-    else:
-      D = np.array(D, dtype=int)
-      S = np.array(S, dtype=int)
-      a = np.array(a)
+        z = norm.ppf(0.5 + (1 - 1e-10) * (np.asarray(uniforms)[:n, free_dims] - 0.5))
+        z = z @ np.linalg.cholesky(cov).T
+      if antithetic:
+        z = np.stack([z, -z], axis = 1).reshape(-1, len(free_dims))[:nobs]
+      return z
+
+    values = np.array(values, dtype=np.float64)
+    free = np.isnan(values if values.ndim == 1 else values[0])
+
+    D = np.nonzero(free)[0]
+    S = np.nonzero(~free)[0]
+
+    samples = np.empty((nobs, len(free)))
+    samples[:] = values
+
+    if len(S) == 0:
+      samples[:] = self.mu + sample_normal(self.corr, D)
+    elif len(D) > 0:
+      a = samples[:, S]
 
       mu_1 = self.mu[D]
       mu_2 = self.mu[S]
@@ -269,16 +528,13 @@ class GaussianCopula(sm_api.GaussianCopula):
       cov_21 = self.corr[S, :][:, D]
       cov_22 = self.corr[S, :][:, S]
 
-      mu_bar = mu_1 + np.dot(np.matmul(cov_12, np.linalg.inv(cov_22)), a - mu_2)
-      cov_bar = cov_11 - np.matmul(np.matmul(cov_12, np.linalg.inv(cov_22)), cov_21)
+      regression = np.matmul(cov_12, np.linalg.inv(cov_22))
+      mu_bar = mu_1 + (a - mu_2) @ regression.T
+      cov_bar = cov_11 - np.matmul(regression, cov_21)
 
-      samples = []
-      for s in multivariate_normal.rvs(mean=mu_bar, cov=cov_bar, size=nobs, random_state=random_state):
-        sample = values.copy()
-        sample[D] = s
-        samples.append(sample)
+      samples[:, D] = mu_bar + sample_normal(cov_bar, D)
 
-      return samples
+    return samples
 
 # NOTE: Code taken from https://github.com/tadamcz/copula-wrapper/blob/main/copula_wrapper/correlation_convert.py
 def get_pearsons_rho(kendall=None, spearman=None):
@@ -360,23 +616,39 @@ class JointDistribution(scipy.stats.rv_continuous):
         self.wrapped = sm_copulas.CopulaDistribution(copula_instance, marginals_list)
         self.wrapped.rank_correlation = rank_corr_matrix
 
-    def rvs(self, nobs=2, random_state=None, conditions={}):
+    def rvs(self, nobs=2, random_state=None, conditions={}, uniforms=None, antithetic=False):
+        """
+        `random_state` can also be a source of UniformPoints (eg, QuasiRandomPoints), in which case
+        `nobs` points are taken from it and used as the uniforms of the copula. Those can also be
+        passed directly in `uniforms` (array of shape (nobs, n)).
+
+        The values of the `conditions` can be arrays of size `nobs` (one value per sample).
+
+        If `antithetic`, the samples come in antithetic pairs (consecutive rows, see GaussianCopula.sample_normal_cond):
+        the normal scores of the free dimensions of the second sample are the mirror image of the ones of the first
+        one around their conditional mean. Only half of the randomness is drawn.
+        """
+        if isinstance(random_state, UniformPoints) and uniforms is None:
+          uniforms = random_state.random((nobs + 1)//2 if antithetic else nobs)
+
         # Get conditional values
         fixed_values = [marginal.cdf(conditions.get(name, np.nan)) for (name, marginal) in self.marginals.items()]
-
-        as_df = pd.DataFrame()
+        if any(np.ndim(value) > 0 for value in fixed_values):
+          fixed_values = np.column_stack([np.broadcast_to(value, nobs) for value in fixed_values])
 
         if np.any(np.isnan(fixed_values)):
-          rvs = self.wrapped.rvs(nobs=nobs, random_state=random_state, cop_args=fixed_values)
-          for name, i in self.dimension_names.items():
-              column = rvs[:, i]
-              as_df[name] = column
+          if uniforms is not None or antithetic:
+            # Same as self.wrapped.rvs, but with our uniforms (or antithetic pairs)
+            rvs = np.array(self.wrapped.copula.rvs(nobs=nobs, args=fixed_values, random_state=random_state, uniforms=uniforms, antithetic=antithetic), dtype=np.float64)
+            for i, marginal in enumerate(self.wrapped.marginals):
+              rvs[:, i] = marginal.ppf(0.5 + (1 - 1e-10) * (rvs[:, i] - 0.5))
+          else:
+            rvs = self.wrapped.rvs(nobs=nobs, random_state=random_state, cop_args=fixed_values)
         else:
-          for name, i in self.dimension_names.items():
-              column = np.full(nobs, conditions[name])
-              as_df[name] = column
+          rvs = np.column_stack([np.full(nobs, conditions[name]) for name in self.dimension_names])
 
-        return as_df
+        # (The dimensions are indexed in the order of the marginals)
+        return pd.DataFrame(rvs, columns=list(self.dimension_names))
 
     def cdf(self, **kwargs):
         return self.wrapped.cdf(self._to_tuple(kwargs))
@@ -496,6 +768,31 @@ class SkewedLogUniform(rv_continuous):
 
     return q
 
+  def _pdf(self, x):
+    # The transformed variable y is uniform on [low, med] and on [med, high] (with half of the probability each)
+    x = np.asarray(x, dtype = np.float64)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+      if self.kind == "frac":
+        y = np.log(x / (1. - x))
+        dy_dx = 1 / (x * (1. - x))
+      elif self.kind == "inv_frac":
+        y = -np.log(x - 1.)
+        dy_dx = -1 / (x - 1.)
+      elif self.kind == 'neg':
+        y = np.log(-x)
+        dy_dx = 1 / x
+      else:
+        y = np.log(x)
+        dy_dx = 1 / x
+
+    s = self.integration_direction
+    density = np.where(s*y < s*self.med, 1./2 / (self.med - self.low), 1./2 / (self.high - self.med)) * dy_dx
+
+    # Same truncation as in _ppf
+    inside = (s*y >= s*self.low) & (s*y <= s*self.high) & (x <= self.upper_bound)
+    return np.where(inside, density, 0) / self._cdf(self.upper_bound)
+
   def _ppf(self, q):
     upper_q = self._cdf(self.upper_bound)
     q = q * upper_q
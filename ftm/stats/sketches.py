@@ -0,0 +1,234 @@
+"""
+Streaming quantile sketches.
+"""
+
+import numpy as np
+
+class TrajectoryQuantileSketch:
+  """ Approximate per-timestep quantiles of a stream of (positive) trajectories.
+
+      Keeps, for each timestep, a histogram over a fixed grid of log10 bins,
+      so the memory doesn't grow with the number of trajectories. The grid
+      is chosen from the first `warmup` trajectories; values outside of it
+      go to an underflow/overflow bin. The exact per-timestep minimum and
+      maximum are tracked too. Zeros are counted separately.
+
+      The first `n_sample_paths` trajectories are kept as they are (eg, to
+      plot a few sample paths).
+  """
+
+  def __init__(self, n_timesteps, bins_per_decade = 50, warmup = 100, margin_decades = 2, max_bins = 4000, n_sample_paths = 20):
+    self.n_timesteps = n_timesteps
+    self.bins_per_decade = bins_per_decade
+    self.warmup = warmup
+    self.margin_decades = margin_decades
+    self.max_bins = max_bins
+    self.n_sample_paths = n_sample_paths
+
+    self.count = 0
+    self.sample_paths = []
+
+    self.log_min = None
+    self.log_max = None
+    self.counts = None   # (n_timesteps, n_bins + 2); bin 0 is the underflow bin and bin -1 the overflow bin
+    self.zeros = np.zeros(n_timesteps, dtype = np.int64)
+    self.nans  = np.zeros(n_timesteps, dtype = np.int64)
+    self.min = np.full(n_timesteps, np.inf)   # of the positive values
+    self.max = np.full(n_timesteps, -np.inf)
+
+    self._buffer = []
+
+  def add(self, path):
+    self.add_paths(np.asarray(path, dtype = np.float64)[np.newaxis, :self.n_timesteps])
+
+  def add_paths(self, paths):
+    """ Adds the rows of the (n_paths, n_timesteps) array `paths` (same as adding them one by one) """
+    paths = np.asarray(paths, dtype = np.float64)[:, :self.n_timesteps]
+    if paths.shape[1] < self.n_timesteps:
+      paths = np.concatenate([paths, np.full((len(paths), self.n_timesteps - paths.shape[1]), np.nan)], axis = 1)
+
+    self.count += len(paths)
+    missing_sample_paths = self.n_sample_paths - len(self.sample_paths)
+    if missing_sample_paths > 0:
+      self.sample_paths.extend(paths[:missing_sample_paths])
+
+    if self.counts is None:
+      warmup_paths = max(0, self.warmup - len(self._buffer))
+      self._buffer.extend(paths[:warmup_paths])
+      paths = paths[warmup_paths:]
+      if len(self._buffer) >= self.warmup:
+        self._init_grid()
+
+    if self.counts is not None and len(paths) > 0:
+      self._add_to_histogram(paths)
+
+  def _init_grid(self):
+    buffer = np.stack(self._buffer)
+    positive = buffer[(buffer > 0) & np.isfinite(buffer)]
+
+    if len(positive) > 0:
+      log_min = np.floor(np.log10(positive.min())) - self.margin_decades
+      log_max = np.ceil(np.log10(positive.max())) + self.margin_decades
+    else:
+      log_min, log_max = -1, 1
+
+    # Don't let a few outliers blow the memory up
+    n_bins = int((log_max - log_min) * self.bins_per_decade)
+    if n_bins > self.max_bins:
+      log_max = log_min + self.max_bins / self.bins_per_decade
+      n_bins = self.max_bins
+
+    self.log_min = log_min
+    self.log_max = log_max
+    self.counts = np.zeros((self.n_timesteps, n_bins + 2), dtype = np.int32)
+
+    self._add_to_histogram(buffer)
+    self._buffer = []
+
+  def _add_to_histogram(self, paths):
+    """ `paths` is a (n_paths, n_timesteps) array """
+    n_bins = self.counts.shape[1] - 2
+
+    zero = (paths == 0)
+    positive = (paths > 0)
+    nan = ~zero & ~positive
+
+    self.nans += np.sum(nan, axis = 0)
+    self.zeros += np.sum(zero, axis = 0)
+    self.min = np.minimum(self.min, np.min(np.where(positive, paths, np.inf), axis = 0))
+    self.max = np.maximum(self.max, np.max(np.where(positive, paths, -np.inf), axis = 0))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+      log_values = np.log10(paths)
+    bins = np.floor((log_values - self.log_min) * self.bins_per_decade)
+    bins = np.clip(np.nan_to_num(bins, nan = 0, posinf = n_bins, neginf = -1), -1, n_bins).astype(np.int64) + 1
+
+    # (Flat indices of the (timestep, bin) cells)
+    rows, timesteps = np.nonzero(positive)
+    cells = timesteps * self.counts.shape[1] + bins[rows, timesteps]
+    self.counts += np.bincount(cells, minlength = self.counts.size).reshape(self.counts.shape).astype(self.counts.dtype)
+
+  def flush(self):
+    """ Builds the histograms even if we are still in the warm-up phase """
+    if self.counts is None and self._buffer:
+      self._init_grid()
+
+  def _get_edges(self, minimum = None, maximum = None):
+    """ Lower and upper edges (log10) of the bins of each timestep (or of a single range) """
+    if minimum is None: minimum, maximum = self.min, self.max
+
+    n_bins = self.counts.shape[1] - 2
+    grid = self.log_min + np.arange(n_bins + 1) / self.bins_per_decade
+
+    with np.errstate(divide = 'ignore'):
+      log_min = np.log10(np.atleast_1d(minimum))
+      log_max = np.log10(np.atleast_1d(maximum))
+
+    lower = np.empty((len(log_min), n_bins + 2))
+    upper = np.empty((len(log_min), n_bins + 2))
+    lower[:, 1:-1] = grid[:-1]
+    upper[:, 1:-1] = grid[1:]
+    lower[:, 0]  = -np.inf
+    upper[:, 0]  = self.log_min
+    lower[:, -1] = self.log_max
+    upper[:, -1] = np.inf
+
+    # The bins that contain the minimum and the maximum end there
+    lower = np.maximum(lower, log_min[:, np.newaxis])
+    upper = np.minimum(upper, log_max[:, np.newaxis])
+    return lower, upper
+
+  @staticmethod
+  def _quantiles_from_counts(counts, lower, upper, qs):
+    """ counts, lower, upper: (n, bins). Returns (n, len(qs)), interpolating linearly within the bins. """
+    cumulative = np.cumsum(counts, axis = 1)
+    totals = cumulative[:, -1]
+
+    result = np.full((counts.shape[0], len(qs)), np.nan)
+    rows = np.arange(counts.shape[0])
+    for i, q in enumerate(qs):
+      rank = q * totals
+
+      # First bin that reaches the rank (skipping the empty bins)
+      bins = np.where(
+        rank < totals,
+        np.argmax(cumulative > rank[:, np.newaxis], axis = 1),
+        np.argmax(cumulative >= rank[:, np.newaxis], axis = 1),
+      )
+
+      bin_counts = counts[rows, bins]
+      bin_lower = lower[rows, bins]
+      bin_upper = upper[rows, bins]
+      previous = cumulative[rows, bins] - bin_counts
+
+      with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        frac = np.clip(np.nan_to_num((rank - previous) / bin_counts), 0, 1)
+        value = np.where(frac == 1, bin_upper, bin_lower + frac * (bin_upper - bin_lower))
+        result[:, i] = np.where((frac == 0) | (bin_lower == bin_upper), bin_lower, value)
+    result[totals == 0] = np.nan
+    return result
+
+  def get_quantiles(self, qs, zeros_on_top = False):
+    """ Returns a (n_timesteps, len(qs)) array with the approximate quantiles `qs` of each timestep.
+        Zeros are considered to be the smallest values, or the biggest ones if `zeros_on_top`.
+    """
+    self.flush()
+    qs = np.atleast_1d(qs)
+
+    if self.counts is None:
+      return np.full((self.n_timesteps, len(qs)), np.nan)
+
+    lower, upper = self._get_edges()
+
+    # Add the zeros as an extra bin
+    zero_edge = np.full((self.n_timesteps, 1), np.inf if zeros_on_top else -np.inf)
+    if zeros_on_top:
+      counts = np.hstack([self.counts, self.zeros[:, np.newaxis]])
+      lower  = np.hstack([lower, zero_edge])
+      upper  = np.hstack([upper, zero_edge])
+    else:
+      counts = np.hstack([self.zeros[:, np.newaxis], self.counts])
+      lower  = np.hstack([zero_edge, lower])
+      upper  = np.hstack([zero_edge, upper])
+
+    with np.errstate(invalid = 'ignore'):
+      return 10**TrajectoryQuantileSketch._quantiles_from_counts(counts, lower, upper, qs)
+
+  def get_global_quantile(self, q):
+    """ Approximate quantile `q` of the values of every timestep together (zeros included) """
+    self.flush()
+    if self.counts is None:
+      return np.nan
+
+    lower, upper = self._get_edges(self.min.min(), self.max.max())
+    counts = np.concatenate([[self.zeros.sum()], self.counts.sum(axis = 0)])
+    lower  = np.concatenate([[-np.inf], lower[0]])
+    upper  = np.concatenate([[-np.inf], upper[0]])
+
+    with np.errstate(invalid = 'ignore'):
+      return 10**TrajectoryQuantileSketch._quantiles_from_counts(counts[np.newaxis], lower[np.newaxis], upper[np.newaxis], [q])[0, 0]
+
+  def get_percentiles(self, percentiles, **kwargs):
+    return self.get_quantiles(np.asarray(percentiles)/100, **kwargs)
+
+  settings = ['n_timesteps', 'bins_per_decade', 'warmup', 'margin_decades', 'max_bins', 'n_sample_paths', 'count', 'log_min', 'log_max']
+  state_arrays = ['counts', 'zeros', 'nans', 'min', 'max']
+
+  def to_arrays(self):
+    """ Returns (settings, arrays), which from_arrays() turns back into the sketch (eg, to store it) """
+    self.flush()
+    settings = {name: getattr(self, name) for name in TrajectoryQuantileSketch.settings}
+    arrays = {name: getattr(self, name) for name in TrajectoryQuantileSketch.state_arrays if getattr(self, name) is not None}
+    arrays['sample_paths'] = np.array(self.sample_paths).reshape(-1, self.n_timesteps)
+    return settings, arrays
+
+  @staticmethod
+  def from_arrays(settings, arrays):
+    sketch = TrajectoryQuantileSketch(**{name: settings[name] for name in ['n_timesteps', 'bins_per_decade', 'warmup', 'margin_decades', 'max_bins', 'n_sample_paths']})
+    sketch.count = settings['count']
+    sketch.log_min = settings['log_min']
+    sketch.log_max = settings['log_max']
+    for name in TrajectoryQuantileSketch.state_arrays:
+      if name in arrays: setattr(sketch, name, arrays[name])
+    sketch.sample_paths = list(arrays['sample_paths'])
+    return sketch
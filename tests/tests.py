@@ -1,4 +1,8 @@
+import os
+import tempfile
+import time
 import unittest
+import unittest.mock
  
 import numpy as np
 import pandas as pd
@@ -6,9 +10,20 @@ from scipy import stats
 from ftm.core.utils import *
 from scipy.interpolate import interp1d
 from statsmodels.distributions.empirical_distribution import ECDF
-from ftm.stats.distributions import TakeoffParamsDist, PointDistribution, AjeyaDistribution
+from ftm.stats.distributions import TakeoffParamsDist, PointDistribution, AjeyaDistribution, GaussianCopula, QuasiRandomPoints, PresetPoints, MirroredPoints, UniformPoints
+from ftm.stats.sketches import TrajectoryQuantileSketch
 
 from ftm.core.model import *
+from ftm.core.perf import PerfCounters
+from ftm.core.results import SimulationResult
+from ftm.core.cache import SimulationCache, SimulationMemo, get_simulation_key, get_simulation_parameters, simulate
+from ftm.analysis import golden
+from ftm.analysis.work_queue import WorkQueue, TaskFailed, run_worker
+from ftm.analysis.mc_analysis import McCheckpoint, McAnalysisResults, FailureClassifier, get_metrics_before_full_automation, get_quantile_ci, get_proportion_ci, interpolate, \
+    get_doubling_indices, get_takeoff_probability_table, n_year_doubling_before_m_year_doubling, TAKEOFF_TABLE_SIZE, \
+    get_trajectory_percentiles, get_global_quantile, get_weighted_quantile, get_mc_params_dist, get_grouped_quantiles, \
+    MultiFidelityEstimator, get_ratio_variance, get_trial_units, init_trial_worker, run_trial, mc_analysis
+from ftm.analysis.mc_queries import McQuery, parse_condition
 
 class TestSimulateTakeoff(unittest.TestCase):
   
@@ -571,6 +586,140 @@ class TestParamsDistribution(unittest.TestCase):
           self.assertLessEqual(model.frac_automatable_tasks_goods[0], max_frac_automatable_tasks_goods)
           self.assertLessEqual(model.frac_automatable_tasks_rnd[0], max_frac_automatable_tasks_rnd)
 
+  def test_seeding(self):
+    dist = TakeoffParamsDist(max_frac_automatable_tasks_goods = 0, max_frac_automatable_tasks_rnd = 0.05)
+
+    seeds = np.random.SeedSequence(1234).spawn(3)
+    samples_a = [dist.rvs(1, random_state = np.random.default_rng(seed)) for seed in seeds]
+    samples_b = [dist.rvs(1, random_state = np.random.default_rng(seed)) for seed in seeds]
+
+    for sample_a, sample_b in zip(samples_a, samples_b):
+      pd.testing.assert_frame_equal(sample_a, sample_b)
+
+  def test_initial_frac_automatable_tasks(self):
+    samples = self.params_dist.joint_dist.rvs(200, random_state = np.random.default_rng(0))
+
+    frac_goods, frac_rnd = SimulateTakeOff.get_initial_frac_automatable_tasks(**samples)
+    for i, sample in samples.iterrows():
+      model = SimulateTakeOff(**sample.to_dict(), t_start = 2022, t_end = 2023)
+      model.initialize_inputs()
+      model.automate_tasks(0)
+      self.assertAlmostEqual(frac_goods[i], model.frac_automatable_tasks_goods[0])
+      self.assertAlmostEqual(frac_rnd[i], model.frac_automatable_tasks_rnd[0])
+
+  def test_initial_frac_automatable_tasks_with_steepness(self):
+    rng = np.random.default_rng(1)
+    samples = self.params_dist.joint_dist.rvs(100, random_state = rng)
+    samples['training_requirements_steepness'] = rng.choice([0, 0.1, 0.5, 1.3], size = len(samples))
+
+    frac_goods, frac_rnd = SimulateTakeOff.get_initial_frac_automatable_tasks(**samples)
+    for i, sample in samples.iterrows():
+      model = SimulateTakeOff(**sample.to_dict(), t_start = 2022, t_end = 2023)
+      model.initialize_inputs()
+      model.automate_tasks(0)
+      self.assertAlmostEqual(frac_goods[i], model.frac_automatable_tasks_goods[0])
+      self.assertAlmostEqual(frac_rnd[i], model.frac_automatable_tasks_rnd[0])
+
+  def test_stratified_reqs(self):
+    dist = TakeoffParamsDist(max_frac_automatable_tasks_goods = 0, max_frac_automatable_tasks_rnd = 0.05)
+
+    n = 50
+    quantiles = dist.get_stratified_reqs_quantiles(n, random_state = np.random.default_rng(0))
+
+    # One quantile per stratum
+    strata = np.floor(quantiles * n)
+    self.assertTrue(np.all(np.sort(strata) == np.arange(n)))
+
+  def test_stratified_reqs_retries(self):
+    # Prescreens the first candidate of the trial, so that it has to be resampled
+    class RejectFirst:
+      def __init__(self): self.calls = 0
+      def get_failure_probability(self, samples):
+        self.calls += 1
+        return np.array([1.0 if self.calls == 1 else 0.0])
+
+    dist = get_mc_params_dist()
+    reqs_marginal = dist.get_admissible_reqs_marginal()
+    init_trial_worker([dist], {
+      't_start': 2022, 't_end': 2030, 't_step': 0.1, 'n_trials': 1, 'max_retries': 5,
+      'failure_classifier': RejectFirst(), 'prescreen_threshold': 0.5,
+    })
+
+    reqs_quantile = 0.123
+    sample, result, _, failures = run_trial((0, 0, None, reqs_quantile))
+
+    self.assertEqual(len(failures), 1)
+    self.assertEqual(failures[0]['exception'], 'PrescreenedSample')
+    self.assertAlmostEqual(reqs_marginal.cdf(failures[0]['full_automation_requirements_training']), reqs_quantile)
+    self.assertAlmostEqual(reqs_marginal.cdf(sample['full_automation_requirements_training'][0]), reqs_quantile)
+
+  def test_admissible_reqs(self):
+    dist = TakeoffParamsDist(max_frac_automatable_tasks_goods = 0, max_frac_automatable_tasks_rnd = 0.05)
+
+    reqs_marginal = dist.get_admissible_reqs_marginal()
+    marginal = dist.marginals['full_automation_requirements_training']
+    self.assertGreater(reqs_marginal.a, marginal.a)
+    self.assertTrue(dist.sample_is_admissible(reqs_marginal.a))
+    self.assertFalse(dist.sample_is_admissible(marginal.ppf(dist.get_admissible_reqs_quantile() - 1e-3)))
+
+    samples = dist.rvs(5, random_state = np.random.default_rng(0))
+    self.assertTrue(np.all(samples['full_automation_requirements_training'] >= reqs_marginal.a))
+
+    # Same as the original marginal conditional on being admissible
+    q = dist.get_admissible_reqs_quantile()
+    reqs = np.logspace(np.log10(reqs_marginal.a), np.log10(reqs_marginal.b), 200)[1:-1]
+    self.assertTrue(np.allclose(reqs_marginal.cdf(reqs), (marginal.cdf(reqs) - q) / (1 - q)))
+
+  def test_common_random_numbers(self):
+    # Same random stream, different training requirements marginals (as in mc_analysis(paired = True))
+    dist = TakeoffParamsDist(max_frac_automatable_tasks_goods = 0, max_frac_automatable_tasks_rnd = 0.05)
+    other_dist = TakeoffParamsDist(max_frac_automatable_tasks_goods = 0, max_frac_automatable_tasks_rnd = 0.05, use_ajeya_dist = False)
+
+    for seed in range(10):
+      sample = dist.rvs(1, random_state = np.random.default_rng(seed))
+      other_sample = other_dist.rvs(1, random_state = np.random.default_rng(seed))
+
+      # The training requirements are at the same quantile of each admissible marginal
+      reqs = sample['full_automation_requirements_training'][0]
+      other_reqs = other_sample['full_automation_requirements_training'][0]
+      self.assertAlmostEqual(dist.get_admissible_reqs_marginal().cdf(reqs), other_dist.get_admissible_reqs_marginal().cdf(other_reqs))
+
+  def test_antithetic_pairs(self):
+    dist = TakeoffParamsDist(max_frac_automatable_tasks_goods = 0, max_frac_automatable_tasks_rnd = 0.05)
+    reqs_marginal = dist.get_admissible_reqs_marginal()
+
+    samples = dist.rvs(100, random_state = np.random.default_rng(0), antithetic = True)
+    self.assertFalse(samples.isna().any().any())
+    self.assertTrue(np.all(dist.samples_are_good(samples)))
+    q = reqs_marginal.cdf(samples['full_automation_requirements_training'].to_numpy())
+    self.assertTrue(np.allclose(q[0::2] + q[1::2], 1))
+
+    # A trial and its mirrored trial (as in mc_analysis(antithetic = True))
+    for seed in range(5):
+      source = lambda: PresetPoints(np.empty((0, len(dist.marginals))), np.random.default_rng(seed))
+      sample = dist.rvs(1, random_state = source())
+      mirrored_sample = dist.rvs(1, random_state = MirroredPoints(source()))
+      q = reqs_marginal.cdf([sample['full_automation_requirements_training'][0], mirrored_sample['full_automation_requirements_training'][0]])
+      self.assertAlmostEqual(q[0] + q[1], 1)
+
+  def test_importance_weights(self):
+    # Samples of one distribution reweighted to another one must look like samples of the second one
+    dist = get_mc_params_dist()
+    ajeya_cdf = dist.marginals['full_automation_requirements_training'].cdf_pd.copy()
+    ajeya_cdf.iloc[:, 0] += 0.5
+    other_dist = get_mc_params_dist(ajeya_cdf = ajeya_cdf)
+
+    samples = dist.rvs(5000, random_state = np.random.default_rng(0))
+    other_samples = other_dist.rvs(5000, random_state = np.random.default_rng(1))
+
+    log_weights = other_dist.logpdf(samples, random_state = 0) - dist.logpdf(samples, random_state = 0)
+    weights = np.exp(log_weights - np.max(log_weights))
+
+    for param in ['full_automation_requirements_training', 'flop_gap_training']:
+      for q in [0.1, 0.5, 0.9]:
+        reweighted = np.log10(get_weighted_quantile(samples[param], weights, q))
+        self.assertAlmostEqual(reweighted, np.log10(np.quantile(other_samples[param], q)), delta = 0.3)
+
   def ecdf(self, samples):
     result = ECDF(samples)
     result.x[0] = result.x[1] # get rid of -inf
@@ -582,6 +731,97 @@ class TestParamsDistribution(unittest.TestCase):
     return interp1d(cdf[1], cdf[0])
 
 class MiscTests(unittest.TestCase):
+  def test_takeoff_probability_table(self):
+    t_step = 0.1
+    rng = np.random.default_rng(0)
+
+    # Random GWP trajectories with accelerating growth
+    trajectories = []
+    for i in range(20):
+      growth = np.cumsum(rng.uniform(0, 0.01, 400)) * rng.uniform(0.01, 1)
+      trajectories.append(np.exp(np.cumsum(growth * t_step)))
+
+    doubling_indices = np.array([get_doubling_indices(gwp, t_step) for gwp in trajectories])
+    table = get_takeoff_probability_table(doubling_indices, t_step)
+
+    for n in range(1, TAKEOFF_TABLE_SIZE + 1):
+      for m in range(1, TAKEOFF_TABLE_SIZE + 1):
+        if n <= m:
+          self.assertTrue(np.isnan(table[n-1, m-1]))
+        else:
+          expected = np.mean([n_year_doubling_before_m_year_doubling(gwp, t_step, n, m) for gwp in trajectories])
+          self.assertEqual(table[n-1, m-1], expected)
+
+  def test_failure_classifier(self):
+    rng = np.random.default_rng(0)
+    samples = pd.DataFrame({'a': rng.uniform(size = 2000), 'b': rng.uniform(size = 2000), 'c': np.ones(2000)})
+
+    # The simulations fail when `a` is big
+    failed = samples['a'] > 0.8
+    failures = samples[failed].assign(exception = 'FloatingPointError')
+    classifier = FailureClassifier.fit(samples[~failed].reset_index(drop = True), failures)
+
+    self.assertNotIn('c', classifier.coefficients)
+    self.assertGreater(classifier.coefficients['a'], abs(classifier.coefficients['b']))
+
+    probabilities = classifier.get_failure_probability(pd.DataFrame({'a': [0.1, 0.95], 'b': [0.5, 0.5], 'c': [1, 1]}))
+    self.assertLess(probabilities[0], 0.1)
+    self.assertGreater(probabilities[1], 0.5)
+
+    self.assertIsNone(FailureClassifier.fit(samples, failures.iloc[:0]))
+
+  def test_truncated_ajeya_dist(self):
+    cdf = pd.DataFrame({'log10 FLOP': [24., 26., 28., 30., 32.], 'p': [0., 0.1, 0.4, 0.8, 1.]})
+    marginal = AjeyaDistribution(cdf = cdf)
+
+    # The bound falls between two points of the grid
+    bound = 10**27.3
+    truncated = AjeyaDistribution(lower_bound = bound, cdf = cdf)
+    self.assertAlmostEqual(truncated.a, bound, delta = 1e-6 * bound)
+
+    q = marginal.cdf(bound)
+    reqs = np.logspace(27.3, 32, 100)[1:-1]
+    self.assertTrue(np.allclose(truncated.cdf(reqs), (marginal.cdf(reqs) - q) / (1 - q)))
+    self.assertTrue(np.allclose(truncated.ppf([0.25, 0.5, 0.75]), marginal.ppf(q + np.array([0.25, 0.5, 0.75]) * (1 - q))))
+
+  def test_weighted_quantile(self):
+    rng = np.random.default_rng(0)
+    values = rng.normal(size = 101)
+
+    for q in [0, 0.1, 0.5, 0.99, 1]:
+      self.assertAlmostEqual(get_weighted_quantile(values, np.full(len(values), 3.0), q), np.quantile(values, q))
+
+    # Integer weights are the same as repeating the values
+    weights = rng.integers(1, 4, size = len(values))
+    repeated = np.repeat(values, weights)
+    self.assertAlmostEqual(get_weighted_quantile(values, weights, 0.5), np.median(repeated), delta = np.ptp(values) / 50)
+
+  def test_trajectory_percentiles(self):
+    rng = np.random.default_rng(0)
+    data = 10**rng.normal(20, 3, (500, 40))
+    data[rng.uniform(size = data.shape) < 0.05] = 0
+    percentiles = np.linspace(0, 100, 7)
+    transform = lambda chunk: np.where(chunk == 0, 1e30, chunk)
+
+    reference = np.array([[np.percentile(transform(data[:, t]), p) for p in percentiles] for t in range(data.shape[1])])
+    for max_chunk_size in [1, 1000, 2**24]:
+      self.assertTrue(np.array_equal(get_trajectory_percentiles(data, percentiles, transform, max_chunk_size = max_chunk_size), reference))
+
+    # The global quantile is exact for small arrays, and approximated with a sketch for the big ones
+    self.assertEqual(get_global_quantile(data, 0.95), np.quantile(data, 0.95))
+    self.assertAlmostEqual(np.log10(get_global_quantile(data, 0.95, max_chunk_size = 1000)), np.log10(np.quantile(data, 0.95)), delta = 0.02)
+
+  def test_interpolate(self):
+    xp = np.linspace(2022, 2030, 81)
+    fp = 10**np.cumsum(np.random.default_rng(0).uniform(0, 0.1, len(xp)))
+    x = np.concatenate([np.linspace(2010, 2040, 300), xp])
+
+    reference = interp1d(xp, np.log10(fp), fill_value = 'extrapolate')(x)
+    self.assertTrue(np.allclose(interpolate(x, xp, fp, logarithmic = True), reference, rtol = 1e-12))
+
+    reference = interp1d(xp, fp, fill_value = 'extrapolate')(x)
+    self.assertTrue(np.allclose(interpolate(x, xp, fp), reference, rtol = 1e-12))
+
   def test_process_quantiles(self):
     np.random.seed(0)
 
@@ -681,3 +921,568 @@ class TestTradeoff(unittest.TestCase):
       actual_reqs = SimulateTakeOff.compute_runtime_requirements(runtime_training_tradeoff, training_reqs, runtime_reqs, biggest_training_run)
 
       self.assertTrue(np.abs((actual_reqs[0] - runtime_reqs[0])/runtime_reqs[0]) < 1e-9)
+
+class BaselineParametersTestCase(unittest.TestCase):
+  """ Tests that run the model with the parameters of updated_baseline.json """
+  def setUp(self):
+    json_path = os.path.join(os.path.dirname(__file__), '..', 'updated_baseline.json')
+    _, self.parameters = load_parameters_from_json(json_path)
+
+class TestProfiling(BaselineParametersTestCase):
+  def test_profiling_does_not_change_results(self):
+    model = SimulateTakeOff(**self.parameters, t_end = 2030)
+    model.run_simulation()
+    self.assertIsNone(model.perf)
+
+    profiled_model = SimulateTakeOff(**self.parameters, t_end = 2030, profile = True)
+    profiled_model.run_simulation()
+    self.assertTrue(np.all(model.gwp == profiled_model.gwp))
+
+    perf = profiled_model.perf
+    self.assertEqual(perf.calls['tick'], profiled_model.n_timesteps)
+    self.assertEqual(perf.calls['solve_allocation'], 6 * profiled_model.n_timesteps)
+    self.assertGreaterEqual(perf.solve_allocation_iterations, perf.calls['solve_allocation'])
+    self.assertGreaterEqual(perf.peak_state_capacity, profiled_model.n_timesteps)
+
+  def test_merge(self):
+    models = [SimulateTakeOff(**self.parameters, t_end = 2025, profile = True) for i in range(2)]
+    for model in models: model.run_simulation()
+
+    perf = PerfCounters().merge(models[0].perf).merge(models[1].perf)
+    self.assertEqual(perf.n_runs, 2)
+    self.assertEqual(perf.calls['tick'], models[0].perf.calls['tick'] + models[1].perf.calls['tick'])
+
+class TestNoAutomationCounterfactual(BaselineParametersTestCase):
+  def test_counterfactual(self):
+    model = SimulateTakeOff(**self.parameters, t_end = 2030, compute_shares = False)
+    counterfactual = model.get_no_automation_counterfactual(t_end = model.t_start + 1.05)
+    counterfactual.run_simulation()
+
+    parameters = {**self.parameters, 'full_automation_requirements_training': 1e100, 'flop_gap_training': 2}
+    reference = SimulateTakeOff(**parameters, t_start = model.t_start, t_end = model.t_start + 2.1)
+    reference.run_simulation()
+
+    n = counterfactual.n_timesteps
+    self.assertEqual(counterfactual.timesteps[-1], reference.timesteps[n-1])
+    self.assertTrue(np.all(counterfactual.gwp == reference.gwp[:n]))
+    self.assertTrue(np.all(counterfactual.frac_tasks_automated_goods < 1))
+
+class TestSimulationResult(BaselineParametersTestCase):
+  def test_result_matches_model(self):
+    model = SimulateTakeOff(**self.parameters, t_end = 2035)
+    result = model.run_simulation(return_result = True)
+
+    self.assertTrue(np.all(result.gwp == model.gwp))
+    self.assertTrue(np.all(result.timesteps == model.timesteps))
+    self.assertEqual(result.flop_gap_training, self.parameters['flop_gap_training'])
+    self.assertEqual(result.timeline_metrics, model.timeline_metrics)
+    self.assertTrue(result.get_summary_table().equals(model.get_summary_table()))
+
+    # Parameters are accessed with their processed values, and the inputs are kept to run it again
+    self.assertEqual(result.hardware_returns, model.hardware_returns)
+    self.assertEqual(result.runtime_training_tradeoff, model.runtime_training_tradeoff)
+    self.assertEqual(result.input_params['hardware_returns'], self.parameters['hardware_returns'])
+    self.assertNotEqual(result.hardware_returns, result.input_params['hardware_returns'])
+    rerun = SimulateTakeOff(**result.input_params).run_simulation(return_result = True)
+    self.assertTrue(np.all(rerun.gwp == result.gwp))
+
+    # Read-only
+    with self.assertRaises(AttributeError):
+      result.t_end = 2100
+    with self.assertRaises(ValueError):
+      result.gwp[0] = 0
+
+  def test_serialization(self):
+    result = SimulateTakeOff(**self.parameters, t_end = 2035).run_simulation(return_result = True)
+    restored = SimulationResult.from_bytes(result.to_bytes())
+
+    self.assertEqual(restored.params, result.params)
+    self.assertEqual(restored.input_params, result.input_params)
+    self.assertEqual(restored.timeline_metrics, result.timeline_metrics)
+    self.assertEqual(restored.takeoff_metrics, result.takeoff_metrics)
+    self.assertEqual(restored.doubling_times, result.doubling_times)
+    self.assertEqual(restored.rampup_start, result.rampup_start)
+    for name, array in result.arrays.items():
+      self.assertEqual(restored.arrays[name].dtype, array.dtype)
+      self.assertTrue(np.array_equal(restored.arrays[name], array))
+
+class TestSimulationCache(BaselineParametersTestCase):
+  def test_keys(self):
+    key = get_simulation_key(self.parameters)
+
+    # Explicit defaults and metadata don't change the key
+    self.assertEqual(key, get_simulation_key({**self.parameters, 't_step': get_option('t_step'), 'title': 'foo'}))
+
+    # The rest of the parameters do
+    self.assertNotEqual(key, get_simulation_key({**self.parameters, 't_step': 1}))
+    self.assertNotEqual(key, get_simulation_key({**self.parameters, 'flop_gap_training': 2*self.parameters['flop_gap_training']}))
+
+  def test_put_get_and_eviction(self):
+    result = SimulateTakeOff(**self.parameters, t_end = 2025).run_simulation(return_result = True)
+    size = len(result.to_bytes())
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache = SimulationCache(cache_dir, max_size = 2.5 * size)
+      self.assertIsNone(cache.get('a'))
+
+      cache.put('a', result)
+      self.assertTrue(np.all(cache.get('a').gwp == result.gwp))
+
+      cache.put('b', result)
+      os.utime(cache.get_path('a'), (0, 0)) # make 'a' the least recently used
+      cache.put('c', result)
+
+      self.assertIsNone(cache.get('a'))
+      self.assertIsNotNone(cache.get('b'))
+      self.assertIsNotNone(cache.get('c'))
+
+  def test_memo(self):
+    memo = SimulationMemo()
+    result_1 = memo.simulate(**self.parameters, t_end = 2025)
+    result_2 = memo.simulate(**{**self.parameters, 'title': 'copy'}, t_end = 2025)
+    result_3 = memo.simulate(**self.parameters, t_end = 2026)
+
+    self.assertIs(result_1.gwp, result_2.gwp)
+    self.assertEqual(result_2.params['title'], 'copy')
+    self.assertIsNot(result_1.gwp, result_3.gwp)
+    self.assertIs(result_1, memo.simulate(**self.parameters, t_end = 2025))
+    self.assertEqual(memo.requested, 4)
+    self.assertEqual(memo.saved, 2)
+
+  def test_title_of_cached_results(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache = SimulationCache(cache_dir)
+      key = get_simulation_key({**self.parameters, 't_end': 2025})
+      cache.put(key, SimulateTakeOff(**self.parameters, t_end = 2025, title = 'first').run_simulation(return_result = True))
+
+      with unittest.mock.patch('ftm.core.cache.get_simulation_cache', return_value = cache):
+        result = simulate(**self.parameters, t_end = 2025, title = 'second')
+
+      self.assertEqual(cache.hits, 1)
+      self.assertEqual(result.params['title'], 'second')
+      self.assertEqual(cache.get(key).params['title'], 'first')
+
+  def test_option_defaults(self):
+    full_params = get_simulation_parameters(self.parameters)
+    for name in ['t_start', 't_step', 'disable_automation', 'dynamic_t_end']:
+      self.assertEqual(full_params[name], get_option(name, SimulateTakeOff.option_defaults[name]))
+
+class TestGoldenTrajectories(BaselineParametersTestCase):
+  def setUp(self):
+    super().setUp()
+    self.corpus = {
+      'baseline':    {**self.parameters, 't_end': 2030},
+      't_step_1':    {**self.parameters, 't_end': 2030, 't_step': 1},
+    }
+
+  def test_compare(self):
+    class PerturbedEngine(SimulateTakeOff):
+      def __init__(self, **kwargs):
+        kwargs['hardware_returns'] = kwargs['hardware_returns'] * (1 + 1e-6)
+        super().__init__(**kwargs)
+
+    with tempfile.TemporaryDirectory() as golden_dir:
+      golden.record(golden_dir, self.corpus)
+
+      divergences = golden.compare(golden_dir)
+      self.assertTrue(all(d.ok for d in divergences))
+
+      divergences = golden.compare(golden_dir, engine = PerturbedEngine, cases = ['baseline'])
+      self.assertFalse(divergences[0].ok)
+      self.assertIsNotNone(divergences[0].step)
+      self.assertIn('hardware_performance', divergences[0].variables)
+
+      # Loose enough tolerances hide the perturbation
+      divergences = golden.compare(golden_dir, engine = PerturbedEngine, cases = ['baseline'], default_rtol = 1e-3)
+      self.assertTrue(divergences[0].ok)
+
+class TestTrajectoryQuantileSketch(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.default_rng(0)
+    n_trials, n_timesteps = 2000, 50
+    growth = np.linspace(0, 20, n_timesteps) * rng.uniform(0.5, 1.5, (n_trials, 1))
+    self.data = 10**(rng.normal(30, 3, (n_trials, 1)) + growth)
+
+  def test_quantiles(self):
+    sketch = TrajectoryQuantileSketch(self.data.shape[1], n_sample_paths = 5)
+    for path in self.data:
+      sketch.add(path)
+
+    percentiles = np.array([0, 10, 50, 90, 100])
+    approx = sketch.get_percentiles(percentiles)
+
+    # Exact at the extremes
+    self.assertTrue(np.allclose(approx[:, [0, -1]], np.percentile(self.data, [0, 100], axis = 0).T))
+
+    # Within a bin of the empirical quantiles in the interior
+    bin_width = 1/sketch.bins_per_decade
+    lower = np.percentile(self.data, percentiles[1:-1] - 0.5, axis = 0).T
+    upper = np.percentile(self.data, percentiles[1:-1] + 0.5, axis = 0).T
+    self.assertTrue(np.all(np.log10(approx[:, 1:-1]) >= np.log10(lower) - bin_width))
+    self.assertTrue(np.all(np.log10(approx[:, 1:-1]) <= np.log10(upper) + bin_width))
+
+    self.assertLess(abs(np.log10(sketch.get_global_quantile(0.95)/np.quantile(self.data, 0.95))), bin_width)
+
+    self.assertEqual(len(sketch.sample_paths), 5)
+    self.assertTrue(np.all(sketch.sample_paths[0] == self.data[0]))
+
+  def test_zeros(self):
+    self.data[:100, 10] = 0
+
+    sketch = TrajectoryQuantileSketch(self.data.shape[1])
+    for path in self.data:
+      sketch.add(path)
+
+    self.assertEqual(sketch.get_quantiles([0])[10, 0], 0)
+    self.assertEqual(sketch.get_quantiles([1], zeros_on_top = True)[10, 0], np.inf)
+
+  def test_add_paths(self):
+    self.data[:100, 10] = 0
+    self.data[50:150, -1] = np.nan
+
+    sketch = TrajectoryQuantileSketch(self.data.shape[1])
+    for path in self.data:
+      sketch.add(path)
+
+    batched_sketch = TrajectoryQuantileSketch(self.data.shape[1])
+    for start in range(0, len(self.data), 37):
+      batched_sketch.add_paths(self.data[start:start + 37])
+
+    for name in TrajectoryQuantileSketch.state_arrays + ['count']:
+      self.assertTrue(np.array_equal(getattr(batched_sketch, name), getattr(sketch, name)))
+    self.assertTrue(np.array_equal(batched_sketch.sample_paths, sketch.sample_paths))
+
+class TestMcCheckpoint(unittest.TestCase):
+  def test_append_and_iterate(self):
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+      checkpoint = McCheckpoint(checkpoint_dir, chunk_size = 3)
+      checkpoint.write_manifest({'seed': 1234})
+
+      for trial in range(7):
+        checkpoint.append(trial, ('trial', trial))
+      self.assertEqual(checkpoint.get_completed_trials(), 6) # the last chunk is still pending
+
+      checkpoint.flush()
+      self.assertEqual(checkpoint.get_completed_trials(), 7)
+
+      # A new run continues where the previous one stopped
+      checkpoint = McCheckpoint(checkpoint_dir, chunk_size = 3)
+      self.assertEqual(checkpoint.read_manifest(), {'seed': 1234})
+      self.assertEqual(list(checkpoint.iterate(5)), [('trial', i) for i in range(5)])
+      self.assertEqual(list(checkpoint.iterate(100)), [('trial', i) for i in range(7)])
+
+      os.remove(checkpoint.get_chunks()[1][2])
+      with self.assertRaises(ValueError):
+        checkpoint.get_completed_trials()
+
+class TestMcAnalysisResults(unittest.TestCase):
+  def test_save_and_load(self):
+    rng = np.random.default_rng(0)
+    n_trials, n_timesteps = 20, 30
+
+    results = McAnalysisResults()
+    results.quantiles = [0.1, 0.5, 0.9]
+    results.metrics_quantiles = [{'Quantile': 0.5, 'full_automation_gns': 3.0}]
+    results.n_trials = n_trials
+    results.n_finished_trials = np.int64(18)
+    results.t_step = 0.1
+    results.t_start = 2022
+    results.t_end = 2025
+    results.slow_takeoff_count = 7
+    results.aggressive = False
+    results.seed = 2**100 + 1
+    results.checkpoint_dir = None
+    results.adaptive = False
+    results.stopped_early = False
+    results.qmc = 'sobol'
+    results.stratify_reqs = True
+    results.paired = False
+    results.antithetic = True
+    results.timesteps = np.linspace(2022, 2025, n_timesteps)
+    results.last_valid_indices = np.full(n_trials, n_timesteps - 1)
+    results.doubling_indices = rng.integers(-1, n_timesteps, (n_trials, 19))
+    results.scalar_metrics = {'full_automation_gns': rng.uniform(1, 10, n_trials), 'agi_year': rng.uniform(2022, 2100, n_trials)}
+
+    sketch = TrajectoryQuantileSketch(n_timesteps, warmup = 5, n_sample_paths = 3)
+    paths = 10**rng.uniform(20, 30, (n_trials, n_timesteps))
+    for path in paths:
+      sketch.add(path)
+    results.state_metrics = {'gwp': list(paths[:, :-5]), 'biggest_training_run': sketch}
+
+    results.param_samples = pd.DataFrame(rng.uniform(size = (n_trials, 2)), columns = ['a', 'b'])
+    results.parameter_table = pd.DataFrame({'Best guess': [1.0, 2.0], 'Type': ['normal', 'log']}, index = pd.Index(['a', 'b'], name = 'Parameter id'))
+    results.rank_correlations = pd.DataFrame([[1.0, 0.2], [0.2, 1.0]], index = ['a', 'b'], columns = ['a', 'b'])
+    results.ajeya_cdf = None
+    results.failures = pd.DataFrame({'trial': [3, 3], 'exception': ['FloatingPointError', 'PrescreenedSample'], 't_idx': [12, np.nan], 'time': [0.5, 0.], 'a': [0.1, 0.2], 'b': [0.3, 0.4]})
+
+    metrics = get_metrics_before_full_automation()
+    results.metrics_before_full_automation_quantiles = {metric: [{'Percentile': '50%', 'At time of full economic automation': i}] for i, metric in enumerate(metrics)}
+    results.precision = {'quantiles': {('full_automation_gns', 0.5): 0.3}, 'slow_takeoff_probability': 0.1, 'confidence': 0.95}
+
+    perf = PerfCounters()
+    perf.n_runs = 3
+    results.perf = perf
+
+    with tempfile.TemporaryDirectory() as path:
+      results.save(path)
+      loaded = McAnalysisResults.load(path)
+
+      for attr in McAnalysisResults.manifest_attributes:
+        self.assertEqual(getattr(loaded, attr), getattr(results, attr))
+
+      self.assertIsInstance(loaded.timesteps, np.memmap)
+      self.assertTrue(np.array_equal(loaded.doubling_indices, results.doubling_indices))
+      for metric, values in results.scalar_metrics.items():
+        self.assertTrue(np.array_equal(loaded.scalar_metrics[metric], values))
+
+      # The trajectories are padded to the number of timesteps
+      gwp = loaded.state_metrics['gwp']
+      self.assertEqual(gwp.shape, (n_trials, n_timesteps))
+      self.assertTrue(np.array_equal(gwp[:, :-5], paths[:, :-5]))
+      self.assertTrue(np.all(np.isnan(gwp[:, -5:])))
+
+      loaded_sketch = loaded.state_metrics['biggest_training_run']
+      self.assertTrue(np.array_equal(loaded_sketch.get_percentiles([10, 50, 90]), sketch.get_percentiles([10, 50, 90])))
+      self.assertTrue(np.array_equal(loaded_sketch.sample_paths[2], paths[2]))
+
+      pd.testing.assert_frame_equal(loaded.param_samples, results.param_samples)
+      pd.testing.assert_frame_equal(loaded.parameter_table, results.parameter_table)
+      pd.testing.assert_frame_equal(loaded.rank_correlations, results.rank_correlations)
+      self.assertIsNone(loaded.ajeya_cdf)
+      pd.testing.assert_frame_equal(loaded.failures, results.failures)
+
+      self.assertEqual([metric.name for metric in loaded.metrics_before_full_automation_quantiles], [metric.name for metric in metrics])
+      self.assertEqual(list(loaded.metrics_before_full_automation_quantiles.values()), list(results.metrics_before_full_automation_quantiles.values()))
+      self.assertEqual(loaded.precision, results.precision)
+      self.assertEqual(loaded.perf.n_runs, 3)
+
+class TestMcQuery(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.default_rng(0)
+    n_trials = 1000
+
+    self.results = McAnalysisResults()
+    self.results.n_trials = n_trials
+    self.results.t_end = 2100
+    self.results.param_samples = pd.DataFrame({'software_returns': rng.lognormal(size = n_trials)})
+    self.results.scalar_metrics = {'full_automation_gns': self.results.param_samples['software_returns'].to_numpy() + rng.uniform(size = n_trials)}
+
+  def test_where(self):
+    returns = self.results.param_samples['software_returns'].to_numpy()
+    gns = self.results.scalar_metrics['full_automation_gns']
+
+    query = McQuery(self.results).where(**parse_condition('software_returns>=q0.9'))
+    top_decile = returns >= np.quantile(returns, 0.9)
+    self.assertEqual(query.get_count(), np.sum(top_decile))
+    self.assertAlmostEqual(query.get_quantiles('full_automation_gns', [0.5])[0], np.median(gns[top_decile]))
+
+    query = query.where('full_automation_gns', high = 10)
+    self.assertTrue(np.all(query.get_values('full_automation_gns')[query.mask] < 10))
+
+    with self.assertRaises(ValueError):
+      parse_condition('software_returns > 2')
+
+  def test_grouped_quantiles(self):
+    rng = np.random.default_rng(1)
+    groups = rng.integers(-1, 8, 500)
+    values = rng.normal(size = 500)
+    values[:10] = np.nan
+
+    counts, quantiles = get_grouped_quantiles(groups, values, [0, 0.25, 0.5, 1], 7)
+    for group in range(7):
+      group_values = values[(groups == group) & ~np.isnan(values)]
+      self.assertEqual(counts[group], len(group_values))
+      self.assertTrue(np.allclose(quantiles[group], np.quantile(group_values, [0, 0.25, 0.5, 1])))
+
+    # Same as the weighted quantile of each group
+    weights = rng.uniform(size = 500)
+    counts, quantiles = get_grouped_quantiles(groups, values, [0.3], 7, weights = weights)
+    for group in range(7):
+      self.assertAlmostEqual(quantiles[group, 0], get_weighted_quantile(values[groups == group], weights[groups == group], 0.3))
+
+    table = McQuery(self.results).get_grouped_quantiles('full_automation_gns', 'software_returns', qs = [0.5], bins = 4)
+    self.assertEqual(list(table['Trials']), [250, 250, 250, 250])
+
+class TestMultiFidelityEstimator(unittest.TestCase):
+  def get_results(self, params, values, t_step):
+    results = McAnalysisResults()
+    results.n_trials = len(values)
+    results.t_end = 2100
+    results.t_step = t_step
+    results.quantiles = [0.1, 0.5, 0.9]
+    results.param_samples = pd.DataFrame({'a': params})
+    results.scalar_metrics = {'full_automation_gns': values, 'automation_gns_100%': np.full(len(values), 2050.)}
+    results.doubling_indices = np.full((len(values), TAKEOFF_TABLE_SIZE), -1)
+    return results
+
+  def test_control_variates(self):
+    rng = np.random.default_rng(0)
+    params = rng.uniform(size = 1000)
+    coarse_values = 10 * params + rng.normal(size = 1000)
+
+    # The fine values are the coarse ones plus a constant, so the estimates are exact
+    fine_params = params[:100].copy()
+    fine_values = coarse_values[:100] - 0.5
+
+    # (Except for a pair whose sample was redrawn in the fine run, which must be left out)
+    fine_params[7] = 2
+    fine_values[7] = 100
+
+    estimator = MultiFidelityEstimator(self.get_results(params, coarse_values, 1), self.get_results(fine_params, fine_values, 0.1))
+
+    self.assertEqual(estimator.paired.sum(), 99)
+    self.assertAlmostEqual(estimator.get_mean('full_automation_gns')[0], np.mean(coarse_values) - 0.5)
+    self.assertAlmostEqual(estimator.get_quantile('full_automation_gns', 0.9), np.quantile(coarse_values, 0.9) - 0.5)
+    self.assertAlmostEqual(estimator.get_correlation('full_automation_gns'), 1)
+    self.assertGreater(estimator.get_equivalent_trials('full_automation_gns'), 900)
+    self.assertAlmostEqual(estimator.get_full_automation_probability(), 1)
+
+class TestWorkQueue(unittest.TestCase):
+  def test_leases(self):
+    with tempfile.TemporaryDirectory() as path:
+      queue = WorkQueue(path, lease_time = 0.2)
+      ids = queue.add([(pow, (2, i)) for i in range(3)])
+
+      task_id, function, args = queue.claim('a')
+      self.assertEqual((task_id, function(*args)), (ids[0], 1))
+      self.assertEqual(queue.claim('b')[0], ids[1])
+
+      # The lease of a worker that stops renewing it expires, and the task goes back to the queue
+      self.assertTrue(queue.renew(ids[0], 'a'))
+      time.sleep(0.3)
+      self.assertEqual(queue.claim('c')[0], ids[0])
+      self.assertFalse(queue.renew(ids[0], 'a'))
+
+      queue.complete(ids[0], 1)
+      self.assertEqual(queue.get_counts(), {'pending': 1, 'leased': 1, 'done': 1, 'failed': 0})
+
+      # A worker finishes the rest (taking over the expired lease of 'b')
+      time.sleep(0.3)
+      self.assertEqual(run_worker(path, lease_time = 0.2), 2)
+      self.assertTrue(queue.is_finished())
+      self.assertEqual([queue.get_result(task_id) for task_id in ids], [1, 2, 4])
+
+  def test_failures(self):
+    with tempfile.TemporaryDirectory() as path:
+      queue = WorkQueue(path)
+      queue.add([(pow, (2, 3)), (int, ('not a number',))])
+
+      with self.assertRaises(ValueError):
+        run_worker(path)
+      self.assertEqual(queue.get_counts()['failed'], 1)
+
+      # The failed task isn't run again
+      with self.assertRaises(TaskFailed):
+        run_worker(path)
+
+  def test_failures_in_mc_analysis(self):
+    with tempfile.TemporaryDirectory() as path:
+      queue = WorkQueue(path)
+      queue.add([(int, ('not a number',))])
+      with self.assertRaises(ValueError):
+        run_worker(path)
+      queue.close()
+
+      # Resuming the analysis reports the failed task (rather than the gap it left in the checkpoint)
+      with self.assertRaises(TaskFailed) as context:
+        mc_analysis(n_trials = 4, queue_dir = path)
+      self.assertIn('not a number', str(context.exception))
+
+class TestMcPrecision(unittest.TestCase):
+  def test_quantile_ci_coverage(self):
+    rng = np.random.default_rng(0)
+    q = 0.9
+    true_quantile = stats.norm.ppf(q)
+
+    covered = 0
+    for i in range(400):
+      low, high = get_quantile_ci(rng.normal(size = 500), q)
+      covered += (low <= true_quantile <= high)
+    self.assertGreater(covered/400, 0.92)
+
+    # Too few samples for the extreme quantiles
+    self.assertEqual(get_quantile_ci(rng.normal(size = 20), 0.01), (-np.inf, np.inf))
+
+  def test_proportion_ci(self):
+    low, high = get_proportion_ci(50, 100)
+    self.assertAlmostEqual(high - low, 2 * 1.96 * 0.05, places = 3)
+    self.assertEqual(get_proportion_ci(0, 0), (-np.inf, np.inf))
+
+  def test_antithetic_units(self):
+    rng = np.random.default_rng(0)
+    x = rng.normal(size = 1000)
+
+    # Independent trials: the usual variance of the mean
+    self.assertAlmostEqual(get_ratio_variance(x, np.ones(len(x)), get_trial_units(len(x))), np.var(x, ddof = 1) / len(x))
+
+    # Antithetic pairs of a linear function cancel out
+    pairs = np.stack([x, -x], axis = 1).ravel()
+    self.assertAlmostEqual(get_ratio_variance(pairs, np.ones(len(pairs)), get_trial_units(len(pairs), antithetic = True)), 0)
+
+    # The interval of the median is much narrower than the one of the independent trials
+    low, high = get_quantile_ci(pairs, 0.5, units = get_trial_units(len(pairs), antithetic = True))
+    iid_low, iid_high = get_quantile_ci(pairs, 0.5)
+    self.assertLess(high - low, (iid_high - iid_low) / 5)
+
+class TestQuasiRandomSampling(unittest.TestCase):
+  def test_points(self):
+    points = QuasiRandomPoints(3, seed = 0, block_size = 16)
+    first = np.concatenate([points.random(5), points.random(20)])
+    self.assertEqual(first.shape, (25, 3))
+    self.assertTrue(np.allclose(first, QuasiRandomPoints(3, seed = 0).random(25)))
+
+    preset = PresetPoints([[0.1, 0.2, 0.3]], np.random.default_rng(0))
+    self.assertTrue(np.all(preset.random(1) == [[0.1, 0.2, 0.3]]))
+    self.assertEqual(preset.random(4).shape, (4, 3))
+
+    # The sources must implement random()
+    with self.assertRaises(TypeError):
+      UniformPoints(3)
+
+  def test_copula_with_uniforms(self):
+    corr = np.array([[1, 0.6, 0], [0.6, 1, -0.3], [0, -0.3, 1]])
+    copula = GaussianCopula(corr = corr, k_dim = 3)
+
+    uniforms = QuasiRandomPoints(3, seed = 0).random(4096)
+    samples = copula.rvs(nobs = len(uniforms), args = [np.nan] * 3, uniforms = uniforms)
+
+    # Uniform marginals and the right correlations
+    for i in range(3):
+      self.assertLess(stats.kstest(samples[:, i], 'uniform').statistic, 0.01)
+    normal_corr = np.corrcoef(stats.norm.ppf(samples), rowvar = False)
+    self.assertTrue(np.allclose(normal_corr, corr, atol = 0.02))
+
+    # Conditional samples keep the fixed values
+    samples = np.array(copula.rvs(nobs = 1, args = [0.9, np.nan, np.nan], uniforms = uniforms[:1]))
+    self.assertEqual(samples.shape, (1, 3))
+    self.assertAlmostEqual(samples[0, 0], 0.9)
+
+    # Also when each sample has its own
+    fixed = np.linspace(0.1, 0.9, 5)
+    args = np.column_stack([fixed, np.full(5, np.nan), np.full(5, np.nan)])
+    samples = copula.rvs(nobs = 5, args = args, uniforms = uniforms[:5])
+    self.assertTrue(np.allclose(samples[:, 0], fixed))
+    for i in range(5):
+      sample = copula.rvs(nobs = 1, args = args[i], uniforms = uniforms[i:i+1])
+      self.assertTrue(np.allclose(samples[i], sample))
+
+  def test_antithetic_copula(self):
+    corr = np.array([[1, 0.6, 0], [0.6, 1, -0.3], [0, -0.3, 1]])
+    copula = GaussianCopula(corr = corr, k_dim = 3)
+
+    samples = copula.rvs(nobs = 7, args = [np.nan] * 3, random_state = np.random.default_rng(0), antithetic = True)
+    self.assertEqual(samples.shape, (7, 3))
+    self.assertTrue(np.allclose(samples[0:6:2] + samples[1:6:2], 1))
+
+    # With uniforms, only the first sample of each pair uses them
+    uniforms = QuasiRandomPoints(3, seed = 0).random(4)
+    samples = copula.rvs(nobs = 8, args = [np.nan] * 3, uniforms = uniforms, antithetic = True)
+    self.assertTrue(np.allclose(samples[0::2], copula.rvs(nobs = 4, args = [np.nan] * 3, uniforms = uniforms)))
+
+    # Conditional samples are mirrored around their conditional mean
+    args = np.column_stack([np.repeat([0.2, 0.7], 2), np.full(4, np.nan), np.full(4, np.nan)])
+    samples = copula.rvs(nobs = 4, args = args, random_state = np.random.default_rng(0), antithetic = True)
+    self.assertTrue(np.allclose(samples[:, 0], args[:, 0]))
+    z = stats.norm.ppf(samples[:, 1:])
+    conditional_mean = stats.norm.ppf(args[:, :1]) * corr[0, 1:]
+    self.assertTrue(np.allclose(z[0::2] + z[1::2], 2 * conditional_mean[0::2]))